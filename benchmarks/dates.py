@@ -0,0 +1,76 @@
+"""
+Measures date range queries over a large directory.
+
+    python benchmarks/dates.py [--files 1000000] [--repeat 5]
+
+Every file is modified a second after the one before it. It times building the date indexes (the
+first date query builds them), range queries that find a few files and many, and keeping the indexes
+up to date as files change, against a scan that parses the date of every file the way the testbed
+did before the indexes.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from drivetestbed import query, throttle
+from drivetestbed.services import ServiceDirectory
+
+# 2015-01-01T00:00:00Z
+START = 1420070400
+
+
+def make_files(count):
+    return [{'id': "FILE_%08d" % i, 'title': "file %d" % i, 'mimeType': 'text/plain',
+             'createdDate': query.format_date(START + i), 'modifiedDate': query.format_date(START + i)}
+            for i in xrange(count)]
+
+
+def scan(files, field, date):
+    found = []
+    for afile in files._files.itervalues():
+        actual = query.parse_date(afile.get(field))
+        if actual is not None and actual > date:
+            found.append(afile['id'])
+    return found
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark date range queries")
+    parser.add_argument('--files', type=int, default=1000000, help="files in the directory")
+    parser.add_argument('--repeat', type=int, default=5, help="times each query is run, the best is kept")
+    args = parser.parse_args(argv[1:])
+    clock = throttle.VirtualClock(START + args.files)
+    directory = ServiceDirectory(files=make_files(args.files), clock=clock)
+    files = directory.files()
+    started = timeit.default_timer()
+    files._date_indexes()
+    print "%-24s %10.1fms" % ('index build', (timeit.default_timer() - started) * 1000)
+    queries = [
+        ('last 100 files', "modifiedDate > '%s'" % query.format_date(START + args.files - 101)),
+        ('a 10 second window', "createdDate >= '%s' and createdDate < '%s'" % (
+            query.format_date(START + args.files // 2), query.format_date(START + args.files // 2 + 10))),
+        ('newest half, one page', "modifiedDate > '%s'" % query.format_date(START + args.files // 2)),
+    ]
+    for name, q in queries:
+        best = min(timeit.repeat(lambda: files.list(q=q, maxResults=100), number=1, repeat=args.repeat))
+        print "%-24s %10.2fms" % (name, best * 1000)
+    step = max(1, args.files // 1000)
+    ids = ["FILE_%08d" % i for i in xrange(0, args.files, step)]
+
+    def patch_all():
+        for file_id in ids:
+            clock.advance(1)
+            files.patch(fileId=file_id, body={})
+    best = min(timeit.repeat(patch_all, number=1, repeat=1))
+    print "%-24s %10.2fus" % ('patch, indexes kept', best / len(ids) * 1e6)
+    date = query.parse_date(query.format_date(START + args.files - 101))
+    best = min(timeit.repeat(lambda: scan(files, 'modifiedDate', date), number=1, repeat=1))
+    print "%-24s %10.1fms" % ('scan', best * 1000)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,94 @@
+"""
+Measures the cost of routing a request: finding the service method for its path and reading its
+query parameters, without making the call.
+
+    python benchmarks/dispatch.py [--calls 100000]
+
+Times drivetestbed.dispatch (the method tries, the prebound handler table and parse_query)
+against the Routes mapper and urlparse.parse_qs the testbed used before, on the same mix of
+paths. Routes is only needed for the comparison; without it only the dispatcher is timed.
+"""
+import argparse
+import os
+import sys
+import timeit
+from urlparse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from drivetestbed import dispatch, schema
+from drivetestbed.services import ServiceDirectory
+
+# (method, path, query) of a mix of calls, like a test suite's
+REQUESTS = [
+    ('GET', "/drive/v2/files", "maxResults=100&q=%27FOLDER%27+in+parents"),
+    ('GET', "/drive/v2/files/FILE_00000001", ""),
+    ('GET', "/drive/v2/files/FILE_00000001", "alt=media"),
+    ('POST', "/drive/v2/files", ""),
+    ('POST', "/drive/v2/files/FILE_00000001/copy", "fields=id%2Ctitle"),
+    ('GET', "/drive/v2/files/FILE_00000001/parents", ""),
+    ('DELETE', "/drive/v2/files/FILE_00000001", ""),
+    ('GET', "/drive/v2/files/FILE_00000001/permissions", ""),
+    ('POST', "/drive/v2/files/FILE_00000001/permissions", "sendNotificationEmails=false"),
+    ('DELETE', "/drive/v2/files/FILE_00000001/parents/FOLDER", ""),
+    ('GET', "/drive/v2/files/FOLDER/children", "maxResults=50&pageToken=50"),
+    ('GET', "/drive/v2/changes", "startChangeId=10"),
+]
+
+
+def route_with_dispatcher(directory, dispatcher):
+    for method, path, query in REQUESTS:
+        route, params = dispatcher.match(method, path)
+        directory.handler(route.resource, route.action)
+        dispatch.parse_query(query)
+
+
+def build_mapper(discovery):
+    from routes import Mapper
+    mapper = Mapper()
+    with mapper.submapper(path_prefix=schema.PATH_PREFIX) as m:
+        for r_name, r_data in discovery['resources'].iteritems():
+            for meth_name, meth_data in r_data['methods'].iteritems():
+                m.connect(meth_data['path'], conditions={'method': [meth_data['httpMethod']]},
+                          controller=r_name, action=meth_name)
+    mapper.create_regs()
+    return mapper
+
+
+def route_with_mapper(directory, mapper):
+    for method, path, query in REQUESTS:
+        matched = mapper.match(path, environ={'REQUEST_METHOD': method})
+        getattr(directory.for_name(matched['controller']), matched['action'])
+        params = parse_qs(query)
+        for key in params.keys():
+            if len(params[key]) == 1:
+                params[key] = params[key][0]
+
+
+def per_call_us(func, calls):
+    rounds = max(1, calls // len(REQUESTS))
+    best = min(timeit.repeat(func, number=rounds, repeat=3))
+    return best / (rounds * len(REQUESTS)) * 1e6
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark request routing")
+    parser.add_argument('--calls', type=int, default=100000, help="requests routed per timing")
+    args = parser.parse_args(argv[1:])
+    cache = schema.get_cache()
+    directory = ServiceDirectory()
+    dispatcher = cache.dispatcher
+    print "dispatcher:       %6.2fus a request" % per_call_us(lambda: route_with_dispatcher(directory, dispatcher),
+                                                             args.calls)
+    try:
+        mapper = build_mapper(cache.schema)
+    except ImportError:
+        print "routes isn't installed, nothing to compare with"
+        return 0
+    print "routes+parse_qs:  %6.2fus a request" % per_call_us(lambda: route_with_mapper(directory, mapper),
+                                                             args.calls)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,114 @@
+"""
+Measures the memory the in-memory store uses for each file.
+
+    python benchmarks/memory.py [--files 100000]
+
+Reports the deep size of the ServiceDirectory (every object reachable from it, shared
+objects counted once) divided by the number of files, plus the growth in peak RSS. For
+comparison it builds the same files in the layout the store used before FileRecord: a dict
+for each file with its own labels and owners, and its own permission and parent reference
+dicts, with a set in the indexes for every value.
+"""
+import argparse
+import gc
+import os
+import resource
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from drivetestbed.services import DEFAULT_LABELS, ROOT_FOLDER_ID, ServiceDirectory, _default_owner
+from drivetestbed.store import OrderedStore
+
+_SKIP_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+               types.MethodType, types.CodeType, types.ClassType)
+
+
+def deep_size(root):
+    """
+    :return: bytes used by root and everything it refers to, each object counted once
+    """
+    seen = set()
+    pending = [root]
+    total = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen or isinstance(obj, _SKIP_TYPES):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        pending.extend(gc.get_referents(obj))
+    return total
+
+
+def make_files(count):
+    return [{'id': "FILE_%08d" % i, 'title': "file number %d" % i, 'mimeType': 'text/plain'}
+            for i in xrange(count)]
+
+
+def dict_layout(files, user_email="test@drivetestbed.org"):
+    """
+    :return: the files, their permissions, parents and indexes as the store kept them in plain dicts
+    """
+    owner_perm, owner_data = _default_owner(user_email)
+    store = OrderedStore()
+    permissions = {}
+    parents = {}
+    root_children = OrderedStore()
+    field_index = {'title': {}, 'mimeType': {}}
+    owner_ids = {}
+    for record in files:
+        afile = dict(record)
+        file_id = afile['id']
+        afile['labels'] = dict(DEFAULT_LABELS)
+        afile['owners'] = [dict(owner_data, picture=dict(owner_data['picture']))]
+        store[file_id] = afile
+        for field, index in field_index.iteritems():
+            index.setdefault(afile.get(field), set()).add(file_id)
+        perms = permissions[file_id] = OrderedStore()
+        perms[owner_perm['id']] = dict(owner_perm)
+        owner_ids[file_id] = 1
+        file_parents = parents[file_id] = OrderedStore()
+        file_parents[ROOT_FOLDER_ID] = {
+            "kind": "drive#parentReference",
+            "id": ROOT_FOLDER_ID,
+            "selfLink": "https://www.googleapis.com/drive/v2/files/%s/parents/%s" % (file_id, ROOT_FOLDER_ID),
+            "parentLink": "https://www.googleapis.com/drive/v2/files/%s" % ROOT_FOLDER_ID,
+            "isRoot": True
+        }
+        root_children[file_id] = file_id
+    return store, permissions, parents, root_children, field_index, owner_ids
+
+
+def measure(count):
+    files = make_files(count)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    directory = ServiceDirectory(files=files)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # after the directory, so that its peak RSS doesn't include this
+    baseline = deep_size(dict_layout(files))
+    # don't count the fixture list itself
+    del files
+    empty = deep_size(ServiceDirectory())
+    size = deep_size(directory) - empty
+    return {
+        'files': count,
+        'bytes_per_file': size / float(count),
+        'dict_bytes_per_file': baseline / float(count),
+        'rss_growth_kb': rss_after - rss_before,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Measure the memory used for each file")
+    parser.add_argument('--files', type=int, default=100000, help="files in the directory")
+    args = parser.parse_args(argv[1:])
+    result = measure(args.files)
+    print "%(files)d files: %(bytes_per_file).0f bytes per file, peak RSS grew %(rss_growth_kb)d KB" % result
+    print "as plain dicts: %(dict_bytes_per_file).0f bytes per file" % result
+    return result
+
+
+if __name__ == '__main__':
+    main(sys.argv)
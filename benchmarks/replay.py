@@ -0,0 +1,65 @@
+"""
+Measures replaying a log of recorded calls, in one process and fanned out over workers.
+
+    python benchmarks/replay.py [--tenants 8] [--calls 2000] [--workers 1,4]
+
+Records `calls` calls for each tenant (inserts, gets, lists with a query, parents and permission
+changes, made through the client library) into a temporary log, then replays it as fast as possible
+with each number of workers and prints the report.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apiclient.discovery import build
+from drivetestbed import http, traffic
+
+FILES = [{'id': "FOLDER_%d" % i, 'title': "folder %d" % i,
+          'mimeType': 'application/vnd.google-apps.folder'} for i in xrange(10)]
+
+
+def record(path, tenants, calls):
+    recorder = traffic.Recorder(path)
+    for tenant in xrange(tenants):
+        drive = build('drive', 'v2', http=http.TestbedHttp(files=FILES, user_email="user%d@x.org" % tenant,
+                                                           recorder=recorder))
+        made = []
+        for i in xrange(calls // 5):
+            file_id = drive.files().insert(body={'title': "report %d" % i}).execute()['id']
+            made.append(file_id)
+            drive.parents().insert(fileId=file_id, body={'id': "FOLDER_%d" % (i % 10)}).execute()
+            drive.permissions().insert(fileId=file_id, body={'type': 'user', 'role': 'reader',
+                                                             'value': "reader%d@x.org" % i}).execute()
+            drive.files().get(fileId=made[i // 2]).execute()
+            drive.files().list(q="'FOLDER_%d' in parents and title contains 'report'" % (i % 10),
+                               maxResults=20).execute()
+    recorder.close()
+    return recorder.calls
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark replaying recorded traffic")
+    parser.add_argument('--tenants', type=int, default=8, help="directories the calls are shared between")
+    parser.add_argument('--calls', type=int, default=2000, help="calls recorded for each tenant")
+    parser.add_argument('--workers', default='1,4', help="comma separated numbers of workers to replay with")
+    args = parser.parse_args(argv[1:])
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, "traffic.log")
+        count = record(path, args.tenants, args.calls)
+        print "recorded %d calls, %d bytes of log" % (count, os.path.getsize(path))
+        for workers in [int(value) for value in args.workers.split(',')]:
+            print
+            print "%d worker(s):" % workers
+            print traffic.replay(path, files=FILES, workers=workers).format()
+    finally:
+        shutil.rmtree(folder)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,128 @@
+"""
+Measures the throughput of the standalone testbed server.
+
+    python benchmarks/server.py [--connections 1000] [--requests 20] [--depth 4]
+
+Starts a TestbedServer in a child process with 1000 files, then opens every connection at
+once from a single-threaded load client and keeps each one `depth` requests ahead
+(files.get, keep-alive, pipelined). Reports requests per second over the whole run.
+"""
+import argparse
+import asyncore
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from drivetestbed.server import TestbedServer
+from drivetestbed.services import ServiceDirectory
+
+FILE_COUNT = 1000
+
+
+def run_server(ready):
+    files = [{'id': "FILE_%d" % i, 'title': "file %d" % i} for i in xrange(FILE_COUNT)]
+    server = TestbedServer(ServiceDirectory(files=files))
+    ready.send(server.address)
+    server.serve_forever()
+
+
+class LoadClient(asyncore.dispatcher):
+    """
+    One keep-alive connection that sends `requests` GETs, at most `depth` outstanding at a time
+    """
+
+    def __init__(self, address, requests, depth, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+        self._to_send = requests
+        self._outstanding = 0
+        self._depth = depth
+        self._in = ''
+        self._out = ''
+        self.done = 0
+        self.errors = 0
+        self._fill()
+
+    def _fill(self):
+        while self._to_send and self._outstanding < self._depth:
+            file_id = "FILE_%d" % (self._to_send % FILE_COUNT)
+            self._out += "GET /drive/v2/files/%s HTTP/1.1\r\nHost: localhost\r\n\r\n" % file_id
+            self._to_send -= 1
+            self._outstanding += 1
+
+    def handle_connect(self):
+        pass
+
+    def writable(self):
+        return bool(self._out) or not self.connected
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+
+    def handle_read(self):
+        self._in += self.recv(1 << 16)
+        while True:
+            end = self._in.find('\r\n\r\n')
+            if end < 0:
+                break
+            head = self._in[:end]
+            length = int(head.split('Content-Length: ', 1)[1].split('\r\n', 1)[0])
+            if len(self._in) < end + 4 + length:
+                break
+            if not head.startswith('HTTP/1.1 200'):
+                self.errors += 1
+            self._in = self._in[end + 4 + length:]
+            self._outstanding -= 1
+            self.done += 1
+        self._fill()
+        if not self._to_send and not self._outstanding:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+
+def measure(connections, requests, depth):
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run_server, args=(child,))
+    process.daemon = True
+    process.start()
+    address = parent.recv()
+    try:
+        socket_map = {}
+        started = time.time()
+        clients = [LoadClient(address, requests, depth, socket_map) for i in xrange(connections)]
+        asyncore.loop(timeout=1, use_poll=True, map=socket_map)
+        seconds = time.time() - started
+    finally:
+        process.terminate()
+    done = sum(client.done for client in clients)
+    return {
+        'connections': connections,
+        'requests': done,
+        'errors': sum(client.errors for client in clients),
+        'seconds': seconds,
+        'requests_per_second': done / seconds,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the standalone testbed server")
+    parser.add_argument('--connections', type=int, default=1000, help="connections opened at once")
+    parser.add_argument('--requests', type=int, default=20, help="requests sent on each connection")
+    parser.add_argument('--depth', type=int, default=4, help="requests each connection keeps outstanding")
+    args = parser.parse_args(argv[1:])
+    result = measure(args.connections, args.requests, args.depth)
+    print ("%(connections)d connections, %(requests)d requests (%(errors)d errors) in %(seconds).2fs: "
+           "%(requests_per_second).0f requests/s" % result)
+    return result
+
+
+if __name__ == '__main__':
+    main(sys.argv)
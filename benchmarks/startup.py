@@ -0,0 +1,77 @@
+"""
+Measures how long the testbed takes to start: importing it, setting up a directory and
+answering the first requests.
+
+    python benchmarks/startup.py [--files 100000] [--runs 5]
+
+Each run is a fresh Python process, so nothing is imported or cached yet. It times:
+
+* import: `import drivetestbed.http`
+* setup: a TestbedHttp over `files` fixture files (building the records isn't counted)
+* first files.get: the first request, which reads the schema and compiles the dispatcher
+* first permissions.list and parents.list: the first requests to use those services, which
+  take in their share of the fixture then
+
+and reports the median of the runs in milliseconds.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run in the child process, with the number of files as its argument
+CHILD = r"""
+import json, sys, timeit
+timer = timeit.default_timer
+count = int(sys.argv[1])
+files = [{'id': "FILE_%08d" % i, 'title': "file %d" % i, 'mimeType': 'text/plain'} for i in xrange(count)]
+times = {}
+started = timer()
+from drivetestbed.http import TestbedHttp
+times['import'] = timer() - started
+started = timer()
+testbed = TestbedHttp(files=files)
+times['setup'] = timer() - started
+for name, path in (('first files.get', "files/FILE_00000000"),
+                   ('first permissions.list', "files/FILE_00000000/permissions"),
+                   ('first parents.list', "files/FILE_00000000/parents")):
+    started = timer()
+    resp, content = testbed.request("https://www.googleapis.com/drive/v2/" + path)
+    times[name] = timer() - started
+    assert resp.status == 200, (path, resp.status)
+print json.dumps(times)
+"""
+
+STEPS = ('import', 'setup', 'first files.get', 'first permissions.list', 'first parents.list')
+
+
+def run_once(count):
+    output = subprocess.check_output([sys.executable, '-c', CHILD, str(count)], cwd=ROOT)
+    return json.loads(output)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the testbed's startup")
+    parser.add_argument('--files', type=int, default=100000, help="fixture files to set up with")
+    parser.add_argument('--runs', type=int, default=5, help="processes to start")
+    args = parser.parse_args(argv[1:])
+    runs = [run_once(args.files) for i in xrange(args.runs)]
+    total = 0.0
+    for step in STEPS:
+        value = median([run[step] for run in runs]) * 1000
+        total += value
+        print "%-24s %9.1fms" % (step, value)
+    print "%-24s %9.1fms" % ('total', total)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,311 @@
+"""
+Measures how the testbed scales with the number of files it holds.
+
+    python benchmarks/suite.py [--sizes 1000,100000,1000000] [--calls 500] [--output results.json]
+    python benchmarks/suite.py --compare old.json new.json [--threshold 0.2]
+
+For each size, in a fresh child process (so peak memory is that size's alone):
+
+* bulk load: building a ServiceDirectory from a list of records, and streaming the same
+  records from an NDJSON file with ServiceDirectory.load
+* peak RSS after loading and running every call
+* the round trip of files.list, files.get, files.insert, files.copy, permissions.insert and
+  parents.insert through TestbedHttp.request: routing, the service call and the JSON encoding,
+  `calls` times each, reported as mean, median, p95 and max in microseconds
+
+and once, outside the sizes, the time to build the Drive service from the discovery document,
+cold (the schema is read and its dispatcher compiled) and warm.
+
+The fixture is the same for every run: every 100th file is a folder and the others are spread
+over the folders. Calls pick files with a fixed seed.
+
+The results are written as JSON (to stdout unless --output is given) with the commit, Python
+version and platform. --compare prints each measurement of two result files side by side and
+exits with status 1 if any got slower by more than the threshold.
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apiclient.discovery import build
+from drivetestbed import schema
+from drivetestbed.http import TestbedHttp
+from drivetestbed.services import ServiceDirectory
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+DEFAULT_CALLS = 500
+FOLDER_EVERY = 100
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+BASE_URI = "https://www.googleapis.com/drive/v2/"
+SEED = 1
+
+
+def make_files(count):
+    files = []
+    for i in xrange(count):
+        if i % FOLDER_EVERY == 0:
+            files.append({'id': "FOLDER_%08d" % i, 'title': "folder %d" % i, 'mimeType': FOLDER_MIME_TYPE})
+        else:
+            folder = i - i % FOLDER_EVERY
+            files.append({'id': "FILE_%08d" % i, 'title': "file number %d" % i, 'mimeType': 'text/plain',
+                          'parents': [{'id': "FOLDER_%08d" % folder}]})
+    return files
+
+
+def file_ids(count):
+    return ["FOLDER_%08d" % i if i % FOLDER_EVERY == 0 else "FILE_%08d" % i for i in xrange(count)]
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def summarize(samples):
+    """
+    :param samples: seconds per call
+    :return: dict of statistics in microseconds
+    """
+    samples = sorted(samples)
+    count = len(samples)
+    return {
+        'calls': count,
+        'mean_us': sum(samples) / count * 1e6,
+        'median_us': samples[count // 2] * 1e6,
+        'p95_us': samples[min(int(count * 0.95), count - 1)] * 1e6,
+        'max_us': samples[-1] * 1e6,
+    }
+
+
+def time_calls(calls, make_request, testbed):
+    """
+    :param make_request: i -> (uri, method, body) of the i'th call
+    :return: summary of the round trips, see summarize
+    """
+    timer = timeit.default_timer
+    samples = []
+    for i in xrange(calls):
+        uri, method, body = make_request(i)
+        started = timer()
+        resp, content = testbed.request(uri, method=method, body=body)
+        samples.append(timer() - started)
+        if resp.status != 200:
+            raise AssertionError("%s %s answered %d" % (method, uri, resp.status))
+    return summarize(samples)
+
+
+def measure_endpoints(directory, count, calls):
+    testbed = TestbedHttp()
+    testbed._services = directory
+    testbed._use_schema()
+    rand = random.Random(SEED)
+    ids = file_ids(count)
+    folders = ids[::FOLDER_EVERY]
+    picks = [rand.choice(ids) for i in xrange(calls)]
+    folder_picks = [rand.choice(folders) for i in xrange(calls)]
+    insert_body = json.dumps({'title': "inserted", 'mimeType': 'text/plain'})
+    permission_body = json.dumps({'type': 'user', 'role': 'reader', 'value': 'reader@example.com'})
+
+    endpoints = [
+        ('files.list', lambda i: (BASE_URI + "files?maxResults=100", 'GET', None)),
+        ('files.list.query', lambda i: (BASE_URI + "files?maxResults=100&q=%27" + folder_picks[i] + "%27+in+parents",
+                                        'GET', None)),
+        ('files.get', lambda i: (BASE_URI + "files/" + picks[i], 'GET', None)),
+        ('files.insert', lambda i: (BASE_URI + "files", 'POST', insert_body)),
+        ('files.copy', lambda i: (BASE_URI + "files/%s/copy" % picks[i], 'POST', None)),
+        ('permissions.insert', lambda i: (BASE_URI + "files/%s/permissions" % picks[i], 'POST', permission_body)),
+        ('parents.insert', lambda i: (BASE_URI + "files/%s/parents" % picks[i], 'POST',
+                                      json.dumps({'id': folder_picks[i]}))),
+    ]
+    results = {}
+    for name, make_request in endpoints:
+        gc.collect()
+        results[name] = time_calls(calls, make_request, testbed)
+    return results
+
+
+def measure_size(count, calls):
+    """
+    Everything measured for one size. Run in its own process.
+    """
+    result = {'files': count}
+    files = make_files(count)
+    gc.collect()
+    started = time.time()
+    ServiceDirectory(files=files)
+    result['load_list_seconds'] = time.time() - started
+
+    fd, path = tempfile.mkstemp(suffix='.ndjson')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            for record in files:
+                fp.write(json.dumps(record))
+                fp.write('\n')
+        del files
+        gc.collect()
+        directory = ServiceDirectory()
+        stats = directory.load(path)
+        result['load_ndjson_seconds'] = stats.seconds
+        result['load_ndjson_files_per_second'] = stats.files_per_second
+    finally:
+        os.remove(path)
+
+    result['endpoints'] = measure_endpoints(directory, count, calls)
+    result['peak_rss_kb'] = peak_rss_kb()
+    return result
+
+
+def _run_size(count, calls, pipe):
+    pipe.send(measure_size(count, calls))
+
+
+def run_size(count, calls):
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_size, args=(count, calls, child))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def measure_build(builds=20):
+    """
+    Build the Drive service from the discovery document, first with nothing cached then warm
+    """
+    schema.get_cache().clear()
+    started = timeit.default_timer()
+    build('drive', 'v2', http=TestbedHttp())
+    cold = timeit.default_timer() - started
+    samples = []
+    for i in xrange(builds):
+        started = timeit.default_timer()
+        build('drive', 'v2', http=TestbedHttp())
+        samples.append(timeit.default_timer() - started)
+    result = summarize(samples)
+    result['cold_us'] = cold * 1e6
+    return result
+
+
+def _run_build(pipe):
+    pipe.send(measure_build())
+
+
+def run_build():
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_run_build, args=(child,))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, calls):
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'calls': calls,
+        'discovery_build': run_build(),
+        'sizes': [run_size(count, calls) for count in sizes],
+    }
+
+
+def flatten(results):
+    """
+    :return: {measurement name: value} for everything in a result file where lower is better
+    """
+    values = {}
+    build_result = results['discovery_build']
+    values['discovery_build.cold_us'] = build_result['cold_us']
+    values['discovery_build.median_us'] = build_result['median_us']
+    for size in results['sizes']:
+        prefix = "%d." % size['files']
+        values[prefix + 'load_list_seconds'] = size['load_list_seconds']
+        values[prefix + 'load_ndjson_seconds'] = size['load_ndjson_seconds']
+        values[prefix + 'peak_rss_kb'] = size['peak_rss_kb']
+        for name, summary in size['endpoints'].iteritems():
+            values[prefix + name + '.median_us'] = summary['median_us']
+            values[prefix + name + '.p95_us'] = summary['p95_us']
+    return values
+
+
+def compare(old, new, threshold):
+    """
+    Print every measurement in both files with the change between them
+    :return: names of the measurements that got worse by more than threshold
+    """
+    old_values = flatten(old)
+    new_values = flatten(new)
+    worse = []
+    print "%-45s %14s %14s %8s" % ("measurement", "old", "new", "change")
+    for name in sorted(set(old_values) & set(new_values)):
+        before, after = old_values[name], new_values[name]
+        change = (after - before) / before if before else 0.0
+        flag = ''
+        if change > threshold:
+            worse.append(name)
+            flag = ' <-- slower'
+        print "%-45s %14.1f %14.1f %+7.0f%%%s" % (name, before, after, change * 100, flag)
+    return worse
+
+
+def print_summary(results):
+    build_result = results['discovery_build']
+    print >> sys.stderr, "discovery build: %.0fus cold, %.0fus warm" % (build_result['cold_us'],
+                                                                     build_result['median_us'])
+    for size in results['sizes']:
+        print >> sys.stderr, ("%(files)d files: loaded in %(load_list_seconds).2fs from a list, "
+                              "%(load_ndjson_seconds).2fs from NDJSON, peak RSS %(peak_rss_kb)d KB" % size)
+        for name in sorted(size['endpoints']):
+            print >> sys.stderr, "    %-20s median %8.1fus  p95 %8.1fus" % (
+                name, size['endpoints'][name]['median_us'], size['endpoints'][name]['p95_us'])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the Drive testbed")
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help="comma separated numbers of files")
+    parser.add_argument('--calls', type=int, default=DEFAULT_CALLS, help="calls timed per endpoint and size")
+    parser.add_argument('--output', help="file to write the JSON results to, stdout if not given")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="with --compare, the fraction slower that counts as a regression")
+    args = parser.parse_args(argv[1:])
+    if args.compare:
+        with open(args.compare[0]) as fp:
+            old = json.load(fp)
+        with open(args.compare[1]) as fp:
+            new = json.load(fp)
+        return 1 if compare(old, new, args.threshold) else 0
+    results = run([int(size) for size in args.sizes.split(',')], args.calls)
+    print_summary(results)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
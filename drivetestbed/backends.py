@@ -0,0 +1,278 @@
+# where a ServiceDirectory keeps its files, permissions and parents
+import json
+import threading
+from drivetestbed.loader import gc_paused
+from drivetestbed.media import Blob
+from drivetestbed.records import principal
+
+__author__ = 'charlie'
+
+
+class DictBackend(object):
+    """
+    The default: everything lives in the services' own dicts, in this process only
+    """
+
+    # True if other directories, possibly in other processes, may write to the same data
+    shared = False
+
+    def attach(self, directory, files):
+        """
+        Called once, by the directory's constructor
+        :param files: fixture records to load
+        """
+        if files:
+            directory._load(files)
+
+    def stale(self):
+        return False
+
+    def refresh(self, directory):
+        pass
+
+    def begin(self, directory):
+        pass
+
+    def commit(self, directory, file_ids):
+        pass
+
+    def rollback(self, directory, file_ids):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteBackend(DictBackend):
+    """
+    Keeps the directory in an SQLite database (in WAL mode) that any number of directories, in any
+    number of processes, can share: e.g. one per pytest-xdist worker, all using a fixture that the
+    first of them loaded.
+
+    Each directory still answers calls from its own in-memory services; the database is the
+    shared copy they are kept in step with. A write takes the database's write lock, catches up
+    with what other directories committed, makes its change in memory and writes every file it
+    touched back in the same transaction, so a change that spans services is committed whole
+    or not at all. Reads catch up first if anything was committed since the last one.
+
+    Each commit appends the ids it touched to a change log, so catching up costs in proportion
+    to the number of files changed elsewhere, not the size of the directory.
+    """
+
+    shared = True
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS files (id TEXT PRIMARY KEY, seq INTEGER NOT NULL, data TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS permissions (file_id TEXT NOT NULL, position INTEGER NOT NULL, "
+        "perm_id TEXT NOT NULL, principal TEXT, role TEXT, data TEXT NOT NULL, PRIMARY KEY (file_id, position))",
+        "CREATE INDEX IF NOT EXISTS permissions_principal ON permissions (principal, role)",
+        "CREATE TABLE IF NOT EXISTS parents (file_id TEXT NOT NULL, position INTEGER NOT NULL, "
+        "parent_id TEXT NOT NULL, seq INTEGER NOT NULL, PRIMARY KEY (file_id, position))",
+        "CREATE INDEX IF NOT EXISTS parents_parent ON parents (parent_id)",
+        "CREATE TABLE IF NOT EXISTS content (file_id TEXT PRIMARY KEY, md5 TEXT NOT NULL, data BLOB NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS changes (version INTEGER PRIMARY KEY AUTOINCREMENT, file_id TEXT NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    )
+
+    def __init__(self, path, timeout=60.0):
+        """
+        :param path: the database file, created if it doesn't exist
+        :param timeout: seconds to wait for another process's write to finish
+        """
+        # only imported by those that use it
+        import sqlite3
+        self.path = path
+        # transactions are managed here, not by the sqlite3 module
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        # the connection is shared by the directory's threads
+        self._mutex = threading.RLock()
+        self._version = 0
+        self._in_transaction = False
+        with self._mutex:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            for statement in self._SCHEMA:
+                self._db.execute(statement)
+
+    def attach(self, directory, files):
+        """
+        The first directory to attach to a new database loads the fixture into it, the rest
+        load what is in the database and ignore their fixture.
+        """
+        with directory._writing():
+            if self._db.execute("SELECT value FROM meta WHERE key = 'loaded'").fetchone() is None:
+                if files:
+                    directory._load(files)
+                self._db.execute("INSERT INTO meta (key, value) VALUES ('loaded', '1')")
+
+    def _latest_version(self):
+        row = self._db.execute("SELECT MAX(version) FROM changes").fetchone()
+        return row[0] or 0
+
+    def stale(self):
+        """
+        :return: True if another directory has committed since this one last caught up
+        """
+        with self._mutex:
+            return self._latest_version() != self._version
+
+    def refresh(self, directory):
+        """
+        Bring the directory's services up to date with the database. Called under its write lock.
+        """
+        with self._mutex:
+            if self._in_transaction:
+                self._catch_up(directory)
+                return
+            # read every table as of the same commit
+            self._db.execute("BEGIN")
+            try:
+                self._catch_up(directory)
+            finally:
+                self._db.execute("COMMIT")
+
+    def _catch_up(self, directory):
+        latest = self._latest_version()
+        if latest == self._version:
+            return
+        if not self._version:
+            self._load_all(directory)
+        else:
+            rows = self._db.execute("SELECT DISTINCT file_id FROM changes WHERE version > ?",
+                                    (self._version,))
+            self._reload(directory, [row[0] for row in rows])
+        self._version = latest
+
+    def _read_state(self, file_id):
+        """
+        :return: the file's state in the form of ServiceDirectory._export, None if it isn't in the database
+        """
+        row = self._db.execute("SELECT seq, data FROM files WHERE id = ?", (file_id,)).fetchone()
+        if row is None:
+            return None
+        perms = self._db.execute("SELECT data FROM permissions WHERE file_id = ? ORDER BY position",
+                                 (file_id,))
+        parents = self._db.execute("SELECT parent_id, seq FROM parents WHERE file_id = ? ORDER BY position",
+                                   (file_id,))
+        content = self._db.execute("SELECT data FROM content WHERE file_id = ?", (file_id,)).fetchone()
+        return {
+            'files': (row[0], json.loads(row[1])),
+            'permissions': [json.loads(data) for data, in perms],
+            'parents': [(parent_id, seq) for parent_id, seq in parents],
+            'content': Blob.from_string(content[0]) if content else None,
+        }
+
+    def _reload(self, directory, file_ids):
+        for file_id in file_ids:
+            directory._forget_file(file_id)
+        for file_id in file_ids:
+            state = self._read_state(file_id)
+            if state is not None:
+                directory._import_file(file_id, state)
+
+    def _load_all(self, directory):
+        """
+        Load the whole database into an empty directory, reading each table once.
+        The garbage collector is paused, as it is for loading fixtures.
+        """
+        with gc_paused():
+            self._load_tables(directory)
+
+    def _load_tables(self, directory):
+        perms = {}
+        # most files have the same default owner, only decode it once. _import copies what it keeps.
+        decoded = {}
+        for file_id, data in self._db.execute("SELECT file_id, data FROM permissions ORDER BY file_id, position"):
+            permission = decoded.get(data)
+            if permission is None:
+                permission = decoded[data] = json.loads(data)
+            perms.setdefault(file_id, []).append(permission)
+        parents = {}
+        for file_id, parent_id, seq in self._db.execute(
+                "SELECT file_id, parent_id, seq FROM parents ORDER BY file_id, position"):
+            parents.setdefault(file_id, []).append((parent_id, seq))
+        contents = {}
+        for file_id, data in self._db.execute("SELECT file_id, data FROM content"):
+            contents[file_id] = Blob.from_string(data)
+        for file_id, seq, data in self._db.execute("SELECT id, seq, data FROM files ORDER BY seq"):
+            directory._import_file(file_id, {
+                'files': (seq, json.loads(data)),
+                'permissions': perms.pop(file_id, []),
+                'parents': parents.pop(file_id, []),
+                'content': contents.pop(file_id, None),
+            }, changed=False)
+
+    def begin(self, directory):
+        with self._mutex:
+            # take the database's write lock now, so nobody commits between catching up and writing
+            self._db.execute("BEGIN IMMEDIATE")
+            self._in_transaction = True
+            try:
+                self._catch_up(directory)
+            except Exception:
+                self._in_transaction = False
+                self._db.execute("ROLLBACK")
+                raise
+
+    def commit(self, directory, file_ids):
+        with self._mutex:
+            try:
+                cursor = self._db.cursor()
+                for file_id in file_ids:
+                    self._write_state(cursor, file_id, directory._export(file_id))
+                if file_ids:
+                    cursor.executemany("INSERT INTO changes (file_id) VALUES (?)",
+                                       [(file_id,) for file_id in file_ids])
+                    # every change before ours was read by begin()
+                    self._version = self._latest_version()
+                self._db.execute("COMMIT")
+                self._in_transaction = False
+            except Exception:
+                self.rollback(directory, file_ids)
+                raise
+
+    def _write_state(self, cursor, file_id, state):
+        for table, column in (('files', 'id'), ('permissions', 'file_id'), ('parents', 'file_id')):
+            cursor.execute("DELETE FROM %s WHERE %s = ?" % (table, column), (file_id,))
+        self._write_content(cursor, file_id, state and state.get('content'))
+        if state is None:
+            return
+        seq, afile = state['files']
+        cursor.execute("INSERT INTO files (id, seq, data) VALUES (?, ?, ?)", (file_id, seq, json.dumps(afile)))
+        cursor.executemany(
+            "INSERT INTO permissions (file_id, position, perm_id, principal, role, data) VALUES (?, ?, ?, ?, ?, ?)",
+            [(file_id, position, perm['id'], principal(perm), perm.get('role'), json.dumps(perm))
+             for position, perm in enumerate(state['permissions'] or ())])
+        cursor.executemany(
+            "INSERT INTO parents (file_id, position, parent_id, seq) VALUES (?, ?, ?, ?)",
+            [(file_id, position, parent_id, seq) for position, (parent_id, seq) in enumerate(state['parents'] or ())])
+
+    def _write_content(self, cursor, file_id, blob):
+        """
+        Store the file's content, unless the database already has the same content for it:
+        most changes to a file with content don't touch the content.
+        """
+        if blob is None:
+            cursor.execute("DELETE FROM content WHERE file_id = ?", (file_id,))
+            return
+        row = cursor.execute("SELECT md5 FROM content WHERE file_id = ?", (file_id,)).fetchone()
+        if row is None or row[0] != blob.md5:
+            cursor.execute("INSERT OR REPLACE INTO content (file_id, md5, data) VALUES (?, ?, ?)",
+                           (file_id, blob.md5, blob.view()))
+
+    def rollback(self, directory, file_ids):
+        """
+        Undo the transaction and put the files it touched back the way the database has them
+        """
+        with self._mutex:
+            self._in_transaction = False
+            try:
+                self._db.execute("ROLLBACK")
+            except self._db.OperationalError:
+                # no transaction was open
+                pass
+            self._reload(directory, list(file_ids))
+
+    def close(self):
+        with self._mutex:
+            self._db.close()
@@ -0,0 +1,103 @@
+# reading and writing the multipart/mixed bodies of the batch endpoint
+# see https://developers.google.com/drive/v2/web/batch
+import re
+
+__author__ = 'charlie'
+
+BATCH_PATH = "/batch"
+
+_BOUNDARY_RE = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+_BLANK_LINE_RE = re.compile(r'\r?\n\r?\n')
+
+
+class BatchError(ValueError):
+    pass
+
+
+class BatchPart(object):
+    """
+    One call inside a batch, as parsed from its application/http part
+    """
+
+    def __init__(self, content_id, method, uri, body):
+        self.content_id = content_id
+        self.method = method
+        self.uri = uri
+        self.body = body
+
+
+def is_batch_path(path):
+    return path == BATCH_PATH or path.startswith(BATCH_PATH + '/')
+
+
+def _split_headers(text):
+    """
+    :return: (dict of lower case header name -> value, the rest of the text after the blank line)
+    """
+    match = _BLANK_LINE_RE.search(text)
+    if match:
+        head, rest = text[:match.start()], text[match.end():]
+    else:
+        head, rest = text, ''
+    headers = {}
+    for line in head.splitlines():
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return headers, rest
+
+
+def parse_batch(body, content_type):
+    """
+    :param body: the body of the batch request
+    :param content_type: its content-type header, which holds the boundary
+    :return: list of BatchPart in the order they were sent
+    :raises BatchError: if the body isn't a multipart/mixed batch
+    """
+    match = _BOUNDARY_RE.search(content_type or '')
+    if not content_type or not content_type.lower().startswith('multipart/mixed') or not match:
+        raise BatchError("Batch requests must be multipart/mixed with a boundary")
+    delimiter = '--' + match.group(1)
+    parts = []
+    # the preamble comes before the first delimiter and the epilogue after the closing one
+    for chunk in body.split(delimiter)[1:]:
+        if chunk.startswith('--'):
+            break
+        headers, payload = _split_headers(chunk.lstrip('\r\n'))
+        request_line, _, payload = payload.partition('\n')
+        request_line = request_line.split()
+        if len(request_line) < 2:
+            raise BatchError("Invalid request line in batch part: %s" % ' '.join(request_line))
+        part_headers, part_body = _split_headers(payload)
+        if 'content-length' in part_headers:
+            part_body = part_body[:int(part_headers['content-length'])]
+        else:
+            part_body = part_body.rstrip('\r\n')
+        content_id = headers.get('content-id', '').strip('<>')
+        parts.append(BatchPart(content_id, request_line[0], request_line[1], part_body or None))
+    if not parts:
+        raise BatchError("Batch request has no parts")
+    return parts
+
+
+def format_batch(responses):
+    """
+    :param responses: list of (content id, status, reason, content) in the order of the request's parts
+    :return: (content-type header, body) for the batch response
+    """
+    # uuid imports ctypes, which only batches should pay for
+    import uuid
+    boundary = "batch_%s" % uuid.uuid4().hex
+    lines = []
+    for content_id, status, reason, content in responses:
+        lines.append('--%s\r\n'
+                     'Content-Type: application/http\r\n'
+                     'Content-ID: <response-%s>\r\n'
+                     '\r\n'
+                     'HTTP/1.1 %d %s\r\n'
+                     'Content-Type: application/json; charset=UTF-8\r\n'
+                     'Content-Length: %d\r\n'
+                     '\r\n'
+                     '%s\r\n' % (boundary, content_id, status, reason, len(content), content))
+    lines.append('--%s--\r\n' % boundary)
+    return 'multipart/mixed; boundary=%s' % boundary, ''.join(lines)
@@ -0,0 +1,140 @@
+# routing of REST calls to service methods, compiled once from the discovery document
+# urlparse's unquote, not urllib's: importing urllib imports socket and ssl
+from urlparse import unquote
+
+__author__ = 'charlie'
+
+
+class Route(object):
+    """
+    Where a call goes: the schema's resource and method, and the names of the path's parameters
+    """
+
+    __slots__ = ('resource', 'action', 'params')
+
+    def __init__(self, resource, action, params):
+        self.resource = resource
+        self.action = action
+        self.params = params
+
+    def __repr__(self):
+        return "<Route %s.%s>" % (self.resource, self.action)
+
+
+class _Node(object):
+    """
+    One path segment deep in a trie: the literal segments that can come next, the node for a
+    parameter in the next segment, and the route of a path that ends here
+    """
+
+    __slots__ = ('literals', 'param', 'route')
+
+    def __init__(self):
+        self.literals = {}
+        self.param = None
+        self.route = None
+
+
+def _walk(node, segments, i, values):
+    """
+    :param values: the parameter values of the segments matched so far, added to as the walk goes on
+    :return: the Route, None if no path matches
+    """
+    if i == len(segments):
+        return node.route
+    segment = segments[i]
+    # a literal segment beats a parameter, e.g. "files/trash" isn't files.get of a file called trash
+    child = node.literals.get(segment)
+    if child is not None:
+        route = _walk(child, segments, i + 1, values)
+        if route is not None:
+            return route
+    if node.param is not None and segment:
+        values.append(segment)
+        route = _walk(node.param, segments, i + 1, values)
+        if route is not None:
+            return route
+        values.pop()
+    return None
+
+
+class Dispatcher(object):
+    """
+    A segment trie for each HTTP method, built from the methods in the discovery document.
+    Matching a path costs a dict lookup per segment instead of trying a regex per route.
+    """
+
+    def __init__(self, schema, path_prefix):
+        """
+        :param schema: the parsed discovery document
+        :param path_prefix: what comes before each method's path, e.g. "/drive/v2/"
+        """
+        self._prefix = path_prefix
+        self._roots = {}
+        for resource, resource_data in schema['resources'].iteritems():
+            for action, method in resource_data.get('methods', {}).iteritems():
+                self._add(method['httpMethod'], method['path'], resource, action)
+
+    def _add(self, http_method, path, resource, action):
+        node = self._roots.get(http_method)
+        if node is None:
+            node = self._roots[http_method] = _Node()
+        params = []
+        for segment in path.split('/'):
+            if segment.startswith('{') and segment.endswith('}'):
+                # methods may name the same parameter differently, e.g. {fileId} and {folderId}
+                params.append(segment[1:-1])
+                if node.param is None:
+                    node.param = _Node()
+                node = node.param
+            else:
+                child = node.literals.get(segment)
+                if child is None:
+                    child = node.literals[segment] = _Node()
+                node = child
+        node.route = Route(resource, action, tuple(params))
+
+    def match(self, http_method, path):
+        """
+        :param path: the path of the request, still quoted
+        :return: (Route, dict of path parameters), None if no method has the path
+        """
+        root = self._roots.get(http_method)
+        if root is None or not path.startswith(self._prefix):
+            return None
+        values = []
+        route = _walk(root, path[len(self._prefix):].split('/'), 0, values)
+        if route is None:
+            return None
+        params = {}
+        for name, value in zip(route.params, values):
+            if '%' in value:
+                value = unquote(value).decode('utf-8')
+            params[name] = value
+        return route, params
+
+
+def parse_query(query):
+    """
+    Like urlparse.parse_qs, blank values are left out, but a parameter given once is a string and
+    only a repeated one is a list
+    """
+    params = {}
+    if not query:
+        return params
+    for pair in query.split('&'):
+        name, _, value = pair.partition('=')
+        if not value:
+            continue
+        if '%' in name or '+' in name:
+            name = unquote(name.replace('+', ' '))
+        if '%' in value or '+' in value:
+            value = unquote(value.replace('+', ' '))
+        existing = params.get(name)
+        if existing is None:
+            params[name] = value
+        elif isinstance(existing, list):
+            existing.append(value)
+        else:
+            params[name] = [existing, value]
+    return params
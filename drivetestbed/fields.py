@@ -0,0 +1,203 @@
+# the "fields" parameter: partial responses holding only the fields a client asked for
+# see https://developers.google.com/drive/v2/web/performance#partial-response
+import re
+import threading
+from drivetestbed.records import Resource
+
+__author__ = 'charlie'
+
+_TOKEN_RE = re.compile(r'\s*(?:([A-Za-z_][A-Za-z0-9_]*|\*)|([/(),]))')
+
+_PROJECTION_CACHE_SIZE = 256
+_projection_cache = {}
+_projection_cache_lock = threading.Lock()
+
+
+class FieldsError(ValueError):
+    pass
+
+
+class Projection(object):
+    """
+    A compiled fields selection. Applied to a response it keeps the selected fields, going into
+    lists and nested objects as the selection says, e.g. "items(id,title),nextPageToken".
+    """
+
+    __slots__ = ('fields', 'key')
+
+    def __init__(self, fields):
+        """
+        :param fields: name -> Projection for the parts of it to keep, or None to keep all of it.
+            "*" stands for every field.
+        """
+        self.fields = fields
+        # the selection written out in a fixed order, used in the cache keys of projected resources
+        self.key = ','.join(name if sub is None else '%s(%s)' % (name, sub.key)
+                            for name, sub in sorted(fields.iteritems()))
+
+    def apply(self, value):
+        """
+        :return: the part of value the selection keeps. Resources become Resources cached under
+            their own key and the selection's, so their JSON is still only encoded once.
+        """
+        if isinstance(value, list):
+            return [self.apply(item) for item in value]
+        if not isinstance(value, dict):
+            # a selection inside something that isn't an object keeps all of it
+            return value
+        fields = self.fields
+        if '*' in fields:
+            result = dict(value)
+        else:
+            result = {}
+        for name, sub in fields.iteritems():
+            if name == '*' or name not in value:
+                continue
+            result[name] = value[name] if sub is None else sub.apply(value[name])
+        if isinstance(value, Resource) and value.cache_key is not None:
+            return Resource(result, (value.cache_key, self.key))
+        return result
+
+
+def projects(method):
+    """
+    Mark a service method that takes the request's compiled selection as fields= and only builds
+    what it selects, so that TestbedHttp passes it on instead of applying it to the response
+    """
+    method.projects = True
+    return method
+
+
+def project_list(projection, response, items, resource):
+    """
+    Build a list response with only the fields a selection keeps, building only the items it keeps
+    :param projection: a Projection, None to keep everything
+    :param response: the list's fields other than its items
+    :param items: the stored items of the page
+    :param resource: called with an item and the Projection for the items (None for all of them),
+        returns the item's resource
+    """
+    if projection is None:
+        response['items'] = [resource(item, None) for item in items]
+        return response
+    selected = projection.fields
+    keep_all = '*' in selected
+    result = {}
+    for name, value in response.iteritems():
+        if keep_all or name in selected:
+            sub = selected.get(name)
+            result[name] = value if sub is None else sub.apply(value)
+    if keep_all or 'items' in selected:
+        sub = selected.get('items')
+        result['items'] = [resource(item, sub) for item in items]
+    return result
+
+
+class _Parser(object):
+    """
+    Reads a selection: a comma separated list of fields, where a field is a name, a path of
+    names separated by "/", or either of those followed by a selection in brackets
+    """
+
+    def __init__(self, text):
+        self._text = text
+        self._tokens = self._tokenize(text)
+        self._pos = 0
+
+    def _tokenize(self, text):
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = _TOKEN_RE.match(text, pos)
+            if match is None:
+                raise FieldsError("Invalid field selection: %s" % self._text)
+            tokens.append(match.group(1) or match.group(2))
+            pos = match.end()
+        return tokens
+
+    def _peek(self):
+        return self._tokens[self._pos] if self._pos < len(self._tokens) else None
+
+    def _next(self):
+        token = self._peek()
+        self._pos += 1
+        return token
+
+    def _name(self):
+        token = self._next()
+        if token is None or token in '/(),':
+            raise FieldsError("Invalid field selection: %s" % self._text)
+        return token
+
+    def parse(self):
+        """
+        :return: name -> the same for the selection inside it, None for all of it
+        """
+        if self._peek() is None:
+            raise FieldsError("Empty field selection")
+        fields = self._selection()
+        if self._peek() is not None:
+            raise FieldsError("Invalid field selection: %s" % self._text)
+        return fields
+
+    def _selection(self):
+        fields = {}
+        while True:
+            name, sub = self._field()
+            _merge(fields, name, sub)
+            if self._peek() != ',':
+                return fields
+            self._next()
+
+    def _field(self):
+        """
+        :return: (name, dict for the selection inside it, None for all of it)
+        """
+        name = self._name()
+        token = self._peek()
+        if token == '/':
+            self._next()
+            sub_name, sub = self._field()
+            return name, {sub_name: sub}
+        if token == '(':
+            self._next()
+            sub = self._selection()
+            if self._next() != ')':
+                raise FieldsError("Invalid field selection: %s" % self._text)
+            return name, sub
+        return name, None
+
+
+def _merge(fields, name, sub):
+    """
+    Add a field to a selection that may already have it, e.g. "labels/starred,labels/hidden"
+    """
+    if name not in fields:
+        fields[name] = sub
+    elif fields[name] is None or sub is None:
+        # all of it
+        fields[name] = None
+    else:
+        for sub_name, sub_sub in sub.iteritems():
+            _merge(fields[name], sub_name, sub_sub)
+
+
+def _compile(fields):
+    return dict((name, None if sub is None else Projection(_compile(sub))) for name, sub in fields.iteritems())
+
+
+def compile_fields(text):
+    """
+    :param text: the fields parameter of a request
+    :return: a Projection, shared with other callers that used the same text
+    :raises FieldsError: if the selection can't be read
+    """
+    projection = _projection_cache.get(text)
+    if projection is None:
+        projection = Projection(_compile(_Parser(text).parse()))
+        with _projection_cache_lock:
+            if len(_projection_cache) >= _PROJECTION_CACHE_SIZE:
+                _projection_cache.clear()
+            _projection_cache[text] = projection
+    return projection
@@ -1,73 +1,306 @@
 # mock http service that intercepts calls to allow Drive to work locally
 import json
-import os
-from urlparse import urlparse, parse_qs
-from httplib2 import Response
-from drivetestbed.services import ServiceDirectory
-from routes import Mapper
+from timeit import default_timer
+from urlparse import urlparse
+from googleapiclient.errors import HttpError
+from drivetestbed import batch, dispatch, fields, media, schema, serialize
+from drivetestbed.services import ServiceDirectory, raise_400, raise_404, raise_rate_limited
+
+# content type of alt=media downloads
+MEDIA_CONTENT_TYPE = 'application/octet-stream'
+
+
+def _response(status, reason, **headers):
+    # httplib2 is only needed once there is something to answer
+    from httplib2 import Response
+    headers['status'] = status
+    headers['reason'] = reason
+    return Response(headers)
 
 
 class TestbedHttp(object):
 
     default_service = None
 
+    # (files, user_email, directory, snapshot) from the last setup_global_service
+    _global_fixture = None
+
+    # the traffic.Recorder every TestbedHttp logs its calls to, see start_recording
+    default_recorder = None
+
     @classmethod
     def setup_global_service(cls, files=None, user_email=None):
-        cls.default_service = ServiceDirectory(files=files, user_email=user_email)
+        """
+        Set up the directory every TestbedHttp uses. Calling this again with the same files list
+        (the same, unchanged list object) and user puts the directory built last time back the way
+        it started instead of loading the files again, which only costs as much as the changes
+        made since, and starts its changes feed, metrics and uploads again.
+        """
+        fixture = cls._global_fixture
+        if fixture and fixture[0] is files and fixture[1] == user_email and fixture[2]._snapshot is fixture[3]:
+            directory = fixture[2]
+            directory.restore(fixture[3])
+            # a test starting from the fixture mustn't see the changes earlier tests made
+            directory.reset_changes()
+            # nor the calls they made, their unfinished uploads or a throttle one of them set
+            directory.metrics().reset()
+            directory.uploads().clear()
+            directory.set_throttle(None)
+        else:
+            directory = ServiceDirectory(files=files, user_email=user_email)
+            cls._global_fixture = (files, user_email, directory, directory.snapshot())
+        cls.default_service = directory
 
     @classmethod
     def teardown_global_service(cls):
         cls.default_service = None
 
-    def __init__(self, files=None, user_email=None, **kwargs):
-        if TestbedHttp.default_service:
+    @classmethod
+    def warm_up(cls):
+        """
+        Read the discovery schema and compile the route map ahead of the first request.
+        Every TestbedHttp in the process shares the result.
+        """
+        schema.warm_up()
+
+    @classmethod
+    def start_recording(cls, path):
+        """
+        Log the calls made through every TestbedHttp to an append-only file, to replay later
+        with drivetestbed.traffic
+        :return: the traffic.Recorder
+        """
+        from drivetestbed import traffic
+        cls.stop_recording()
+        cls.default_recorder = traffic.Recorder(path)
+        return cls.default_recorder
+
+    @classmethod
+    def stop_recording(cls):
+        if cls.default_recorder is not None:
+            cls.default_recorder.close()
+            cls.default_recorder = None
+
+    def __init__(self, files=None, user_email=None, recorder=None, directory=None, **kwargs):
+        """
+        :param recorder: a traffic.Recorder to log this one's calls to, None for the default_recorder,
+            False to log nothing
+        :param directory: the ServiceDirectory to answer calls from, instead of the default_service
+            or a new one made from files and user_email
+        """
+        if directory is not None:
+            self._services = directory
+        elif TestbedHttp.default_service:
             self._services = self.default_service
         else:
             self._services = ServiceDirectory(files, user_email)
+        self._recorder = recorder
 
-    def request(self, uri, method="GET", body=None, **kwargs):
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        headers = dict((key.lower(), value) for key, value in (headers or {}).iteritems())
+        if hasattr(body, 'read'):
+            # chunks of resumable uploads come as a slice of the client's stream
+            body = body.read()
+        recorder = self._recorder
+        if recorder is None:
+            recorder = TestbedHttp.default_recorder
+        if recorder:
+            return recorder.call(self._services._user_email, self._request, uri, method, body, headers)
+        return self._request(uri, method, body, headers)
+
+    def _request(self, uri, method, body, headers):
         parsed_uri = urlparse(uri)
         if 'discovery' in parsed_uri.path:
-            # TODO -- use Routes for discovery service as well
-            resp = Response({'status': 200, 'reason': 'OK'})
-            dirname = os.path.dirname(os.path.realpath(__file__))
-            fp = file("%s/schema.json" % dirname, 'r')
-            try:
-                content = fp.read()
-            finally:
-              fp.close()
-            schema = json.loads(content)
-            path_dict = {}
-            map = Mapper()
-            with map.submapper(path_prefix="/drive/v2/") as m:
-                for r_name, r_data in schema['resources'].iteritems():
-                    for meth_name, meth_data in r_data['methods'].iteritems():
-                        m.connect(meth_data['path'], conditions={'method': [meth_data['httpMethod']]},
-                                    controller=r_name, action=meth_name)
-            self._map = map
-            return (resp, content)
+            return (_response(200, 'OK'), self._use_schema().content)
+        elif batch.is_batch_path(parsed_uri.path):
+            return self._batch(body, headers)
+        elif media.upload_path(parsed_uri.path) is not None:
+            return self._upload(uri, method, parsed_uri, body, headers)
         else:
-            environ = {'REQUEST_METHOD': method}
-            matched = self._map.match(parsed_uri.path, environ=environ)
-            if matched:
-                query_params = parse_qs(parsed_uri.query)
-                # unwrap single value params from list
-                for key in query_params.keys():
-                    if len(query_params[key]) == 1:
-                        query_params[key] = query_params[key][0]
-
-                if body:
-                    query_params['body'] = json.loads(body)
-                service = self._services.for_name(matched['controller'])
-                action_func = getattr(service, matched['action'])
-                if action_func:
-                    del matched['controller']
-                    del matched['action']
-                    query_params.update(matched)
-                    data = action_func(**query_params)
-                else:
-                    return (Response({'status': 404, 'reason': 'No such action: %s' % matched['action']}), "")
-                resp = Response({'status': 200, 'reason': 'OK'})
-                return (resp, json.dumps(data))
+            return self._dispatch(method, parsed_uri, body, headers)
+
+    def _use_schema(self):
+        """
+        Load the shared schema, if nothing has yet, ahead of routing requests with it
+        :return: the schema cache
+        """
+        cache = schema.get_cache()
+        cache.dispatcher
+        return cache
+
+    def _dispatch(self, method, parsed_uri, body, headers=None, params=None):
+        """
+        Call the service method the uri is routed to. HttpErrors raised by the services
+        are left for the caller.
+        :param params: more arguments for the method, e.g. the content of an upload
+        :return: (Response, content)
+        """
+        started = default_timer()
+        found = schema.get_cache().dispatcher.match(method, parsed_uri.path)
+        if found is None:
+            return _response(404, 'Bad request'), ""
+        route, path_params = found
+        resource, action = route.resource, route.action
+        query_params = dispatch.parse_query(parsed_uri.query)
+        if body:
+            query_params['body'] = json.loads(body)
+        if params:
+            query_params.update(params)
+        query_params.update(path_params)
+        # says whose quota the call counts against, it isn't for the service
+        quota_user = query_params.pop('quotaUser', None)
+        selection = query_params.pop('fields', None)
+        request_bytes = len(body or '')
+        if params and params.get('media_body') is not None:
+            request_bytes += params['media_body'].size
+        metrics = self._services.metrics()
+        throttle = self._services.throttle()
+        try:
+            # a call the testbed has no method for is still counted, as a 404
+            action_func = self._services.handler(resource, action)
+            if action_func is None:
+                raise_404(action, msg="No such action: %s.%s" % (resource, action))
+            if throttle is not None:
+                refusal = throttle.admit(resource + '.' + action, quota_user or self._services._user_email)
+                if refusal is not None:
+                    raise_rate_limited(*refusal)
+            projection = None
+            if selection:
+                try:
+                    projection = fields.compile_fields(selection)
+                except fields.FieldsError as e:
+                    raise_400(str(e))
+                if getattr(action_func, 'projects', False):
+                    # the service only builds what's selected
+                    query_params['fields'] = projection
+                    projection = None
+            data = action_func(**query_params)
+            if isinstance(data, media.Blob):
+                resp, content = self._download(data, headers or {})
             else:
-                return (Response({'status': 404, 'reason': 'Bad request'}), "")
+                if projection is not None:
+                    data = projection.apply(data)
+                resp, content = _response(200, 'OK'), serialize.dumps(data, self._services.response_cache())
+        except HttpError as e:
+            metrics.record(resource, action, default_timer() - started, request_bytes, len(e.content or ''),
+                           e.resp.status)
+            raise
+        metrics.record(resource, action, default_timer() - started, request_bytes, len(content), resp.status)
+        return resp, content
+
+    def _download(self, blob, headers):
+        """
+        Answer an alt=media request with the content, or the part of it the Range header asks for.
+        The content is a buffer over the stored bytes, not a copy.
+        """
+        try:
+            span = media.parse_range(headers.get('range'), blob.size)
+        except media.MediaError:
+            return _response(416, 'Requested Range Not Satisfiable', **{'content-range': "bytes */%d" % blob.size}), ""
+        if span is None:
+            return _response(200, 'OK', **{'content-type': MEDIA_CONTENT_TYPE,
+                                          'content-length': str(blob.size)}), blob.view()
+        first, end = span
+        return _response(206, 'Partial Content', **{'content-type': MEDIA_CONTENT_TYPE,
+                                                   'content-length': str(end - first),
+                                                   'content-range': "bytes %d-%d/%d" % (first, end - 1, blob.size)}
+                         ), blob.view(first, end)
+
+    def _upload(self, uri, method, parsed_uri, body, headers):
+        """
+        Handle a call made on an upload path: uploadType=media sends just the content,
+        multipart the metadata and the content together, resumable starts a session
+        that the content is then sent to in chunks.
+        """
+        params = dispatch.parse_query(parsed_uri.query)
+        upload_type = params.get('uploadType')
+        # the call the upload is for
+        target = parsed_uri._replace(path=media.upload_path(parsed_uri.path))
+        try:
+            if upload_type == 'media':
+                return self._dispatch(method, target, None, headers, {
+                    'media_body': media.Blob.from_string(body or ''),
+                    'media_mime_type': headers.get('content-type')})
+            elif upload_type == 'multipart':
+                metadata, content, content_type = media.parse_multipart(body or '', headers.get('content-type'))
+                return self._dispatch(method, target, metadata, headers, {
+                    'media_body': media.Blob.from_string(content),
+                    'media_mime_type': content_type})
+            elif upload_type == 'resumable':
+                upload_id = params.get('upload_id')
+                if upload_id is None:
+                    return self._start_upload(uri, method, target, body, headers)
+                return self._upload_chunk(upload_id, body, headers)
+        except media.MediaError as e:
+            raise_400(str(e))
+        raise_400("Invalid uploadType: %s" % upload_type)
+
+    def _start_upload(self, uri, method, target, body, headers):
+        if schema.get_cache().dispatcher.match(method, target.path) is None:
+            return _response(404, 'Bad request'), ""
+        total = headers.get('x-upload-content-length')
+        upload = self._services.uploads().start(media.ResumableUpload(
+            method, target, body, content_type=headers.get('x-upload-content-type'),
+            total=int(total) if total else None))
+        location = "%s%supload_id=%s" % (uri, '&' if '?' in uri else '?', upload.id)
+        return _response(200, 'OK', location=location), ""
+
+    def _upload_chunk(self, upload_id, body, headers):
+        """
+        Add a chunk to a resumable upload. Until the content is complete the answer is a 308
+        whose Range header says how much has arrived; the chunk that completes it makes the call.
+        """
+        uploads = self._services.uploads()
+        upload = uploads.get(upload_id)
+        if upload is None:
+            raise_404(upload_id, msg="Upload not found: %s" % upload_id)
+        body = body or ''
+        if 'content-range' in headers:
+            first, last, total = media.parse_content_range(headers['content-range'])
+        elif body:
+            # all of the content at once
+            first, last, total = 0, len(body) - 1, len(body)
+        else:
+            first, last, total = None, None, None
+        with upload.lock:
+            if total is not None:
+                upload.total = total
+            if first is not None:
+                if len(body) != last - first + 1:
+                    raise media.MediaError("Content-Range says %d bytes, the chunk has %d" %
+                                           (last - first + 1, len(body)))
+                upload.write(first, body)
+            if upload.total is None or upload.received < upload.total:
+                resume = _response(308, 'Resume Incomplete')
+                if upload.range_header():
+                    resume['range'] = upload.range_header()
+                return resume, ""
+            if upload.received > upload.total:
+                raise media.MediaError("Received %d bytes of a %d byte upload" % (upload.received, upload.total))
+            if uploads.finish(upload_id) is None:
+                # another thread finished it
+                raise_404(upload_id, msg="Upload not found: %s" % upload_id)
+            blob = upload.writer.finish()
+        return self._dispatch(upload.method, upload.target, upload.metadata, headers, {
+            'media_body': blob,
+            'media_mime_type': upload.content_type})
+
+    def _batch(self, body, headers):
+        """
+        Run every call in a multipart/mixed batch, in order, and answer with one part per call.
+        A call that fails gets its own error status, the rest of the batch still runs.
+        """
+        try:
+            parts = batch.parse_batch(body or '', headers.get('content-type'))
+        except batch.BatchError as e:
+            return (_response(400, 'Bad Request'), str(e))
+        responses = []
+        for part in parts:
+            try:
+                resp, content = self._dispatch(part.method, urlparse(part.uri), part.body)
+                status, reason = resp.status, resp.reason
+            except HttpError as e:
+                status, reason, content = e.resp.status, e.resp.reason, e.content
+            responses.append((part.content_id, status, reason, content))
+        content_type, content = batch.format_batch(responses)
+        return (_response(200, 'OK', **{'content-type': content_type}), content)
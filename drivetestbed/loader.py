@@ -0,0 +1,221 @@
+# streaming loader for large fixture files
+import gc
+import json
+import logging
+import mmap
+import time
+from contextlib import contextmanager
+
+__author__ = 'charlie'
+
+DEFAULT_BATCH_SIZE = 1000
+
+# bytes read at a time when parsing a JSON array
+READ_SIZE = 1 << 16
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def gc_paused():
+    """
+    Pause the garbage collector while loading or building an index: that only makes objects,
+    so its passes over them would find nothing to collect
+    """
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+class LoadStats(object):
+    """
+    What a load did and how fast it went
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def files_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.files / self.seconds
+
+    @property
+    def megabytes_per_second(self):
+        if not self.seconds:
+            return 0.0
+        return self.bytes / self.seconds / (1 << 20)
+
+    def __repr__(self):
+        return "<LoadStats %d files, %d bytes in %.3fs: %.0f files/s, %.1f MB/s>" % (
+            self.files, self.bytes, self.seconds, self.files_per_second, self.megabytes_per_second)
+
+
+class _CountingReader(object):
+    """
+    Wraps a file or mmap and counts the bytes read from it
+    """
+
+    def __init__(self, fp):
+        self._fp = fp
+        self.bytes = 0
+
+    def read(self, size):
+        data = self._fp.read(size)
+        self.bytes += len(data)
+        return data
+
+    def readline(self):
+        line = self._fp.readline()
+        self.bytes += len(line)
+        return line
+
+
+def iter_ndjson(fp):
+    """
+    :param fp: anything with readline(), holding one JSON object per line
+    """
+    while True:
+        line = fp.readline()
+        if not line:
+            return
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_json_array(fp, read_size=READ_SIZE):
+    """
+    Parse a JSON array of objects a piece at a time, so that only the object being
+    decoded and one read buffer are in memory.
+    :param fp: anything with read(size)
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        # skip whitespace and separators, reading more when the buffer runs out
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf) or eof:
+                break
+            buf = fp.read(read_size)
+            pos = 0
+            eof = not buf
+        if pos >= len(buf):
+            raise ValueError("Unexpected end of JSON array")
+        if not started:
+            if buf[pos] != '[':
+                raise ValueError("Expected a JSON array")
+            started = True
+            pos += 1
+            continue
+        if buf[pos] == ']':
+            return
+        if buf[pos] != '{':
+            raise ValueError("Expected an object in the JSON array, got %r" % buf[pos])
+        while True:
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+                break
+            except ValueError:
+                if eof:
+                    raise
+                # the object runs past the buffer, read more and try again
+                more = fp.read(max(read_size, len(buf) - pos))
+                eof = not more
+                buf = buf[pos:] + more
+                pos = 0
+        yield record
+        pos = end
+
+
+def _detect_format(fp):
+    """
+    :return: 'json' if the file holds a JSON array, else 'ndjson'
+    """
+    start = fp.tell()
+    while True:
+        char = fp.read(1)
+        if not char or not char.isspace():
+            break
+    fp.seek(start)
+    return 'json' if char == '[' else 'ndjson'
+
+
+def iter_records(fp, format=None):
+    """
+    :param format: 'ndjson', 'json' or None to work it out from the first character
+    """
+    if format is None:
+        format = _detect_format(fp)
+    if format == 'json':
+        return iter_json_array(fp)
+    if format == 'ndjson':
+        return iter_ndjson(fp)
+    raise ValueError("Unknown fixture format: %s" % format)
+
+
+def load_records(directory, records, batch_size=DEFAULT_BATCH_SIZE, stats=None):
+    """
+    Add records to a ServiceDirectory a batch at a time.
+    The garbage collector is paused while loading: the store only grows, so its passes
+    over the new objects would find nothing to collect.
+    :param records: iterable of Drive file resources
+    :return: LoadStats
+    """
+    stats = stats or LoadStats()
+    started = time.time()
+    with gc_paused():
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                stats.files += directory._add_batch(batch)
+                batch = []
+        if batch:
+            stats.files += directory._add_batch(batch)
+    stats.seconds += time.time() - started
+    return stats
+
+
+def load(directory, source, format=None, use_mmap=False, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Stream a fixture file into a ServiceDirectory in one pass. Each record is a Drive file
+    resource, optionally with "permissions" and "parents" lists.
+    :param source: path or open file, holding NDJSON or a JSON array
+    :param format: 'ndjson', 'json' or None to detect it
+    :param use_mmap: map the file into memory instead of reading it through a buffer
+    :return: LoadStats
+    """
+    fp = open(source, 'rb') if isinstance(source, basestring) else source
+    mapped = None
+    try:
+        reader = fp
+        if use_mmap:
+            fp.seek(0, 2)
+            if fp.tell():
+                mapped = reader = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            fp.seek(0)
+        if format is None:
+            format = _detect_format(reader)
+        counting = _CountingReader(reader)
+        stats = load_records(directory, iter_records(counting, format), batch_size=batch_size)
+        stats.bytes = counting.bytes
+    finally:
+        if mapped is not None:
+            mapped.close()
+        if fp is not source:
+            fp.close()
+    logger.info("Loaded fixture %s: %r", getattr(fp, 'name', source), stats)
+    return stats
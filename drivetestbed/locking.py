@@ -0,0 +1,127 @@
+# locks that let many threads share one ServiceDirectory
+import functools
+import threading
+from contextlib import contextmanager
+
+__author__ = 'charlie'
+
+
+class ReadWriteLock(object):
+    """
+    Any number of readers or one writer.
+
+    Writers are preferred: once a writer is waiting, new readers wait behind it, so a steady
+    stream of reads can't starve it. Both sides are reentrant within a thread, and the thread
+    holding the write lock may also read. A reader can't upgrade to writing, that raises
+    RuntimeError rather than deadlocking.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+        self._local = threading.local()
+
+    def _read_depth(self):
+        return getattr(self._local, 'depth', 0)
+
+    def held(self):
+        """
+        :return: True if the current thread holds the lock, for reading or writing
+        """
+        return self._writer is threading.current_thread() or bool(self._read_depth())
+
+    def acquire_read(self):
+        me = threading.current_thread()
+        depth = self._read_depth()
+        if self._writer is me or depth:
+            # already inside, waiting for a queued writer here would deadlock
+            self._local.depth = depth + 1
+            return
+        with self._cond:
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        self._local.depth = 1
+
+    def release_read(self):
+        depth = self._read_depth() - 1
+        self._local.depth = depth
+        if depth or self._writer is threading.current_thread():
+            return
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread()
+        if self._writer is me:
+            self._writer_depth += 1
+            return
+        if self._read_depth():
+            raise RuntimeError("Can't write while holding the read lock")
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        self._writer_depth -= 1
+        if self._writer_depth:
+            return
+        with self._cond:
+            self._writer = None
+            self._cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+def reads(method):
+    """
+    Run a service method under its directory's read lock
+    """
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        directory = self._directory
+        if directory is None:
+            return method(self, *args, **kwargs)
+        with directory._reading():
+            return method(self, *args, **kwargs)
+    return locked
+
+
+def writes(method):
+    """
+    Run a service method under its directory's write lock, so everything it changes in
+    every service is seen all at once or not at all
+    """
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        directory = self._directory
+        if directory is None:
+            return method(self, *args, **kwargs)
+        with directory._writing():
+            return method(self, *args, **kwargs)
+    return locked
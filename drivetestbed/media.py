@@ -0,0 +1,283 @@
+# file content: how it is stored, uploaded (uploadType=media, multipart and resumable) and served
+# see https://developers.google.com/drive/v2/web/manage-uploads
+import hashlib
+import mmap
+import re
+import threading
+
+__author__ = 'charlie'
+
+# paths the client sends uploads to, in front of the usual /drive/v2/... path
+UPLOAD_PREFIXES = ("/upload", "/resumable/upload")
+
+# content bigger than this is spooled to a temporary file and memory mapped, smaller content stays in memory
+SPOOL_SIZE = 4 * 1024 * 1024
+
+_BOUNDARY_RE = re.compile(r'boundary="?([^";]+)"?', re.IGNORECASE)
+_BLANK_LINE_RE = re.compile(r'\r?\n\r?\n')
+_CONTENT_RANGE_RE = re.compile(r'bytes\s+(?:(\d+)-(\d+)|\*)/(\d+|\*)$')
+_RANGE_RE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class MediaError(ValueError):
+    pass
+
+
+class Blob(object):
+    """
+    The content of a file. Never changed once made, so files, copies of them and snapshots can
+    share one. Parts of it are handed out as read only buffers over the stored bytes rather than
+    copies: Python 2 can't make a memoryview of an mmap, but buffer() works for both.
+    """
+
+    __slots__ = ('size', 'md5', '_data', '_file')
+
+    def __init__(self, data, md5, temp_file=None):
+        """
+        :param data: a str, bytearray or mmap holding the content
+        :param temp_file: the file an mmap maps, kept open for as long as the mmap is used
+        """
+        self._data = data
+        self.size = len(data)
+        self.md5 = md5
+        self._file = temp_file
+
+    @classmethod
+    def from_string(cls, data):
+        writer = BlobWriter()
+        writer.write(data)
+        return writer.finish()
+
+    def view(self, start=0, end=None):
+        """
+        :param end: one past the last byte, the end of the content if None
+        :return: a buffer over the bytes, nothing is copied
+        """
+        if end is None or end > self.size:
+            end = self.size
+        return buffer(self._data, start, max(end - start, 0))
+
+    def __len__(self):
+        return self.size
+
+
+class BlobWriter(object):
+    """
+    Collects content as it arrives and makes a Blob of it. Content is kept in memory until it
+    passes spool_size, then moved to a temporary file, which finish() maps into memory.
+    """
+
+    def __init__(self, spool_size=None):
+        self._spool_size = SPOOL_SIZE if spool_size is None else spool_size
+        # a str until a second write, so content sent in one piece isn't copied
+        self._memory = ''
+        self._file = None
+        self._md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        if not data:
+            return
+        self._md5.update(data)
+        self.size += len(data)
+        if self._file is None and self.size > self._spool_size:
+            import tempfile
+            self._file = tempfile.TemporaryFile(prefix='drivetestbed-')
+            self._file.write(self._memory)
+            self._memory = None
+        if self._file is not None:
+            self._file.write(data)
+        elif not self._memory:
+            self._memory = data if isinstance(data, str) else str(data)
+        else:
+            if isinstance(self._memory, str):
+                self._memory = bytearray(self._memory)
+            self._memory += data
+
+    def finish(self):
+        """
+        :return: a Blob of everything written. The writer can't be used after this.
+        """
+        md5 = self._md5.hexdigest()
+        if self._file is None:
+            return Blob(self._memory, md5)
+        self._file.flush()
+        data = mmap.mmap(self._file.fileno(), self.size, access=mmap.ACCESS_READ)
+        return Blob(data, md5, self._file)
+
+
+EMPTY = Blob('', hashlib.md5().hexdigest())
+
+
+def upload_path(path):
+    """
+    :return: the path of the method an upload is for, None if the path isn't an upload path
+    """
+    for prefix in UPLOAD_PREFIXES:
+        if path.startswith(prefix + '/'):
+            return path[len(prefix):]
+    return None
+
+
+def _split_headers(text):
+    match = _BLANK_LINE_RE.search(text)
+    if match is None:
+        return {}, text
+    headers = {}
+    for line in text[:match.start()].splitlines():
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    return headers, text[match.end():]
+
+
+def parse_multipart(body, content_type):
+    """
+    Split a multipart/related upload into its metadata and its content
+    :return: (the JSON metadata part, the content part, the content's content type)
+    :raises MediaError: if the body isn't multipart/related with two parts
+    """
+    match = _BOUNDARY_RE.search(content_type or '')
+    if not content_type or not content_type.lower().startswith('multipart/related') or not match:
+        raise MediaError("Multipart uploads must be multipart/related with a boundary")
+    delimiter = '--' + match.group(1)
+    parts = []
+    for chunk in body.split(delimiter)[1:]:
+        if chunk.startswith('--'):
+            break
+        # the line break after the delimiter and the one before the next belong to the delimiters
+        if chunk.startswith('\r\n'):
+            chunk = chunk[2:]
+        elif chunk.startswith('\n'):
+            chunk = chunk[1:]
+        if chunk.endswith('\r\n'):
+            chunk = chunk[:-2]
+        elif chunk.endswith('\n'):
+            chunk = chunk[:-1]
+        parts.append(_split_headers(chunk))
+    if len(parts) != 2:
+        raise MediaError("Multipart uploads must have a metadata part and a media part")
+    (meta_headers, metadata), (media_headers, content) = parts
+    return metadata, content, media_headers.get('content-type')
+
+
+def parse_content_range(value):
+    """
+    Read the Content-Range of a chunk of a resumable upload
+    :return: (first byte, last byte, total size); the bytes are None for a status query ("bytes */total")
+        and the total is None while the client doesn't know it yet ("bytes 0-99/*")
+    :raises MediaError: if it can't be read
+    """
+    match = _CONTENT_RANGE_RE.match((value or '').strip())
+    if match is None:
+        raise MediaError("Invalid Content-Range: %s" % value)
+    first, last, total = match.groups()
+    total = None if total == '*' else int(total)
+    if first is None:
+        return None, None, total
+    first, last = int(first), int(last)
+    if last < first or (total is not None and last >= total):
+        raise MediaError("Invalid Content-Range: %s" % value)
+    return first, last, total
+
+
+def parse_range(value, size):
+    """
+    Read the Range header of a download
+    :return: (first byte, one past the last byte) to send, None to send everything
+        (no Range, a form we don't handle like several ranges, or empty content)
+    :raises MediaError: if the range starts past the end of the content
+    """
+    match = _RANGE_RE.match((value or '').strip())
+    if match is None or not size:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # the last n bytes
+        return max(size - int(last), 0), size
+    first = int(first)
+    if first >= size:
+        raise MediaError("Requested range not satisfiable: %s" % value)
+    end = min(int(last) + 1, size) if last else size
+    if end <= first:
+        return None
+    return first, end
+
+
+class ResumableUpload(object):
+    """
+    An upload session: the call it will make when the content is complete, and the content so far
+    """
+
+    def __init__(self, method, target, metadata, content_type=None, total=None):
+        """
+        :param target: the parsed uri of the call, without the upload prefix
+        :param metadata: the JSON body of the call, None if it had none
+        :param total: size of the content, if the client said
+        """
+        import uuid
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.target = target
+        self.metadata = metadata
+        self.content_type = content_type
+        self.total = total
+        self.writer = BlobWriter()
+        # chunks of one upload are written one at a time
+        self.lock = threading.Lock()
+
+    @property
+    def received(self):
+        return self.writer.size
+
+    def write(self, first, data):
+        """
+        Add a chunk. The client may resend bytes it isn't sure arrived, they are skipped.
+        :param first: offset of the chunk's first byte
+        :raises MediaError: if the chunk would leave a gap
+        """
+        received = self.writer.size
+        if first > received:
+            raise MediaError("Chunk starts at %d, only %d bytes have been received" % (first, received))
+        if first + len(data) > received:
+            self.writer.write(data[received - first:] if first < received else data)
+
+    def range_header(self):
+        """
+        :return: the Range header telling the client what has arrived, None if nothing has
+        """
+        if not self.received:
+            return None
+        return "bytes=0-%d" % (self.received - 1)
+
+
+class Uploads(object):
+    """
+    The resumable uploads in progress for a ServiceDirectory, by upload id
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def start(self, upload):
+        with self._lock:
+            self._sessions[upload.id] = upload
+        return upload
+
+    def get(self, upload_id):
+        with self._lock:
+            return self._sessions.get(upload_id)
+
+    def finish(self, upload_id):
+        with self._lock:
+            return self._sessions.pop(upload_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+
+    def __len__(self):
+        return len(self._sessions)
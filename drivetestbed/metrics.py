@@ -0,0 +1,163 @@
+# counts and timings of the Drive calls a ServiceDirectory answers
+import bisect
+import threading
+
+__author__ = 'charlie'
+
+# upper bounds, in seconds, of the latency histogram's buckets. A last bucket takes everything slower.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class EndpointStats(object):
+    """
+    What has been recorded for one (resource, action), e.g. ("files", "list")
+    """
+
+    __slots__ = ('calls', 'errors', 'seconds', 'max_seconds', 'histogram', 'request_bytes', 'response_bytes')
+
+    def __init__(self):
+        self.calls = 0
+        # status -> number of calls that failed with it
+        self.errors = {}
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.request_bytes = 0
+        self.response_bytes = 0
+
+    def copy(self):
+        stats = EndpointStats()
+        stats.calls = self.calls
+        stats.errors = dict(self.errors)
+        stats.seconds = self.seconds
+        stats.max_seconds = self.max_seconds
+        stats.histogram = list(self.histogram)
+        stats.request_bytes = self.request_bytes
+        stats.response_bytes = self.response_bytes
+        return stats
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': dict(self.errors),
+            'seconds': self.seconds,
+            'mean_seconds': self.seconds / self.calls if self.calls else 0.0,
+            'max_seconds': self.max_seconds,
+            'histogram': [[bound, count] for bound, count in zip(LATENCY_BUCKETS + (None,), self.histogram)],
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+        }
+
+
+class MetricsSnapshot(object):
+    """
+    The metrics as they were when Metrics.snapshot() was called, by "resource.action"
+    """
+
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+
+    def __getitem__(self, name):
+        """
+        :return: the EndpointStats for a "resource.action", empty if it hasn't been called
+        """
+        return self.endpoints.get(name) or EndpointStats()
+
+    def calls(self, name=None):
+        """
+        :return: number of calls to a "resource.action", or to everything if name is None
+        """
+        if name is not None:
+            return self[name].calls
+        return sum(stats.calls for stats in self.endpoints.itervalues())
+
+    def errors(self, name=None, status=None):
+        """
+        :param status: only count failures with this status, e.g. 404
+        :return: number of failed calls to a "resource.action", or to everything if name is None
+        """
+        endpoints = [self[name]] if name is not None else self.endpoints.values()
+        if status is None:
+            return sum(sum(stats.errors.itervalues()) for stats in endpoints)
+        return sum(stats.errors.get(status, 0) for stats in endpoints)
+
+    def since(self, earlier):
+        """
+        :return: a MetricsSnapshot of what was recorded after the earlier snapshot was taken
+        """
+        endpoints = {}
+        for name, stats in self.endpoints.iteritems():
+            before = earlier.endpoints.get(name)
+            if before is None:
+                endpoints[name] = stats
+                continue
+            if stats.calls == before.calls:
+                continue
+            diff = stats.copy()
+            diff.calls -= before.calls
+            for status, count in before.errors.iteritems():
+                diff.errors[status] -= count
+                if not diff.errors[status]:
+                    del diff.errors[status]
+            diff.seconds -= before.seconds
+            diff.histogram = [count - earlier_count for count, earlier_count in zip(stats.histogram, before.histogram)]
+            diff.request_bytes -= before.request_bytes
+            diff.response_bytes -= before.response_bytes
+            # the slowest call in between isn't known, only the slowest overall
+            endpoints[name] = diff
+        return MetricsSnapshot(endpoints)
+
+    def to_dict(self):
+        return dict((name, stats.to_dict()) for name, stats in self.endpoints.iteritems())
+
+    def __repr__(self):
+        return "<MetricsSnapshot %d calls, %d errors>" % (self.calls(), self.errors())
+
+
+class Metrics(object):
+    """
+    Per (resource, action) call counts, latency histograms, request and response sizes and
+    error counts for the calls made through TestbedHttp (and so the server and batches too).
+    Recording a call costs a lock and a few additions.
+
+    Calls the services make to each other, e.g. copy's insert, and calls made on the services
+    directly are not counted: these are the Drive calls a client made.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, resource, action, seconds, request_bytes=0, response_bytes=0, status=200):
+        """
+        :param status: the call's HTTP status; 400 and up count as errors
+        """
+        if not self.enabled:
+            return
+        name = resource + '.' + action
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            stats = self._endpoints.get(name)
+            if stats is None:
+                stats = self._endpoints[name] = EndpointStats()
+            stats.calls += 1
+            stats.seconds += seconds
+            if seconds > stats.max_seconds:
+                stats.max_seconds = seconds
+            stats.histogram[bucket] += 1
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+            if status >= 400:
+                stats.errors[status] = stats.errors.get(status, 0) + 1
+
+    def snapshot(self):
+        """
+        :return: a MetricsSnapshot of everything recorded so far, unaffected by later calls
+        """
+        with self._lock:
+            return MetricsSnapshot(dict((name, stats.copy()) for name, stats in self._endpoints.iteritems()))
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
@@ -0,0 +1,510 @@
+# parser and planner for the files.list "q" parameter
+# see https://developers.google.com/drive/v2/web/search-parameters
+import re
+import threading
+from datetime import datetime, timedelta
+from drivetestbed.search import to_text, title_terms, words
+
+__author__ = 'charlie'
+
+DATE_OPS = ('<', '<=', '=', '!=', '>', '>=')
+EQUALITY_OPS = ('=', '!=')
+
+# field -> operators the Drive API accepts for it
+FIELD_OPS = {
+    'title': ('contains', '=', '!='),
+    'fullText': ('contains',),
+    'mimeType': ('contains', '=', '!='),
+    'createdDate': DATE_OPS,
+    'modifiedDate': DATE_OPS,
+    'lastViewedByMeDate': DATE_OPS,
+    'trashed': EQUALITY_OPS,
+    'starred': EQUALITY_OPS,
+    'hidden': EQUALITY_OPS,
+    'sharedWithMe': EQUALITY_OPS,
+}
+
+BOOLEAN_FIELDS = ('trashed', 'starred', 'hidden', 'sharedWithMe')
+DATE_FIELDS = ('createdDate', 'modifiedDate', 'lastViewedByMeDate')
+
+# fields that can appear on the right hand side of "in"
+COLLECTION_FIELDS = ('parents', 'owners', 'writers', 'readers')
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:[^'\\]|\\.)*')
+      | (?P<op><=|>=|!=|=|<|>)
+      | (?P<punct>[(){}])
+      | (?P<word>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<number>-?\d+(?:\.\d+)?)
+    )""", re.VERBOSE)
+
+_DATE_RE = re.compile(r"""^(\d{4})-(\d{2})-(\d{2})
+    (?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.(\d{1,6})\d*)?)?)?
+    (Z|[+-]\d{2}:?\d{2})?$""", re.VERBOSE)
+
+_EPOCH = datetime(1970, 1, 1)
+
+class QueryError(ValueError):
+    pass
+
+
+def parse_date(value):
+    """
+    Parse an RFC 3339 date as used by Drive into a naive UTC datetime
+    :param value: e.g. "2012-06-04T12:00:00.000Z" or "2012-06-04T12:00:00-08:00"
+    :return: datetime, or None if the value isn't a date
+    """
+    match = _DATE_RE.match(value.strip()) if value else None
+    if not match:
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    micro = int((fraction or '0').ljust(6, '0'))
+    try:
+        result = datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0), micro)
+    except ValueError:
+        # e.g. the 13th month
+        return None
+    if zone and zone != 'Z':
+        sign = -1 if zone[0] == '-' else 1
+        zone = zone[1:].replace(':', '')
+        result -= sign * timedelta(hours=int(zone[:2]), minutes=int(zone[2:]))
+    return result
+
+
+def date_key(date):
+    """
+    :param date: a naive UTC datetime, e.g. from parse_date
+    :return: the date as format_date writes it, to the millisecond. These strings sort like the dates.
+    """
+    return _format(date)
+
+
+def parse_date_key(value):
+    """
+    :return: the date_key of an RFC 3339 date, None if the value isn't a date
+    """
+    # the dates the testbed writes are their own keys, nothing is parsed or made
+    if value and _is_formatted(value):
+        return value
+    date = parse_date(value)
+    return _format(date) if date is not None else None
+
+
+def format_date(seconds):
+    """
+    :param seconds: time since 1970, e.g. from time.time()
+    :return: the date as Drive gives it, e.g. "2012-06-04T12:00:00.000Z"
+    """
+    return _format(_EPOCH + timedelta(seconds=seconds))
+
+
+def _format(date):
+    return "%04d-%02d-%02dT%02d:%02d:%02d.%03dZ" % (date.year, date.month, date.day, date.hour, date.minute,
+                                                   date.second, date.microsecond // 1000)
+
+
+def _is_formatted(value):
+    """
+    :return: whether the date is written the way format_date writes it, so that comparing the
+        strings compares the dates
+    """
+    return (len(value) == 24 and value[-1] == 'Z' and value[19] == '.' and value[10] == 'T' and value[4] == '-' and
+            value[13] == ':')
+
+
+def tokenize(q):
+    tokens = []
+    pos = 0
+    q = q.rstrip()
+    while pos < len(q):
+        match = _TOKEN_RE.match(q, pos)
+        if not match or match.end() == pos:
+            raise QueryError("Invalid query at position %d: %s" % (pos, q))
+        pos = match.end()
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'string':
+            text = re.sub(r"\\(.)", r"\1", text[1:-1])
+        tokens.append((kind, text))
+    return tokens
+
+
+def _prefix_match(text, term):
+    """
+    Drive only matches "title contains" against the start of words in the title
+    """
+    if not text:
+        return False
+    text = to_text(text).lower()
+    term = to_text(term).lower()
+    start = text.find(term)
+    while start != -1:
+        if start == 0 or not text[start - 1].isalnum():
+            return True
+        start = text.find(term, start + 1)
+    return False
+
+
+class Node(object):
+    """
+    A compiled piece of a query. lookup() narrows the search using the indexes kept by
+    the services and returns a collection of file ids (anything with len, in and iteration),
+    or None if every file has to be looked at.
+    match() is always applied to the candidates, so lookup() may over-approximate.
+    """
+
+    def lookup(self, files):
+        return None
+
+    def match(self, afile, files):
+        raise NotImplementedError()
+
+
+class Comparison(Node):
+
+    def __init__(self, field, op, value):
+        self.field = field
+        self.op = op
+        self.value = value
+        if field in DATE_FIELDS:
+            self._date = parse_date(value)
+            if self._date is None:
+                raise QueryError("Invalid date for %s: %s" % (field, value))
+            # the date as Drive writes them, to compare with theirs without parsing each one. Only
+            # when that loses nothing: the keys stop at milliseconds.
+            self._formatted = _format(self._date) if self._date.microsecond % 1000 == 0 else None
+
+    def _range(self):
+        """
+        :return: (low, high, include_low, include_high) of the date keys a date comparison
+            matches, None if it isn't one range
+        """
+        if self.field not in DATE_FIELDS or self.op == '!=':
+            return None
+        key = date_key(self._date)
+        # a key cut short at the millisecond is shared by dates either side of this one, so the
+        # range takes them all in and match() sorts them out
+        exact = self._formatted is not None
+        if self.op == '=':
+            return key, key, True, True
+        if self.op in ('<', '<='):
+            return None, key, True, self.op == '<=' or not exact
+        return key, None, self.op == '>=' or not exact, True
+
+    def lookup(self, files):
+        if self.op == 'contains':
+            if self.field == 'fullText':
+                query_words = words(self.value)
+                return files._text_index().with_words(query_words) if query_words else None
+            if self.field == 'title':
+                prefixes = title_terms(self.value)
+                return files._text_index().with_title_prefixes(prefixes) if prefixes else None
+            return None
+        if self.field in DATE_FIELDS:
+            bounds = self._range()
+            return files._ids_in_date_range(self.field, *bounds) if bounds is not None else None
+        if self.op != '=':
+            return None
+        if self.field in ('title', 'mimeType'):
+            return files._ids_with(self.field, self.value)
+        if self.field in ('trashed', 'starred', 'hidden') and self.value:
+            return files._ids_with_label(self.field)
+        if self.field == 'sharedWithMe' and self.value:
+            return files._directory.permissions()._shared_with_me_ids()
+        return None
+
+    def match(self, afile, files):
+        field = self.field
+        op = self.op
+        if field in ('trashed', 'starred', 'hidden'):
+            actual = bool((afile.get('labels') or {}).get(field))
+        elif field == 'sharedWithMe':
+            actual = files._directory.permissions()._is_shared_with_me(afile['id'])
+        elif field == 'fullText':
+            # the index has the words of the content too
+            return files._text_index().has_words(afile['id'], words(self.value))
+        elif field in DATE_FIELDS:
+            actual = afile.get(field)
+            if self._formatted is not None and actual and _is_formatted(actual):
+                return _compare(actual, op, self._formatted)
+            actual = parse_date(actual)
+            if actual is None:
+                return False
+            return _compare(actual, op, self._date)
+        else:
+            actual = afile.get(field)
+            if op == 'contains':
+                if field == 'title':
+                    return _prefix_match(actual, self.value)
+                return actual is not None and self.value in actual
+        return _compare(actual, op, self.value)
+
+
+def _compare(actual, op, expected):
+    if op == '=':
+        return actual == expected
+    if op == '!=':
+        return actual != expected
+    if op == '<':
+        return actual < expected
+    if op == '<=':
+        return actual <= expected
+    if op == '>':
+        return actual > expected
+    if op == '>=':
+        return actual >= expected
+    raise QueryError("Unknown operator: %s" % op)
+
+
+def _narrow(bounds, other):
+    """
+    :return: the bounds of the keys in both ranges, see Comparison._range
+    """
+    if bounds is None:
+        return other
+    low, high, include_low, include_high = bounds
+    other_low, other_high, other_include_low, other_include_high = other
+    if other_low is not None and (low is None or other_low > low or (other_low == low and not other_include_low)):
+        low, include_low = other_low, other_include_low
+    if other_high is not None and (high is None or other_high < high or
+                                   (other_high == high and not other_include_high)):
+        high, include_high = other_high, other_include_high
+    return low, high, include_low, include_high
+
+
+class Membership(Node):
+    """
+    '<value>' in parents|owners|writers|readers
+    """
+
+    def __init__(self, value, field):
+        self.value = value
+        self.field = field
+
+    def lookup(self, files):
+        if self.field == 'parents':
+            return files._directory.parents()._children_ids(self.value)
+        return files._directory.permissions()._file_ids_for(self.value, self.field[:-1])
+
+    def match(self, afile, files):
+        if self.field == 'parents':
+            return files._directory.parents()._has_parent(afile['id'], self.value)
+        role = self.field[:-1]
+        return files._directory.permissions()._has_role(afile['id'], self.value, role)
+
+
+class And(Node):
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def lookup(self, files):
+        # comparisons of the same date make one range, e.g. a day is one lookup rather than two halves
+        ranges = {}
+        others = []
+        for node in self.nodes:
+            bounds = node._range() if isinstance(node, Comparison) else None
+            if bounds is None:
+                others.append(node)
+            else:
+                ranges[node.field] = _narrow(ranges.get(node.field), bounds)
+        found = [files._ids_in_date_range(field, *bounds) for field, bounds in ranges.iteritems()]
+        found.extend(ids for ids in (node.lookup(files) for node in others) if ids is not None)
+        if not found:
+            return None
+        # start from the smallest candidate set and probe the others
+        found.sort(key=len)
+        result, others = found[0], found[1:]
+        if not others:
+            return result
+        return set(file_id for file_id in result if all(file_id in ids for ids in others))
+
+    def match(self, afile, files):
+        for node in self.nodes:
+            if not node.match(afile, files):
+                return False
+        return True
+
+
+class Or(Node):
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+
+    def lookup(self, files):
+        result = set()
+        for node in self.nodes:
+            ids = node.lookup(files)
+            if ids is None:
+                return None
+            result.update(ids)
+        return result
+
+    def match(self, afile, files):
+        for node in self.nodes:
+            if node.match(afile, files):
+                return True
+        return False
+
+
+class Not(Node):
+
+    def __init__(self, node):
+        self.node = node
+
+    def match(self, afile, files):
+        return not self.node.match(afile, files)
+
+
+class Parser(object):
+
+    def __init__(self, q):
+        self._q = q
+        self._tokens = tokenize(q)
+        self._pos = 0
+
+    def parse(self):
+        if not self._tokens:
+            raise QueryError("Empty query")
+        node = self._or()
+        if self._pos != len(self._tokens):
+            raise QueryError("Unexpected '%s' in query: %s" % (self._tokens[self._pos][1], self._q))
+        return node
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise QueryError("Unexpected end of query: %s" % self._q)
+        self._pos += 1
+        return token
+
+    def _keyword(self, word):
+        kind, text = self._peek()
+        if kind == 'word' and text.lower() == word:
+            self._pos += 1
+            return True
+        return False
+
+    def _or(self):
+        nodes = [self._and()]
+        while self._keyword('or'):
+            nodes.append(self._and())
+        return nodes[0] if len(nodes) == 1 else Or(nodes)
+
+    def _and(self):
+        nodes = [self._not()]
+        while self._keyword('and'):
+            nodes.append(self._not())
+        return nodes[0] if len(nodes) == 1 else And(nodes)
+
+    def _not(self):
+        if self._keyword('not'):
+            return Not(self._not())
+        if self._peek() == ('punct', '('):
+            self._next()
+            node = self._or()
+            if self._next() != ('punct', ')'):
+                raise QueryError("Missing ')' in query: %s" % self._q)
+            return node
+        return self._term()
+
+    def _term(self):
+        kind, text = self._next()
+        if kind == 'string':
+            if not self._keyword('in'):
+                raise QueryError("Expected 'in' after '%s'" % text)
+            field_kind, field = self._next()
+            if field_kind != 'word' or field not in COLLECTION_FIELDS:
+                raise QueryError("Invalid collection for 'in': %s" % field)
+            return Membership(text, field)
+        if kind != 'word':
+            raise QueryError("Expected a field name, got '%s'" % text)
+        field = text
+        if field == 'properties':
+            raise QueryError("Property queries are not supported")
+        if field not in FIELD_OPS:
+            raise QueryError("Invalid field: %s" % field)
+        op_kind, op = self._peek()
+        if field == 'sharedWithMe' and op_kind != 'op':
+            # bare "sharedWithMe" is allowed
+            return Comparison(field, '=', True)
+        self._next()
+        if op_kind == 'word' and op.lower() == 'contains':
+            op = 'contains'
+        elif op_kind != 'op':
+            raise QueryError("Expected an operator after %s" % field)
+        if op not in FIELD_OPS[field]:
+            raise QueryError("Operator %s is not valid for %s" % (op, field))
+        return Comparison(field, op, self._value(field))
+
+    def _value(self, field):
+        kind, text = self._next()
+        if field in BOOLEAN_FIELDS:
+            if kind == 'word' and text.lower() in ('true', 'false'):
+                return text.lower() == 'true'
+            raise QueryError("Expected true or false for %s" % field)
+        if kind != 'string':
+            raise QueryError("Expected a quoted value for %s" % field)
+        return text
+
+
+class Query(object):
+    """
+    A parsed query. Compiled once and reused for every list call with the same q.
+    """
+
+    def __init__(self, q):
+        self.q = q
+        self.root = Parser(q).parse()
+
+    def candidates(self, files):
+        """
+        :param files: the FilesService to search
+        :return: set of file ids that may match, or None if all files must be checked
+        """
+        return self.root.lookup(files)
+
+    def match(self, afile, files):
+        return self.root.match(afile, files)
+
+    def execute(self, files, after=None, limit=None):
+        """
+        :param files: the FilesService to search
+        :param after: cursor from the previous page, see OrderedStore.page
+        :param limit: maximum number of files to return
+        :return: (list of matching file dicts, cursor for the next page or None)
+        """
+        store = files._files
+        match = self.root.match
+        ids = self.candidates(files)
+        if ids is None:
+            return store.page(after, limit, accept=lambda afile: match(afile, files))
+        matched = (file_id for file_id in ids if file_id in store and match(store[file_id], files))
+        return store.page_of(matched, after, limit)
+
+
+_PLAN_CACHE_SIZE = 256
+_plan_cache = {}
+_plan_cache_lock = threading.Lock()
+
+
+def compile_query(q):
+    """
+    :param q: query string in the Drive v2 search syntax
+    :return: a Query, shared with other callers that used the same string
+    :raises QueryError: if q isn't a valid query
+    """
+    plan = _plan_cache.get(q)
+    if plan is None:
+        plan = Query(q)
+        with _plan_cache_lock:
+            if len(_plan_cache) >= _PLAN_CACHE_SIZE:
+                _plan_cache.clear()
+            _plan_cache[q] = plan
+    return plan
@@ -0,0 +1,152 @@
+# compact in-memory representation of the Drive resources held by the services
+
+__author__ = 'charlie'
+
+_ABSENT = object()
+
+
+_CONTAINERS = (dict, list)
+
+
+def copy_value(value):
+    """
+    Copy the dicts and lists in a JSON-like value, so a response can't change what's stored
+    """
+    # exact type checks, and no calls for the leaves: this runs for every field of every file returned
+    cls = type(value)
+    if cls is dict:
+        result = value.copy()
+        for key, item in value.iteritems():
+            if type(item) in _CONTAINERS:
+                result[key] = copy_value(item)
+        return result
+    if cls is list:
+        return [copy_value(item) if type(item) in _CONTAINERS else item for item in value]
+    if isinstance(value, dict):
+        return copy_value(dict(value))
+    if isinstance(value, list):
+        return copy_value(list(value))
+    return value
+
+
+def principal(permission):
+    """
+    :return: who a permission grants access to: an email address, a domain or "anyone"
+    """
+    if permission['type'] in ('user', 'group'):
+        return (permission['emailAddress'] or '').lower()
+    if permission['type'] == 'domain':
+        return (permission['domain'] or '').lower()
+    return 'anyone'
+
+
+class FileRecord(object):
+    """
+    A stored file. The fields every file has live in slots, anything else goes in a dict that
+    is only created when needed. Behaves enough like the dict it replaces (get, [], in) for the
+    services and the query planner; to_dict() builds the Drive resource for responses.
+
+    Values may be shared with other records (e.g. the default labels and owners), so replace
+    them rather than changing them in place.
+    """
+
+    __slots__ = ('kind', 'id', 'title', 'description', 'mimeType', 'labels', 'owners', 'extra')
+
+    FIELDS = ('kind', 'id', 'title', 'description', 'mimeType', 'labels', 'owners')
+
+    def __init__(self, data=None):
+        self.extra = None
+        if data:
+            for key, value in data.iteritems():
+                self[key] = value
+
+    def __getitem__(self, key):
+        value = self.get(key, _ABSENT)
+        if value is _ABSENT:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.FIELDS:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.FIELDS:
+            if getattr(self, key, _ABSENT) is _ABSENT:
+                raise KeyError(key)
+            delattr(self, key)
+        elif self.extra and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.get(key, _ABSENT) is not _ABSENT
+
+    def get(self, key, default=None):
+        if key in self.FIELDS:
+            return getattr(self, key, default)
+        if self.extra:
+            return self.extra.get(key, default)
+        return default
+
+    def pop(self, key, default=None):
+        value = self.get(key, _ABSENT)
+        if value is _ABSENT:
+            return default
+        del self[key]
+        return value
+
+    def to_dict(self, result=None, projection=None):
+        """
+        :param result: the dict to fill in, a new one if None
+        :param projection: a fields.Projection, to fill in only the fields it selects. Those it
+            leaves out aren't copied at all.
+        :return: a dict in the shape of a Drive file resource, sharing nothing with the record
+        """
+        if result is None:
+            result = {}
+        if projection is not None:
+            selected = projection.fields
+            if '*' not in selected:
+                for field, sub in selected.iteritems():
+                    value = self.get(field, _ABSENT)
+                    if value is not _ABSENT:
+                        if sub is not None:
+                            value = sub.apply(value)
+                        result[field] = copy_value(value) if type(value) in _CONTAINERS else value
+                return result
+            self.to_dict(result)
+            for field, sub in selected.iteritems():
+                if sub is not None and field in result:
+                    result[field] = sub.apply(result[field])
+            return result
+        for field in self.FIELDS:
+            value = getattr(self, field, _ABSENT)
+            if value is not _ABSENT:
+                result[field] = copy_value(value) if type(value) in _CONTAINERS else value
+        if self.extra:
+            for key, value in self.extra.iteritems():
+                result[key] = copy_value(value)
+        return result
+
+    def copy(self):
+        return FileRecord(self.to_dict())
+
+
+class Resource(dict):
+    """
+    A resource as returned by the services: an ordinary dict, plus the key its JSON is cached
+    under (see drivetestbed.serialize). The key names the stored object and its version, so it
+    changes whenever the object does.
+    """
+
+    __slots__ = ('cache_key',)
+
+    def __init__(self, data=(), cache_key=None):
+        dict.__init__(self, data)
+        self.cache_key = cache_key
@@ -0,0 +1,95 @@
+# process-wide cache of the Drive discovery document and the dispatcher compiled from it
+import json
+import os
+import threading
+from drivetestbed.dispatch import Dispatcher
+
+__author__ = 'charlie'
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "schema.json")
+PATH_PREFIX = "/drive/v2/"
+
+
+class SchemaCache(object):
+    """
+    Holds the raw discovery document, the parsed schema and the compiled Dispatcher.
+    Everything is built once, on first use, and shared by every caller after that.
+    """
+
+    def __init__(self, path=SCHEMA_PATH):
+        self._path = path
+        self._lock = threading.Lock()
+        self._content = None
+        self._schema = None
+        self._dispatcher = None
+
+    def _load(self):
+        with self._lock:
+            # another thread may have finished loading while we waited
+            if self._dispatcher is not None:
+                return
+            fp = open(self._path, 'r')
+            try:
+                content = fp.read()
+            finally:
+                fp.close()
+            schema = json.loads(content)
+            dispatcher = Dispatcher(schema, PATH_PREFIX)
+            self._content = content
+            self._schema = schema
+            # assigned last, it is the flag the unlocked fast path checks
+            self._dispatcher = dispatcher
+
+    @property
+    def loaded(self):
+        return self._dispatcher is not None
+
+    @property
+    def content(self):
+        """
+        :return: the discovery document exactly as it is stored on disk
+        """
+        if self._dispatcher is None:
+            self._load()
+        return self._content
+
+    @property
+    def schema(self):
+        """
+        :return: the parsed discovery document. Shared, so treat it as read only.
+        """
+        if self._dispatcher is None:
+            self._load()
+        return self._schema
+
+    @property
+    def dispatcher(self):
+        """
+        :return: a Dispatcher with a route for every method in the schema
+        """
+        if self._dispatcher is None:
+            self._load()
+        return self._dispatcher
+
+    def clear(self):
+        with self._lock:
+            self._content = None
+            self._schema = None
+            self._dispatcher = None
+
+
+_default_cache = SchemaCache()
+
+
+def get_cache():
+    return _default_cache
+
+
+def warm_up():
+    """
+    Load and compile the schema now, e.g. at import time or from a session fixture,
+    so that the first discovery request in a timed test doesn't pay for it.
+    :return: the shared cache
+    """
+    _default_cache.dispatcher
+    return _default_cache
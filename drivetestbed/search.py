@@ -0,0 +1,210 @@
+# inverted index behind the "fullText contains" and "title contains" queries
+import bisect
+import re
+
+__author__ = 'charlie'
+
+# "fullText contains" matches whole words
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+# "title contains" matches the start of any run of letters and digits, see query._prefix_match
+_TITLE_TERM_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+# how much of a file's content is read for words
+MAX_CONTENT_BYTES = 1 << 20
+# types, besides text/*, whose content is searched
+TEXT_MIME_TYPES = ('application/json', 'application/xml', 'application/javascript')
+
+
+def to_text(value):
+    """
+    Byte strings (e.g. from a query string) are taken to be UTF-8, so that they find the same
+    words as the unicode the JSON bodies give
+    """
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return value.decode('latin-1')
+    return value
+
+
+def words(text):
+    """
+    :return: the lowercased words of the text, for fullText
+    """
+    return _WORD_RE.findall(to_text(text).lower()) if text else []
+
+
+def title_terms(text):
+    """
+    :return: the lowercased runs of letters and digits in the text, whose starts "title contains" matches
+    """
+    return _TITLE_TERM_RE.findall(to_text(text).lower()) if text else []
+
+
+def _file_words(fields):
+    """
+    :return: the set of words in any of the fields
+    """
+    return set(words(u' '.join(to_text(field) for field in fields if field)))
+
+
+def is_text(mime_type):
+    """
+    :return: whether content of the type is searched by fullText
+    """
+    return bool(mime_type) and (mime_type.startswith('text/') or mime_type in TEXT_MIME_TYPES)
+
+
+def _post(index, term, file_id):
+    """
+    :return: whether the term is new to the index
+    """
+    # most terms of a large tree belong to a few files: store a lone id on its own and only make
+    # a set when a second file turns up
+    ids = index.get(term)
+    if ids is None:
+        index[term] = file_id
+        return True
+    if isinstance(ids, set):
+        ids.add(file_id)
+    elif ids != file_id:
+        index[term] = set((ids, file_id))
+    return False
+
+
+def _unpost(index, term, file_id):
+    ids = index.get(term)
+    if ids == file_id:
+        del index[term]
+    elif isinstance(ids, set):
+        ids.discard(file_id)
+        if len(ids) == 1:
+            index[term] = ids.pop()
+
+
+def _ids(index, term):
+    ids = index.get(term)
+    if ids is None:
+        return ()
+    if isinstance(ids, set):
+        return ids
+    return (ids,)
+
+
+def _intersect(postings):
+    """
+    :param postings: collections of file ids
+    :return: the ids in all of them, probing the others for each id of the smallest
+    """
+    postings = sorted(postings, key=len)
+    first, others = postings[0], postings[1:]
+    if not others:
+        return first
+    return set(file_id for file_id in first if all(file_id in ids for ids in others))
+
+
+class TextIndex(object):
+    """
+    Term -> file ids, for the words of each file's title, description and text content, and for
+    the terms of its title. The title terms are also kept in order so that the files with a term
+    starting with some prefix are found with a bisect, and then cost as much as the terms found.
+    """
+
+    def __init__(self, entries=()):
+        """
+        :param entries: (file id, title, description, content) of the files to start with
+        """
+        self._words = {}
+        self._titles = {}
+        for entry in entries:
+            self._post_file(*entry)
+        # the title terms in order. Terms new since it was sorted wait in _recent, and terms no
+        # longer in _titles are only dropped the next time the two are merged.
+        self._sorted = sorted(self._titles)
+        self._recent = []
+
+    def _post_file(self, file_id, title, description, content):
+        titles = self._titles
+        new_terms = [term for term in set(title_terms(title)) if _post(titles, term, file_id)]
+        text = self._words
+        for word in _file_words((title, description, content)):
+            _post(text, word, file_id)
+        return new_terms
+
+    def add(self, file_id, title, description=None, content=None):
+        """
+        :param content: the file's text content, None if it has none to search
+        """
+        new_terms = self._post_file(file_id, title, description, content)
+        if new_terms:
+            self._recent.extend(new_terms)
+            if len(self._recent) > max(1024, len(self._sorted) >> 8):
+                self._merge()
+
+    def remove(self, file_id, title, description=None, content=None):
+        """
+        Take a file out, given the same fields it was added with
+        """
+        titles = self._titles
+        for term in set(title_terms(title)):
+            _unpost(titles, term, file_id)
+        text = self._words
+        for word in _file_words((title, description, content)):
+            _unpost(text, word, file_id)
+
+    def _merge(self):
+        titles = self._titles
+        recent = set(self._recent)
+        merged = [term for term in self._sorted if term in titles and term not in recent]
+        merged.extend(term for term in recent if term in titles)
+        # two sorted runs, which sort() merges in one pass
+        merged.sort()
+        self._sorted = merged
+        self._recent = []
+
+    def with_words(self, query_words):
+        """
+        :return: ids of the files with every one of the words
+        """
+        if not query_words:
+            return ()
+        return _intersect([_ids(self._words, to_text(word).lower()) for word in query_words])
+
+    def has_words(self, file_id, query_words):
+        for word in query_words:
+            if file_id not in _ids(self._words, to_text(word).lower()):
+                return False
+        return True
+
+    def with_prefix(self, prefix):
+        """
+        :return: ids of the files whose title has a term starting with the prefix
+        """
+        prefix = to_text(prefix).lower()
+        titles = self._titles
+        found = []
+        terms = self._sorted
+        i = bisect.bisect_left(terms, prefix)
+        while i < len(terms) and terms[i].startswith(prefix):
+            ids = _ids(titles, terms[i])
+            if ids:
+                found.append(ids)
+            i += 1
+        for term in self._recent:
+            if term.startswith(prefix):
+                found.append(_ids(titles, term))
+        if len(found) == 1:
+            return found[0]
+        result = set()
+        for ids in found:
+            result.update(ids)
+        return result
+
+    def with_title_prefixes(self, prefixes):
+        """
+        :return: ids of the files whose title has, for every prefix, a term starting with it
+        """
+        if not prefixes:
+            return ()
+        return _intersect([self.with_prefix(prefix) for prefix in prefixes])
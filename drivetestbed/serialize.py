@@ -0,0 +1,134 @@
+# JSON encoding of service responses, reusing the encoding of objects that haven't changed
+import json
+import threading
+from drivetestbed.records import Resource
+
+__author__ = 'charlie'
+
+# bytes of JSON a cache keeps before it starts dropping the least recently used
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+# fields of the entries in ResponseCache's recency list
+_PREV, _NEXT, _KEY, _VALUE = 0, 1, 2, 3
+
+
+class ResponseCache(object):
+    """
+    LRU cache of the JSON for Resources, keyed by their cache_key, bounded by the total size
+    of the JSON it holds.
+
+    Entries are [prev, next, key, json] lists linked in order of use, with the most recently
+    used next to the root, so a hit costs a dict lookup and a few assignments.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def fragment(self, resource):
+        """
+        :return: the JSON for a Resource, from the cache if it has been encoded before
+        """
+        return self.fragments([resource])[0]
+
+    def fragments(self, resources):
+        """
+        :return: the JSON for each of a list of Resources
+        """
+        result = []
+        missed = []
+        root = self._root
+        entries = self._entries
+        with self._lock:
+            for resource in resources:
+                key = resource.cache_key
+                entry = entries.get(key) if key is not None else None
+                if entry is None:
+                    missed.append(len(result))
+                    result.append(None)
+                    continue
+                # unlink, then put back as the most recently used
+                prev, next_ = entry[_PREV], entry[_NEXT]
+                prev[_NEXT] = next_
+                next_[_PREV] = prev
+                first = root[_NEXT]
+                entry[_PREV] = root
+                entry[_NEXT] = first
+                first[_PREV] = root[_NEXT] = entry
+                result.append(entry[_VALUE])
+            self.hits += len(result) - len(missed)
+            self.misses += len(missed)
+        if not missed:
+            return result
+        for i in missed:
+            result[i] = json.dumps(resources[i])
+        with self._lock:
+            for i in missed:
+                key = resources[i].cache_key
+                if key is not None and key not in entries:
+                    self._add(key, result[i])
+        return result
+
+    def _add(self, key, encoded):
+        root = self._root
+        first = root[_NEXT]
+        entry = [root, first, key, encoded]
+        first[_PREV] = root[_NEXT] = entry
+        self._entries[key] = entry
+        self.size += len(encoded)
+        while self.size > self.max_bytes and self._entries:
+            last = root[_PREV]
+            last[_PREV][_NEXT] = root
+            root[_PREV] = last[_PREV]
+            del self._entries[last[_KEY]]
+            self.size -= len(last[_VALUE])
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._root[:] = [self._root, self._root, None, None]
+            self.size = 0
+            self.hits = self.misses = self.evictions = 0
+
+
+def dumps(data, cache=None):
+    """
+    Encode a service response. Resources, on their own or as the items of a list response,
+    are taken from the cache; the rest of a list response is encoded around them.
+    :param cache: a ResponseCache, or None to encode everything
+    """
+    if cache is None:
+        return json.dumps(data)
+    if isinstance(data, Resource):
+        return cache.fragment(data)
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return json.dumps(data)
+    rest = dict((key, value) for key, value in data.iteritems() if key != 'items')
+    head = json.dumps(rest)
+    if all(isinstance(item, Resource) for item in items):
+        fragments = cache.fragments(items)
+    else:
+        fragments = [cache.fragment(item) if isinstance(item, Resource) else json.dumps(item) for item in items]
+    return '%s%s"items": [%s]}' % (head[:-1], ', ' if rest else '', ', '.join(fragments))
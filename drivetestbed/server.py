@@ -0,0 +1,313 @@
+# serves a ServiceDirectory over HTTP/1.1 so that other processes and languages can use it
+#
+#     python -m drivetestbed.server --port 8080 --fixture files.ndjson
+#
+# Point a client at http://127.0.0.1:8080/discovery/v1/apis/drive/v2/rest; the discovery
+# document it gets back has its rootUrl set to the server.
+import argparse
+import asyncore
+import json
+import logging
+import socket
+import threading
+from googleapiclient.errors import HttpError
+from drivetestbed import schema
+from drivetestbed.http import TestbedHttp
+from drivetestbed.services import ServiceDirectory
+
+__author__ = 'charlie'
+
+logger = logging.getLogger(__name__)
+
+# a request head bigger than this gets a 431 and the connection is closed
+MAX_HEADER_SIZE = 64 * 1024
+READ_SIZE = 64 * 1024
+# responses smaller than this are joined into one send; bigger content is sent straight from the buffer it's in
+SEND_SIZE = 64 * 1024
+
+# headers of TestbedHttp's responses that are passed on to the client
+_PASSED_HEADERS = ('location', 'range', 'content-range')
+
+_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    411: 'Length Required',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+}
+
+
+def _format_response(status, reason, content, content_type, keep_alive, headers=()):
+    """
+    :param content: a str, or a buffer over file content, which isn't copied
+    :param headers: more (name, value) headers
+    :return: the head and the content of the response, to send one after the other
+    """
+    head = ['HTTP/1.1 %d %s' % (status, reason),
+            'Content-Type: %s' % content_type,
+            'Content-Length: %d' % len(content)]
+    head.extend('%s: %s' % header for header in headers)
+    if not keep_alive:
+        head.append('Connection: close')
+    return ['\r\n'.join(head) + '\r\n\r\n', content]
+
+
+class _Connection(asyncore.dispatcher):
+    """
+    One client connection. Requests are parsed as they arrive and answered in order, so a
+    client may send several without waiting (pipelining). The connection stays open between
+    requests unless the client asks for it to close, or speaks HTTP/1.0 without keep-alive.
+    """
+
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map=server._socket_map)
+        self._server = server
+        self._in = ''
+        self._out = []
+        self._closing = False
+        # (method, target, version, headers, length) of a request whose body is still arriving
+        self._waiting = None
+        self._body = []
+        self._body_size = 0
+
+    def handle_read(self):
+        try:
+            data = self.recv(READ_SIZE)
+        except socket.error:
+            data = ''
+        if not data:
+            self.close()
+            return
+        if self._waiting is None:
+            self._in += data
+        else:
+            # a big body is collected in pieces, adding each to one string would copy it over and over
+            self._body.append(data)
+            self._body_size += len(data)
+            length = self._waiting[-1]
+            if self._body_size < length:
+                return
+            data = ''.join(self._body)
+            method, target, version, headers, length = self._waiting
+            self._waiting = None
+            self._body = []
+            self._body_size = 0
+            # anything after the body is the next request
+            self._in = data[length:]
+            self._respond(method, target, version, headers, data[:length])
+        self._process()
+
+    def _process(self):
+        while not self._closing:
+            end = self._in.find('\r\n\r\n')
+            if end < 0:
+                if len(self._in) > MAX_HEADER_SIZE:
+                    self._reply(431, 'Request head too large', False)
+                return
+            lines = self._in[:end].split('\r\n')
+            request_line = lines[0].split()
+            if len(request_line) != 3:
+                self._reply(400, 'Invalid request line', False)
+                return
+            method, target, version = request_line
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if 'chunked' in headers.get('transfer-encoding', '').lower():
+                self._reply(411, 'Chunked request bodies are not supported', False)
+                return
+            try:
+                length = int(headers.get('content-length') or 0)
+            except ValueError:
+                self._reply(400, 'Invalid Content-Length', False)
+                return
+            start = end + 4
+            if len(self._in) < start + length:
+                # wait for the rest of the body
+                self._waiting = (method, target, version, headers, length)
+                self._body = [self._in[start:]]
+                self._body_size = len(self._body[0])
+                self._in = ''
+                return
+            body = self._in[start:start + length]
+            self._in = self._in[start + length:]
+            self._respond(method, target, version, headers, body)
+
+    def _respond(self, method, target, version, headers, body):
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = connection == 'keep-alive'
+        else:
+            keep_alive = connection != 'close'
+        self._out.extend(self._server.respond(method, target, body, headers, keep_alive))
+        if not keep_alive:
+            self._closing = True
+
+    def _reply(self, status, message, keep_alive):
+        self._out.extend(_format_response(status, _REASONS[status], message, 'text/plain', keep_alive))
+        if not keep_alive:
+            self._closing = True
+
+    def writable(self):
+        return bool(self._out)
+
+    def handle_write(self):
+        out = self._out
+        data = out[0]
+        if len(data) < SEND_SIZE:
+            # join small pieces, e.g. the heads and bodies of pipelined responses, into one send
+            count = size = 0
+            while count < len(out) and size + len(out[count]) <= SEND_SIZE:
+                size += len(out[count])
+                count += 1
+            if count > 1:
+                data = ''.join(str(piece) for piece in out[:count])
+                out[:count] = [data]
+        try:
+            sent = self.send(data)
+        except socket.error:
+            self.close()
+            return
+        if sent < len(data):
+            out[0] = buffer(data, sent)
+        else:
+            del out[0]
+        if not out and self._closing:
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        logger.exception("Error on connection to testbed server")
+        self.close()
+
+
+class TestbedServer(asyncore.dispatcher):
+    """
+    Serves a ServiceDirectory on a local socket with the same routing as TestbedHttp: discovery,
+    batch and every REST path in the schema. One thread runs an event loop (poll based, so the
+    number of connections isn't capped by select) over all of the connections.
+    """
+
+    def __init__(self, directory=None, host='127.0.0.1', port=0, backlog=1024):
+        """
+        :param directory: the ServiceDirectory to serve, a new empty one if None
+        :param port: 0 to pick a free port, see address
+        """
+        self._socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self._socket_map)
+        self.directory = directory if directory is not None else ServiceDirectory()
+        self._http = TestbedHttp(directory=self.directory)
+        # requests are routed with the map built for the discovery document
+        self._http._use_schema()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+        self.address = self.socket.getsockname()
+        self._discovery = self._discovery_document()
+
+    @property
+    def url(self):
+        return "http://%s:%d/" % self.address
+
+    @property
+    def discovery_url(self):
+        return self.url + "discovery/v1/apis/{api}/{apiVersion}/rest"
+
+    def _discovery_document(self):
+        document = dict(schema.get_cache().schema)
+        document['rootUrl'] = self.url
+        document['baseUrl'] = self.url + document['servicePath']
+        return json.dumps(document)
+
+    def respond(self, method, target, body, headers, keep_alive):
+        """
+        :return: the pieces of the HTTP response to one request, see _format_response
+        """
+        content_type = 'application/json; charset=UTF-8'
+        passed = []
+        try:
+            if 'discovery' in target.split('?', 1)[0]:
+                status, reason, content = 200, 'OK', self._discovery
+            else:
+                resp, content = self._http.request(target, method=method, body=body or None, headers=headers)
+                status, reason = resp.status, resp.reason
+                content_type = resp.get('content-type', content_type)
+                for name in _PASSED_HEADERS:
+                    if name in resp:
+                        passed.append((name.title(), resp[name]))
+        except HttpError as e:
+            status, reason, content = e.resp.status, e.resp.reason, e.content
+        except Exception:
+            logger.exception("Error handling %s %s", method, target)
+            status, reason, content = 500, _REASONS[500], ''
+        return _format_response(status, reason, content, content_type, keep_alive, self._absolute(passed))
+
+    def _absolute(self, headers):
+        """
+        TestbedHttp only sees the path of a request, so it makes upload locations from the path
+        alone. The client needs them to point at this server.
+        """
+        return [(name, self.url[:-1] + value if name == 'Location' and value.startswith('/') else value)
+                for name, value in headers]
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _Connection(pair[0], self)
+
+    def handle_error(self):
+        logger.exception("Error in testbed server")
+
+    def serve_forever(self, poll_interval=0.1):
+        """
+        Run the event loop until stop() is called
+        """
+        while not self._stopped.is_set():
+            asyncore.loop(timeout=poll_interval, use_poll=True, map=self._socket_map, count=1)
+        asyncore.close_all(map=self._socket_map)
+
+    def start(self):
+        """
+        Serve from a background thread
+        :return: self
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name="drivetestbed-server")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a Drive testbed over HTTP")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fixture', help="NDJSON or JSON array of Drive files to load")
+    parser.add_argument('--user-email', default="test@drivetestbed.org")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    directory = ServiceDirectory(user_email=args.user_email)
+    if args.fixture:
+        directory.load(args.fixture)
+    server = TestbedServer(directory, host=args.host, port=args.port)
+    logger.info("Serving the Drive testbed at %s", server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,19 @@
 import base64
+import json
 import logging
-import uuid
-from apiclient.errors import HttpError
-from httplib2 import Response
+import threading
+from contextlib import contextmanager
+# not apiclient.errors: importing the apiclient package imports all of the client library
+from googleapiclient.errors import HttpError
+from drivetestbed import loader, media, query, search
+from drivetestbed.backends import DictBackend
+from drivetestbed.fields import FieldsError, compile_fields, project_list, projects
+from drivetestbed.locking import ReadWriteLock, reads, writes
+from drivetestbed.metrics import Metrics
+from drivetestbed.records import FileRecord, Resource, copy_value, principal
+from drivetestbed.serialize import ResponseCache
+from drivetestbed.store import DEFAULT_PAGE_SIZE, OrderedStore, PageTokenError, SortedIndex, decode_page_token, \
+    encode_page_token, page_size
 
 __author__ = 'charlie'
 
@@ -20,40 +31,163 @@ class ServiceCall(object):
 # From Stack Overflow: http://stackoverflow.com/questions/534839/how-to-create-a-guid-in-python
 # get a UUID - URL safe, Base64
 def get_a_uuid():
+    # uuid imports ctypes, so it waits for the first file to need an id
+    import uuid
     r_uuid = base64.urlsafe_b64encode(uuid.uuid4().bytes)
     return r_uuid.replace('=', '')
 
 
-def raise_404(fileId, msg=None):
-    if not msg:
-        msg = "File not found: %s" % fileId
-    resp = Response({"status": 404, "reason": "Not Found"})
+ROOT_FOLDER_ID = "ROOT_FOLDER_ID"
+
+# labels of a new file, shared by every file that doesn't set its own so never change it in place
+DEFAULT_LABELS = {
+    "starred": False,
+    "hidden": False,
+    "trashed": False,
+    "restricted": False,
+    "viewed": True
+}
+
+
+def _raise_http_error(status, reason, error_reason, msg, domain="global"):
+    from httplib2 import Response
+    resp = Response({"status": status, "reason": reason})
+    # keep quotes in the message from breaking the JSON
+    msg = json.dumps(msg)[1:-1]
     raise HttpError(resp,
                     '''
                     {
                      "error": {
                       "errors": [
                        {
-                        "domain": "global",
-                        "reason": "notFound",
+                        "domain": "%(domain)s",
+                        "reason": "%(error_reason)s",
                         "message": "%(msg)s"
                        }
                       ],
-                      "code": 404,
+                      "code": %(status)d,
                       "message": "%(msg)s"
                      }
-                    }''' % {"msg": msg})
+                    }''' % {"msg": msg, "status": status, "error_reason": error_reason, "domain": domain})
+
+
+def raise_404(fileId, msg=None):
+    if not msg:
+        msg = "File not found: %s" % fileId
+    _raise_http_error(404, "Not Found", "notFound", msg)
+
+
+def raise_400(msg):
+    _raise_http_error(400, "Bad Request", "invalid", msg)
+
+
+def raise_rate_limited(status, reason, error_reason, msg):
+    """
+    Refuse a call for going over a rate limit, e.g. 403 userRateLimitExceeded, see drivetestbed.throttle
+    """
+    _raise_http_error(status, reason, error_reason, msg, domain="usageLimits")
+
+
+def _page_args(pageToken, maxResults, default_size=DEFAULT_PAGE_SIZE):
+    """
+    :param default_size: page size when maxResults isn't given, None to return everything
+    :return: (after, limit) for OrderedStore.page, raising a 400 for bad values
+    """
+    try:
+        return decode_page_token(pageToken), page_size(maxResults, default=default_size)
+    except PageTokenError as e:
+        raise_400(str(e))
+
+
+def _projection(selection):
+    """
+    :param selection: a compiled fields.Projection, or the text of one from a caller using the services directly
+    :return: the Projection, None to return everything
+    """
+    if isinstance(selection, basestring):
+        try:
+            return compile_fields(selection)
+        except FieldsError as e:
+            raise_400(str(e))
+    return selection
+
+
+def _set_next_page(response, last):
+    if last is not None:
+        response['nextPageToken'] = encode_page_token(last)
+
+
+def _default_owner(user_email):
+    """
+    :return: (permission, user) describing the user as owner of a file
+    """
+    default_owner_perm = {
+           "kind": "drive#permission",
+           "etag": "Lie3Y624-6bAlCGsnUSYyb6P-dU/k6w2imYTYLSrsTHqeiu6HpWiCVQ",
+           "id": "11519106257625907838",
+           "name": "Test User",
+           "emailAddress": user_email,
+           "domain": "testers.com",
+           "role": "owner",
+           "type": "user",
+    }
+    owner_data = {
+          "kind": "drive#user",
+          "displayName": "Test User",
+          "picture": {
+            "url": "http://stub"
+          },
+          "isAuthenticatedUser": True,
+          "permissionId": default_owner_perm['id'],
+          "emailAddress": user_email
+    }
+    return default_owner_perm, owner_data
+
+
+def _date_key(afile, field):
+    """
+    :return: the file's date as a key for its SortedIndex, None if it hasn't got one
+    """
+    return query.parse_date_key(afile.get(field))
+
+
+def _add_default_owners(afile, default_owners):
+    """
+    :param default_owners: the directory's shared owners list, see ServiceDirectory._default_owners
+    """
+    if afile.get('owners'):
+        # a new list, so a fixture's own list of owners isn't changed
+        afile['owners'] = afile['owners'] + default_owners
+    else:
+        afile['owners'] = default_owners
 
 
 class FilesService(object):
 
-    def __init__(self, files=None, directory=None, user_email="test@gmail.com"):
-        self._files = {}
-        files = files or []
-        for afile in files:
-            if 'id' not in afile:
-                afile['id'] = get_a_uuid()
-            self._files[afile['id']] = afile
+    # fields with an exact-match index for queries
+    INDEXED_FIELDS = ('title', 'mimeType')
+    # labels with an index of the files that have them set. Trashed files have their own index.
+    INDEXED_LABELS = ('starred', 'hidden')
+    # metadata that patch changes
+    PATCHABLE_FIELDS = ('title', 'description', 'mimeType')
+    # dates with a sorted index for range queries
+    DATE_FIELDS = ('createdDate', 'modifiedDate', 'lastViewedByMeDate')
+
+    def __init__(self, directory=None):
+        self._files = OrderedStore()
+        # the query indexes: field -> {value: file id, or set of ids} and label -> set of ids.
+        # Built the first time a query needs them (see _indexes), kept up to date from then on.
+        self._field_index = None
+        self._label_index = None
+        self._index_lock = threading.Lock()
+        # the search.TextIndex for fullText and "title contains", built like the query indexes
+        self._text = None
+        # date field -> store.SortedIndex of the files by that date, built like the query indexes
+        self._date_index = None
+        # ids of the files in the trash, always kept
+        self._trashed = set()
+        # file id -> media.Blob, for files that have had content uploaded
+        self._content = {}
         self._directory = directory
 
     @property
@@ -64,51 +198,484 @@ class FilesService(object):
     def name(self):
         return "files"
 
-    def list(self, **kwargs):
+    def _add(self, afile):
+        """
+        :param afile: a dict or FileRecord with an id no stored file has
+        :return: the stored FileRecord
+        """
+        if not isinstance(afile, FileRecord):
+            afile = FileRecord(afile)
+        if afile['id'] in self._files:
+            # responses are cached by the file's version, which only moves on in _before_change:
+            # writing over a stored file here would leave the old one's responses being served
+            raise ValueError("File already stored: %s" % afile['id'])
+        self._files[afile['id']] = afile
+        self._index(afile)
+        return afile
+
+    def _export(self, fileId):
+        """
+        :return: a copy of everything this service holds for the file, None if it doesn't exist
+        """
+        afile = self._files.get(fileId)
+        if afile is None:
+            return None
+        return self._files.seq(fileId), afile.to_dict()
+
+    def _import(self, fileId, state):
+        seq, data = state
+        default_owners = self._directory._default_owners()
+        afile = FileRecord()
+        for key, value in data.iteritems():
+            # share the defaults again, rather than giving every restored file its own copy
+            if key == 'labels' and value == DEFAULT_LABELS:
+                value = DEFAULT_LABELS
+            elif key == 'owners' and value == default_owners:
+                value = default_owners
+            else:
+                value = copy_value(value)
+            afile[key] = value
+        self._files.put_at(fileId, afile, seq)
+        self._index(afile)
+
+    def _forget(self, fileId):
+        afile = self._files.pop(fileId, None)
+        if afile is not None:
+            self._unindex(afile)
+        self._content.pop(fileId, None)
+
+    def _set_content(self, afile, blob):
+        """
+        Give the file its uploaded content, with the fields that describe it
+        """
+        file_id = afile['id']
+        self._content[file_id] = blob
+        afile['fileSize'] = str(blob.size)
+        afile['md5Checksum'] = blob.md5
+        afile['downloadUrl'] = "https://www.googleapis.com/drive/v2/files/%s?alt=media" % file_id
+
+    def _indexes(self):
+        """
+        :return: (field index, label index), built now if no query has needed them yet
+        """
+        with self._index_lock:
+            if self._label_index is None:
+                field_index = dict((field, {}) for field in self.INDEXED_FIELDS)
+                label_index = dict((label, set()) for label in self.INDEXED_LABELS)
+                for afile in self._files.itervalues():
+                    self._add_to_indexes(afile, field_index, label_index)
+                self._field_index = field_index
+                # assigned last, it is the flag _index checks
+                self._label_index = label_index
+        return self._field_index, self._label_index
+
+    def _text_index(self):
+        """
+        :return: the search.TextIndex, built now if no query has needed it yet
+        """
+        text = self._text
+        if text is None:
+            with self._index_lock:
+                if self._text is None:
+                    with loader.gc_paused():
+                        self._text = search.TextIndex(self._text_entry(afile) for afile in self._files.itervalues())
+                text = self._text
+        return text
+
+    def _text_entry(self, afile):
+        """
+        :return: (id, title, description, content) of the file for the TextIndex, with the content
+            decoded if it is text
+        """
+        file_id = afile['id']
+        content = None
+        blob = self._content.get(file_id)
+        if blob is not None and search.is_text(afile.get('mimeType')):
+            # a character cut in two at the end is dropped
+            content = str(blob.view(0, search.MAX_CONTENT_BYTES)).decode('utf-8', 'ignore')
+        return file_id, afile.get('title'), afile.get('description'), content
+
+    def _date_indexes(self):
+        """
+        :return: date field -> SortedIndex, built now if no query has needed them yet
+        """
+        date_index = self._date_index
+        if date_index is None:
+            with self._index_lock:
+                if self._date_index is None:
+                    entries = [(field, []) for field in self.DATE_FIELDS]
+                    parse_date_key = query.parse_date_key
+                    with loader.gc_paused():
+                        for afile in self._files.itervalues():
+                            # the dates aren't slots, they are in the record's extra fields
+                            extra = afile.extra
+                            if extra:
+                                for field, items in entries:
+                                    key = parse_date_key(extra.get(field))
+                                    if key is not None:
+                                        items.append((key, afile.id))
+                        self._date_index = dict((field, SortedIndex(items)) for field, items in entries)
+                date_index = self._date_index
+        return date_index
+
+    def _index(self, afile):
+        labels = afile.get('labels')
+        if labels and labels.get('trashed'):
+            self._trashed.add(afile['id'])
+        if self._label_index is not None:
+            self._add_to_indexes(afile, self._field_index, self._label_index)
+        if self._text is not None:
+            self._text.add(*self._text_entry(afile))
+        if self._date_index is not None:
+            for field, index in self._date_index.iteritems():
+                key = _date_key(afile, field)
+                if key is not None:
+                    index.add(key, afile['id'])
+
+    def _add_to_indexes(self, afile, field_index, label_index):
+        file_id = afile['id']
+        for field in self.INDEXED_FIELDS:
+            # most values (titles especially) belong to one file: store its id on its own and
+            # only make a set when a second file turns up
+            index = field_index[field]
+            value = afile.get(field)
+            ids = index.get(value)
+            if ids is None:
+                index[value] = file_id
+            elif isinstance(ids, set):
+                ids.add(file_id)
+            elif ids != file_id:
+                index[value] = set((ids, file_id))
+        labels = afile.get('labels') or {}
+        for label in self.INDEXED_LABELS:
+            if labels.get(label):
+                label_index[label].add(file_id)
+
+    def _unindex(self, afile):
+        file_id = afile['id']
+        self._trashed.discard(file_id)
+        if self._label_index is not None:
+            self._unindex_fields(afile)
+        if self._text is not None:
+            self._text.remove(*self._text_entry(afile))
+        if self._date_index is not None:
+            for field, index in self._date_index.iteritems():
+                key = _date_key(afile, field)
+                if key is not None:
+                    index.remove(key, file_id)
+
+    def _unindex_fields(self, afile):
+        file_id = afile['id']
+        for field in self.INDEXED_FIELDS:
+            index = self._field_index[field]
+            value = afile.get(field)
+            ids = index.get(value)
+            if ids == file_id:
+                del index[value]
+            elif isinstance(ids, set):
+                ids.discard(file_id)
+                if len(ids) == 1:
+                    index[value] = ids.pop()
+        for label in self.INDEXED_LABELS:
+            self._label_index[label].discard(file_id)
+
+    def _resource(self, afile, projection=None):
+        """
+        :param projection: a fields.Projection of the fields wanted, None for all of them
+        """
+        file_id = afile.id
+        cache_key = ('file', file_id, self._directory._version(file_id))
+        if projection is not None:
+            # as fields.Projection.apply would key it
+            cache_key = (cache_key, projection.key)
+        return afile.to_dict(Resource(cache_key=cache_key), projection)
+
+    def _ids_with(self, field, value):
+        field_index = self._field_index
+        if field_index is None:
+            field_index = self._indexes()[0]
+        ids = field_index[field].get(value, ())
+        if isinstance(ids, set):
+            return ids
+        return (ids,) if ids else ()
+
+    def _ids_in_date_range(self, field, low=None, high=None, include_low=True, include_high=True):
+        """
+        :param low: the earliest date wanted as a key (see query.date_key), None for no limit
+        :param high: the latest, None for no limit
+        :return: set of the ids of the files with the date in the range
+        """
+        date_index = self._date_index
+        if date_index is None:
+            date_index = self._date_indexes()
+        return set(date_index[field].range(low, high, include_low, include_high))
+
+    def _set_dates(self, afile, dates):
+        """
+        :param dates: date field -> its new value
+        """
+        file_id = afile['id']
+        for field, value in dates.iteritems():
+            index = self._date_index[field] if self._date_index is not None else None
+            if index is not None:
+                key = _date_key(afile, field)
+                if key is not None:
+                    index.remove(key, file_id)
+            afile[field] = value
+            if index is not None:
+                key = _date_key(afile, field)
+                if key is not None:
+                    index.add(key, file_id)
+
+    def _touch(self, fileId):
+        """
+        Move the file's modifiedDate on to now, for a change made through another service
+        """
+        afile = self._files.get(fileId)
+        if afile is not None:
+            self._set_dates(afile, {'modifiedDate': self._directory._now()})
+
+    def _ids_with_label(self, label):
+        if label == 'trashed':
+            return self._trashed
+        label_index = self._label_index
+        if label_index is None:
+            label_index = self._indexes()[1]
+        return label_index[label]
+
+    @projects
+    @reads
+    def list(self, q=None, maxResults=None, pageToken=None, fields=None, **kwargs):
+        """
+        :param fields: the fields.Projection of the parts of the response wanted, None for all of it
+        """
+        projection = _projection(fields)
+        after, limit = _page_args(pageToken, maxResults)
+        if q:
+            try:
+                plan = query.compile_query(q)
+            except query.QueryError as e:
+                raise_400("Invalid Value: %s" % e)
+            items, last = plan.execute(self, after=after, limit=limit)
+        else:
+            items, last = self._files.page(after, limit)
         response = {
             "kind": "drive#fileList",
             "etag": "\"ALmZNavQ1pakoTwofyfJ4wBG6iY/vyGp6PvFo4RvsFtPoIWeCReyIC8\"",
             "selfLink": "https://www.googleapis.com/drive/v2/files?q=trashed+%3D+false",
-            "items": self._files.values()
         }
-        return response
+        _set_next_page(response, last)
+        return project_list(projection, response, items, self._resource)
 
-    def insert(self, body=None, **kwargs):
+    @writes
+    def insert(self, body=None, media_body=None, media_mime_type=None, **kwargs):
+        """
+        :param media_body: a media.Blob with the file's content, for uploads
+        :param media_mime_type: the content's type, used when the body doesn't give a mimeType
+        """
         # todo -- handle error for body
-        response = {
-            "kind": "drive#file",
-            "title": body.get('title'),
-            "description": body.get("description"),
-            "mimeType": body.get("mimeType", "application/octet-stream"),
-            'owners': []
-        }
-        response['id'] = get_a_uuid()
-        self._files[response['id']] = response
-        self._directory.permissions()._set_default_permissions(response)
-        self._directory.parents()._set_default_parent(response)
-        return response
+        if body is None:
+            body = {}
+        labels = DEFAULT_LABELS
+        if body.get('labels'):
+            labels = dict(DEFAULT_LABELS)
+            labels.update(body['labels'])
+        afile = FileRecord()
+        afile.kind = "drive#file"
+        afile.title = body.get('title')
+        afile.description = body.get("description")
+        afile.mimeType = body.get("mimeType", media_mime_type or "application/octet-stream")
+        afile.labels = labels
+        afile.id = get_a_uuid()
+        now = self._directory._now()
+        for field in self.DATE_FIELDS:
+            afile[field] = now
+        self._directory._before_change(afile.id)
+        if media_body is not None:
+            self._set_content(afile, media_body)
+        self._add(afile)
+        self._directory.permissions()._set_default_permissions(afile)
+        self._directory.parents()._set_default_parent(afile.id, body.get('parents'))
+        return self._resource(afile)
 
-    def get(self, fileId=None, **kwargs):
+    @projects
+    @reads
+    def get(self, fileId=None, alt=None, fields=None, **kwargs):
+        """
+        :param alt: "media" for the file's content, as a media.Blob, instead of its metadata
+        :param fields: the fields.Projection of the parts of the file wanted, None for all of it
+        """
         file = self._files.get(fileId)
-        if file:
-            return file
-        else:
+        if not file:
             raise_404(fileId)
+        if alt == 'media':
+            return self._content.get(fileId, media.EMPTY)
+        return self._resource(file, _projection(fields))
 
+    def _subtree(self, fileIds, accept=None):
+        """
+        :param fileIds: ids of the files to start from
+        :param accept: child id -> whether to include it and go into it, None for every child
+        :return: list of the ids of the files and everything in them, each folder before its
+            contents. Costs as much as the files found.
+        """
+        children = self._directory.parents()._children
+        found = list(fileIds)
+        seen = set(found)
+        i = 0
+        while i < len(found):
+            in_folder = children.get(found[i])
+            i += 1
+            if in_folder:
+                for child_id in in_folder.iterkeys():
+                    if child_id not in seen and (accept is None or accept(child_id)):
+                        seen.add(child_id)
+                        found.append(child_id)
+        return found
+
+    def _remove(self, fileIds):
+        """
+        Delete files for good, with what every service keeps for them
+        :param fileIds: every file to go, including whatever is in the folders among them
+        """
+        directory = self._directory
+        # everything is saved for the snapshot before anything changes
+        for file_id in fileIds:
+            directory._before_change(file_id)
+        permissions = directory.permissions()
+        parents = directory.parents()
+        for file_id in fileIds:
+            self._forget(file_id)
+            permissions._forget(file_id)
+            parents._drop_file(file_id)
+
+    def _set_trashed(self, afile, trashed, explicitly=False):
+        """
+        :param explicitly: the file itself was trashed, rather than a folder it is in
+        """
+        # only the trash index has to change, the other labels and the text stay the same
+        if trashed:
+            self._trashed.add(afile['id'])
+        else:
+            self._trashed.discard(afile['id'])
+        labels = dict(afile.get('labels') or DEFAULT_LABELS)
+        labels['trashed'] = trashed
+        # files out of the trash share the default labels again
+        afile['labels'] = DEFAULT_LABELS if labels == DEFAULT_LABELS else labels
+        if trashed:
+            afile['explicitlyTrashed'] = explicitly
+        else:
+            afile.pop('explicitlyTrashed')
+
+    @writes
     def delete(self, fileId=None, **kwargs):
+        """
+        Delete a file for good, skipping the trash. A folder is deleted with everything in it.
+        """
         if fileId not in self._files:
             raise_404(fileId)
-        del self._files[fileId]
+        self._remove(self._subtree([fileId]))
         return {}
 
+    @writes
+    def trash(self, fileId=None, **kwargs):
+        """
+        Move a file to the trash. A folder takes everything in it along.
+        """
+        afile = self._files.get(fileId)
+        if afile is None:
+            raise_404(fileId)
+        trashed = self._trashed
+        file_ids = [file_id for file_id in self._subtree([fileId])
+                    if file_id == fileId or file_id not in trashed]
+        for file_id in file_ids:
+            self._directory._before_change(file_id)
+        for file_id in file_ids:
+            self._set_trashed(self._files[file_id], True, explicitly=file_id == fileId)
+        return self._resource(afile)
+
+    @writes
+    def untrash(self, fileId=None, **kwargs):
+        """
+        Restore a file from the trash, with whatever went to the trash because it did. Files in it
+        that were trashed on their own stay in the trash.
+        """
+        afile = self._files.get(fileId)
+        if afile is None:
+            raise_404(fileId)
+        files = self._files
+        trashed = self._trashed
+        file_ids = [fileId]
+        if fileId in trashed:
+            file_ids = self._subtree([fileId], accept=lambda child_id: child_id in trashed and
+                                     not files[child_id].get('explicitlyTrashed'))
+        for file_id in file_ids:
+            self._directory._before_change(file_id)
+        for file_id in file_ids:
+            if file_id in trashed:
+                self._set_trashed(files[file_id], False)
+        return self._resource(afile)
+
+    @writes
+    def emptyTrash(self, **kwargs):
+        """
+        Delete every file in the trash for good, with everything in the folders among them
+        """
+        self._remove(self._subtree(list(self._trashed)))
+        return {}
+
+    @writes
+    def patch(self, fileId=None, body=None, setModifiedDate=False, updateViewedDate=True, **kwargs):
+        """
+        Change some of a file's metadata. The labels given are set on top of the file's own, and
+        labels.trashed moves the file to or from the trash the way trash and untrash do.
+        :param setModifiedDate: take the modifiedDate from the body rather than making it now
+        :param updateViewedDate: make lastViewedByMeDate now too
+        """
+        afile = self._files.get(fileId)
+        if afile is None:
+            raise_404(fileId)
+        body = body or {}
+        labels = dict(body.get('labels') or {})
+        trashed = labels.pop('trashed', None)
+        self._directory._before_change(fileId)
+        self._unindex(afile)
+        for key in self.PATCHABLE_FIELDS:
+            if key in body:
+                afile[key] = body[key]
+        if labels:
+            merged = dict(afile.get('labels') or DEFAULT_LABELS)
+            merged.update(labels)
+            afile['labels'] = DEFAULT_LABELS if merged == DEFAULT_LABELS else merged
+        now = self._directory._now()
+        if setModifiedDate not in (False, 'false') and body.get('modifiedDate'):
+            afile['modifiedDate'] = body['modifiedDate']
+        else:
+            afile['modifiedDate'] = now
+        if updateViewedDate not in (False, 'false'):
+            afile['lastViewedByMeDate'] = now
+        self._index(afile)
+        if trashed is not None and bool(trashed) != (fileId in self._trashed):
+            if trashed:
+                return self.trash(fileId)
+            return self.untrash(fileId)
+        return self._resource(afile)
+
+    @writes
     def copy(self, fileId=None, body=None, **kwargs):
         if fileId not in self._files:
             raise_404(fileId)
-        file_copy = self._files[fileId].copy()
+        file_copy = self._files[fileId].to_dict()
         if body:
             for key in body.keys():
                 file_copy[key] = body[key]
-        return self.insert(body=file_copy)
+        # the copy goes in the root folder, so it can't be trashed along with a folder and isn't
+        # created in the trash, whatever the original was
+        if file_copy.get('labels', {}).get('trashed'):
+            file_copy['labels'] = dict(file_copy['labels'], trashed=False)
+        file_copy.pop('explicitlyTrashed', None)
+        # content never changes in place, so the copy can share it
+        return self.insert(body=file_copy, media_body=self._content.get(fileId))
 
     def request(self, path, method='GET', **kwargs):
         """
@@ -127,12 +694,16 @@ class FilesService(object):
 
 class PermissionsService(object):
 
-    def __init__(self, files=None, directory=None):
+    ROLES = ('owner', 'writer', 'reader')
+
+    def __init__(self, directory=None):
         self._directory = directory
+        # file id -> its permissions, keyed by permission id
         self._permissions = {}
-        files = files or []
-        for afile in files:
-            self._set_default_permissions(afile)
+        # (principal, role) -> {file id: number of permissions granting it}
+        self._by_principal = {}
+        # permissions of files that only have the default owner, shared between them
+        self._default_perms = None
 
     @property
     def path(self):
@@ -143,65 +714,194 @@ class PermissionsService(object):
         return "permissions"
 
     def _set_default_permissions(self, afile):
-        default_owner_perm = {
-               "kind": "drive#permission",
-               "etag": "Lie3Y624-6bAlCGsnUSYyb6P-dU/k6w2imYTYLSrsTHqeiu6HpWiCVQ",
-               "id": "11519106257625907838",
-               "name": "Test User",
-               "emailAddress": self._directory._user_email,
-               "domain": "testers.com",
-               "role": "owner",
-               "type": "user",
-        }
+        """
+        Make the directory's user the owner of a new file
+        """
+        _add_default_owners(afile, self._directory._default_owners())
+        self._set_default_permissions_batch([afile['id']])
 
-        default_perms = [ default_owner_perm ]
-        self._permissions[afile['id']] = default_perms
-        owner_data = {
-              "kind": "drive#user",
-              "displayName": "Test User",
-              "picture": {
-                "url": "http://stub"
-              },
-              "isAuthenticatedUser": True,
-              "permissionId": default_owner_perm['id'],
-              "emailAddress": self._directory._user_email
-        }
-        if 'owners' not in afile:
-            afile['owners'] = []
-        afile['owners'].append(owner_data)
+    def _set_default_permissions_batch(self, file_ids):
+        """
+        Give each file the default owner's permission. All of the files share one set of
+        permissions until something changes them. The owners on the files are set apart, see
+        _add_default_owners.
+        """
+        default_perms = self._default_store()
+        owner_ids = self._by_principal.setdefault((principal(default_perms.values()[0]), 'owner'), {})
+        all_perms = self._permissions
+        for file_id in file_ids:
+            all_perms[file_id] = default_perms
+            owner_ids[file_id] = owner_ids.get(file_id, 0) + 1
+
+    def _index_fixtures(self, file_ids, fixture_perms):
+        """
+        Take in files loaded from a fixture, see ServiceDirectory._add_batch
+        :param fixture_perms: file id -> the fixture's permissions, for the files that gave them.
+            The others only have the default owner.
+        """
+        defaults = []
+        for file_id in file_ids:
+            perms = fixture_perms.get(file_id)
+            if perms is None:
+                defaults.append(file_id)
+            else:
+                self._add_permissions(file_id, perms)
+        self._set_default_permissions_batch(defaults)
 
+    def _default_store(self):
+        """
+        :return: the permissions shared by files that only have the default owner
+        """
+        if self._default_perms is None:
+            default_owner_perm, owner_data = _default_owner(self._directory._user_email)
+            self._default_perms = OrderedStore([(default_owner_perm['id'], default_owner_perm)])
+        return self._default_perms
+
+    def _writable(self, fileId):
+        """
+        :return: the file's permissions, first giving it its own copy if they are the shared defaults
+        """
+        perms = self._permissions[fileId]
+        if perms is self._default_perms:
+            perms = self._permissions[fileId] = perms.copy()
+        return perms
+
+    def _add_permissions(self, fileId, permissions):
+        """
+        Give a file the permissions from a fixture instead of the default ones
+        """
+        perms = self._permissions[fileId] = OrderedStore()
+        for permission in permissions:
+            permission = dict(permission)
+            permission.setdefault('kind', "drive#permission")
+            if 'id' not in permission:
+                permission['id'] = permission.get('emailAddress') or permission.get('domain') or 'anyone'
+            perms[permission['id']] = permission
+            self._index(fileId, permission)
+
+    def _index(self, fileId, permission):
+        key = (principal(permission), permission['role'])
+        file_ids = self._by_principal.get(key)
+        if file_ids is None:
+            file_ids = self._by_principal[key] = {}
+        file_ids[fileId] = file_ids.get(fileId, 0) + 1
+
+    def _unindex(self, fileId, permission):
+        key = (principal(permission), permission['role'])
+        file_ids = self._by_principal.get(key)
+        if file_ids is None or fileId not in file_ids:
+            return
+        file_ids[fileId] -= 1
+        if not file_ids[fileId]:
+            del file_ids[fileId]
+            if not file_ids:
+                del self._by_principal[key]
+
+    def _export(self, fileId):
+        perms = self._permissions.get(fileId)
+        if perms is None:
+            return None
+        return [dict(permission) for permission in perms.itervalues()]
+
+    def _import(self, fileId, state):
+        default_perms = self._default_store()
+        if state == default_perms.values():
+            self._permissions[fileId] = default_perms
+            self._index(fileId, state[0])
+            return
+        perms = self._permissions[fileId] = OrderedStore()
+        for permission in state:
+            permission = dict(permission)
+            perms[permission['id']] = permission
+            self._index(fileId, permission)
+
+    def _forget(self, fileId):
+        perms = self._permissions.pop(fileId, None)
+        if perms is not None:
+            for permission in perms.itervalues():
+                self._unindex(fileId, permission)
+
+    def _resource(self, fileId, permission):
+        return Resource(permission, ('permission', fileId, self._directory._version(fileId), permission['id']))
+
+    def _file_ids_for(self, principal, role=None):
+        """
+        :param principal: an email address, a domain or "anyone"
+        :param role: only files where the principal has this role, or None for any role
+        :return: collection of ids of the files shared directly with the principal
+        """
+        principal = principal.lower()
+        if role is not None:
+            return self._by_principal.get((principal, role), {})
+        file_ids = set()
+        for role in self.ROLES:
+            file_ids.update(self._by_principal.get((principal, role), ()))
+        return file_ids
+
+    def _visible_file_ids(self, email):
+        """
+        :return: set of ids of every file the user can open, whether it was shared with them,
+                 with their domain or with anyone
+        """
+        file_ids = self._file_ids_for(email)
+        if '@' in email:
+            file_ids.update(self._file_ids_for(email.split('@', 1)[1]))
+        file_ids.update(self._file_ids_for('anyone'))
+        return file_ids
+
+    def _shared_with_me_ids(self):
+        email = (self._directory._user_email or '').lower()
+        file_ids = set()
+        for role in self.ROLES:
+            if role != 'owner':
+                file_ids.update(self._by_principal.get((email, role), ()))
+        return file_ids
+
+    def _has_role(self, fileId, email, role):
+        return fileId in self._by_principal.get((email.lower(), role), ())
+
+    def _is_shared_with_me(self, fileId):
+        email = (self._directory._user_email or '').lower()
+        for role in self.ROLES:
+            if role != 'owner' and fileId in self._by_principal.get((email, role), ()):
+                return True
+        return False
+
+    @reads
     def get(self, fileId=None, permissionId=None, **kwargs):
         if fileId not in self._permissions:
             raise_404(fileId)
-        perms = self._permissions[fileId]
-        for permission in perms:
-            if permission['id'] == permissionId:
-                return permission
+        permission = self._permissions[fileId].get(permissionId)
+        if permission:
+            return self._resource(fileId, permission)
         raise_404(fileId, msg="Permission not found: %s" % permissionId)
 
+    @writes
     def delete(self, fileId=None, permissionId=None):
         if fileId not in self._permissions:
             raise_404(fileId)
-        perms = self._permissions[fileId]
-        found = None
-        for permission in perms:
-            if permission['id'] == permissionId:
-                found = perms.remove(permission)
-                break
-        if found:
-            perms.remove(found)
+        self._directory._before_change(fileId)
+        permission = self._writable(fileId).pop(permissionId, None)
+        if permission is not None:
+            self._unindex(fileId, permission)
+            self._directory.files()._touch(fileId)
         return {}
 
-    def list(self, fileId=None, **kwargs):
+    @reads
+    def list(self, fileId=None, maxResults=None, pageToken=None, **kwargs):
         if fileId not in self._permissions:
             raise_404(fileId)
+        after, limit = _page_args(pageToken, maxResults, default_size=None)
+        items, last = self._permissions[fileId].page(after, limit)
         response = {
             "kind": "drive#permissionList",
             "etag": "AFakeETag",
-            "items": self._permissions[fileId]
+            "items": [self._resource(fileId, permission) for permission in items]
         }
+        _set_next_page(response, last)
         return response
 
+    @reads
     def getIdForEmail(self, email=None, **kwargs):
         response = {
             "kind": "drive#permissionId",
@@ -209,6 +909,7 @@ class PermissionsService(object):
         }
         return response
 
+    @writes
     def insert(self, fileId=None, body=None, **kwargs):
         if fileId not in self._permissions:
             raise_404(fileId)
@@ -234,8 +935,14 @@ class PermissionsService(object):
                "type": body['type'],
             }
 
-        self._permissions[fileId].append(perm)
-        return perm
+        self._directory._before_change(fileId)
+        perms = self._writable(fileId)
+        if perm['id'] in perms:
+            self._unindex(fileId, perms[perm['id']])
+        perms[perm['id']] = perm
+        self._index(fileId, perm)
+        self._directory.files()._touch(fileId)
+        return self._resource(fileId, perm)
 
     def request(self, path, method='GET', **kwargs):
         """
@@ -254,13 +961,14 @@ class PermissionsService(object):
 
 class ParentsService(object):
 
-    def __init__(self, files=None, directory=None):
-        # TODO -- add a way to pass in parent fixtures
+    def __init__(self, directory=None):
         self._directory = directory
+        # file id -> ids of its parents. The parentReferences are built when they are asked for.
         self._parents = {}
-        files = files or []
-        for afile in files:
-            self._set_default_parent(afile)
+        # shared by every file that is only in the root folder, see _writable
+        self._root_only = OrderedStore([(ROOT_FOLDER_ID, ROOT_FOLDER_ID)])
+        # parent id -> ids of the files in it, the reverse of _parents
+        self._children = {}
 
     @property
     def path(self):
@@ -270,53 +978,166 @@ class ParentsService(object):
     def name(self):
         return "parents"
 
-    def _set_default_parent(self, a_file):
-        default_parents = {
+    def _set_default_parent(self, file_id, parents=None):
+        """
+        Files go in the root folder unless they say which folders they are in
+        :param parents: the file's parentReferences
+        """
+        if not parents:
+            self._parents[file_id] = self._root_only
+            self._add_child(ROOT_FOLDER_ID, file_id)
+            return
+        self._parents[file_id] = OrderedStore()
+        for parent in parents:
+            self._link(file_id, parent['id'])
+
+    def _index_fixtures(self, file_ids, fixture_parents):
+        """
+        Take in files loaded from a fixture, in the order they were loaded, see ServiceDirectory._add_batch
+        :param fixture_parents: file id -> the fixture's parentReferences, for the files that gave them.
+            The others are in the root folder.
+        """
+        for file_id in file_ids:
+            self._set_default_parent(file_id, fixture_parents.get(file_id))
+
+    def _parent_reference(self, fileId, parentId):
+        # made from the two ids alone, so they are all the cache key needs
+        return Resource({
            "kind": "drive#parentReference",
-           "id": "ROOT_FOLDER_ID",
-           "selfLink": "https://www.googleapis.com/drive/v2/files/%(fileId)s/parents/ROOT_FOLDER_ID" %
-                       {'fileId': a_file['id']},
-           "parentLink": "https://www.googleapis.com/drive/v2/files/ROOT_FOLDER_ID",
-           "isRoot": True
-          }
-        self._parents[a_file['id']] = [default_parents]
-
-    def list(self, fileId=None, **kwargs):
+           "id": parentId,
+           "selfLink": "https://www.googleapis.com/drive/v2/files/%(fileId)s/parents/%(parentId)s" %
+                       {'fileId': fileId, 'parentId': parentId},
+           "parentLink": "https://www.googleapis.com/drive/v2/files/%s" % parentId,
+           "isRoot": parentId == ROOT_FOLDER_ID
+        }, ('parent', fileId, parentId))
+
+    def _writable(self, fileId):
+        """
+        :return: the file's parent ids, first giving it its own copy if it shares the root-only store
+        """
+        parents = self._parents[fileId]
+        if parents is self._root_only:
+            parents = self._parents[fileId] = parents.copy()
+        return parents
+
+    def _add_child(self, parentId, fileId):
+        children = self._children.get(parentId)
+        if children is None:
+            children = self._children[parentId] = OrderedStore()
+        children[fileId] = fileId
+
+    def _link(self, fileId, parentId):
+        """
+        :return: the parentReference
+        """
+        if parentId == 'root':
+            parentId = ROOT_FOLDER_ID
+        if parentId not in self._parents[fileId]:
+            self._writable(fileId)[parentId] = parentId
+            self._add_child(parentId, fileId)
+        return self._parent_reference(fileId, parentId)
+
+    def _unlink(self, fileId, parentId):
+        if parentId == 'root':
+            parentId = ROOT_FOLDER_ID
+        if parentId not in self._parents[fileId]:
+            return False
+        self._writable(fileId).pop(parentId)
+        children = self._children.get(parentId)
+        if children is not None:
+            children.pop(fileId, None)
+            if not children:
+                del self._children[parentId]
+        return True
+
+    def _export(self, fileId):
+        parents = self._parents.get(fileId)
+        if parents is None:
+            return None
+        # remember where the file was in each folder as well, so folder listings keep their order
+        return [(parent_id, self._children[parent_id].seq(fileId)) for parent_id in parents]
+
+    def _import(self, fileId, state):
+        if [parent_id for parent_id, seq in state] == [ROOT_FOLDER_ID]:
+            self._parents[fileId] = self._root_only
+        else:
+            self._parents[fileId] = OrderedStore((parent_id, parent_id) for parent_id, seq in state)
+        for parent_id, seq in state:
+            children = self._children.get(parent_id)
+            if children is None:
+                children = self._children[parent_id] = OrderedStore()
+            children.put_at(fileId, fileId, seq)
+
+    def _forget(self, fileId):
+        """
+        Take the file out of its parents. Files inside it are left alone.
+        """
+        parents = self._parents.pop(fileId, None)
+        if parents is not None:
+            for parent_id in parents.keys():
+                children = self._children.get(parent_id)
+                if children is not None:
+                    children.pop(fileId, None)
+                    if not children:
+                        del self._children[parent_id]
+
+    def _drop_file(self, fileId):
+        """
+        Forget a deleted file: take it out of its parents and forget what was in it. Whatever
+        was in it is deleted along with it, see FilesService.delete.
+        """
+        self._forget(fileId)
+        self._children.pop(fileId, None)
+
+    def _children_ids(self, parentId):
+        if parentId == 'root':
+            parentId = ROOT_FOLDER_ID
+        return self._children.get(parentId, ())
+
+    def _has_parent(self, fileId, parentId):
+        if parentId == 'root':
+            parentId = ROOT_FOLDER_ID
+        return parentId in self._parents.get(fileId, ())
+
+    @reads
+    def list(self, fileId=None, maxResults=None, pageToken=None, **kwargs):
         if fileId not in self._parents:
             raise_404(fileId)
+        after, limit = _page_args(pageToken, maxResults, default_size=None)
+        parent_ids, last = self._parents[fileId].page(after, limit)
         response = {
              "kind": "drive#parentList",
-            "items": self._parents[fileId]
+            "items": [self._parent_reference(fileId, parent_id) for parent_id in parent_ids]
         }
+        _set_next_page(response, last)
         return response
 
-    def insert(self, fileId=None, body=None, **kwargs):
+    @reads
+    def get(self, fileId=None, parentId=None, **kwargs):
         if fileId not in self._parents:
             raise_404(fileId)
-        # don't add something twice
-        for parent in self._parents[fileId]:
-            if parent['id'] == body['id']:
-                return parent
+        if parentId == 'root':
+            parentId = ROOT_FOLDER_ID
+        if parentId not in self._parents[fileId]:
+            raise_404(fileId, msg="Parent not found: %s" % parentId)
+        return self._parent_reference(fileId, parentId)
 
-        parent_data = {
-           "kind": "drive#parentReference",
-           "id": body['id'],
-           "selfLink": "https://www.googleapis.com/drive/v2/files/%(fileId)s/parents/%(parentId)s" %
-                       {'fileId': fileId, 'parentId': body['id']},
-           "parentLink": "https://www.googleapis.com/drive/v2/files/%s" % body['id'],
-           "isRoot": False
-        }
-        self._parents[fileId].append(parent_data)
-        return parent_data
+    @writes
+    def insert(self, fileId=None, body=None, **kwargs):
+        if fileId not in self._parents:
+            raise_404(fileId)
+        self._directory._before_change(fileId)
+        self._directory.files()._touch(fileId)
+        # _link won't add something twice
+        return self._link(fileId, body['id'])
 
+    @writes
     def delete(self, fileId=None, parentId=None, **kwargs):
         if fileId not in self._parents:
             raise_404(fileId)
-        parents = self._parents[fileId]
-        for parent in parents:
-            if parent['id'] == parentId:
-                parents.remove(parent)
-                break
+        self._directory._before_change(fileId)
+        self._directory.files()._touch(fileId)
+        self._unlink(fileId, parentId)
         return {}
 
     def request(self, path, method='GET', **kwargs):
@@ -330,16 +1151,534 @@ class ParentsService(object):
         else:
             raise Exception("no method for path: %s" % path)
 
+
+class ChildrenService(object):
+    """
+    Folder contents, answered from the parents service's parent -> children index
+    """
+
+    def __init__(self, directory=None):
+        self._directory = directory
+
+    @property
+    def path(self):
+        return "children"
+
+    @property
+    def name(self):
+        return "children"
+
+    def _folder_id(self, folderId):
+        if folderId == 'root':
+            return ROOT_FOLDER_ID
+        if folderId != ROOT_FOLDER_ID and folderId not in self._directory.files()._files:
+            raise_404(folderId)
+        return folderId
+
+    def _child_reference(self, folderId, childId):
+        return Resource({
+            "kind": "drive#childReference",
+            "id": childId,
+            "selfLink": "https://www.googleapis.com/drive/v2/files/%(folderId)s/children/%(childId)s" %
+                        {'folderId': folderId, 'childId': childId},
+            "childLink": "https://www.googleapis.com/drive/v2/files/%s" % childId
+        }, ('child', folderId, childId))
+
+    @reads
+    def list(self, folderId=None, q=None, maxResults=None, pageToken=None, **kwargs):
+        folderId = self._folder_id(folderId)
+        after, limit = _page_args(pageToken, maxResults)
+        children = self._directory.parents()._children.get(folderId) or OrderedStore()
+        accept = None
+        if q:
+            try:
+                plan = query.compile_query(q)
+            except query.QueryError as e:
+                raise_400("Invalid Value: %s" % e)
+            files = self._directory.files()
+            accept = lambda childId: childId in files._files and plan.match(files._files[childId], files)
+        ids, last = children.page(after, limit, accept=accept)
+        response = {
+            "kind": "drive#childList",
+            "etag": "AFakeETag",
+            "selfLink": "https://www.googleapis.com/drive/v2/files/%s/children" % folderId,
+            "items": [self._child_reference(folderId, childId) for childId in ids]
+        }
+        _set_next_page(response, last)
+        return response
+
+    @reads
+    def get(self, folderId=None, childId=None, **kwargs):
+        folderId = self._folder_id(folderId)
+        if not self._directory.parents()._has_parent(childId, folderId):
+            raise_404(childId, msg="Child not found: %s" % childId)
+        return self._child_reference(folderId, childId)
+
+    @writes
+    def insert(self, folderId=None, body=None, **kwargs):
+        folderId = self._folder_id(folderId)
+        self._directory.parents().insert(fileId=body['id'], body={'id': folderId})
+        return self._child_reference(folderId, body['id'])
+
+    @writes
+    def delete(self, folderId=None, childId=None, **kwargs):
+        folderId = self._folder_id(folderId)
+        self._directory.parents().delete(fileId=childId, parentId=folderId)
+        return {}
+
+
+class ChangesService(object):
+    """
+    The changes feed. Every change to a file gets the next change id, which is also the file's
+    version (see ServiceDirectory._changed). The log keeps one entry per file, for its latest
+    change, in change id order: Drive only reports the latest change to each file, so older
+    entries are dropped as they are superseded and reading from a cursor costs as much as the
+    changes after it.
+
+    Entries for deleted files are kept until there are more than max_deleted of them, then the
+    oldest are dropped. A client reading from before the last dropped one may miss deletions.
+    Files loaded from a fixture have no change until they are first changed.
+    """
+
+    # deleted files the log remembers before it starts forgetting the oldest
+    MAX_DELETED = 100000
+
+    def __init__(self, directory=None):
+        self._directory = directory
+        # file id -> file id, at the sequence number of its latest change
+        self._log = OrderedStore()
+        self._largest = 0
+        # change ids up to this one may have been dropped from the log
+        self._horizon = 0
+        self.max_deleted = self.MAX_DELETED
+
+    @property
+    def path(self):
+        return "changes"
+
+    @property
+    def name(self):
+        return "changes"
+
+    def _record(self, fileId):
+        """
+        :return: the new change id
+        """
+        self._largest += 1
+        self._log.put_at(fileId, fileId, self._largest)
+        if len(self._log) > len(self._directory.files()._files) + self.max_deleted:
+            self._drop_deleted()
+        return self._largest
+
+    def _reset(self):
+        """
+        Start the feed again from nothing, as it is for a directory fresh from its fixture
+        """
+        self._log = OrderedStore()
+        self._largest = 0
+        self._horizon = 0
+
+    def _change_id(self, fileId):
+        """
+        :return: id of the latest change to the file, 0 if it hasn't changed
+        """
+        log = self._log
+        return log.seq(fileId) if fileId in log else 0
+
+    def _drop_deleted(self):
+        """
+        Forget the oldest deleted files until half of max_deleted are left
+        """
+        files = self._directory.files()._files
+        deleted = [file_id for file_id in self._log.iterkeys() if file_id not in files]
+        for file_id in deleted[:len(deleted) - self.max_deleted // 2]:
+            self._horizon = max(self._horizon, self._log.seq(file_id))
+            del self._log[file_id]
+        # the versions of the dropped files go back to 0, which responses cached before their
+        # first change were keyed by. A file loaded again with one of their ids mustn't get those.
+        self._directory.response_cache().clear()
+
+    def _change(self, fileId, change_id):
+        files = self._directory.files()
+        afile = files._files.get(fileId)
+        change = Resource({
+            "kind": "drive#change",
+            "id": str(change_id),
+            "fileId": fileId,
+            "selfLink": "https://www.googleapis.com/drive/v2/changes/%d" % change_id,
+            "deleted": afile is None
+        }, ('change', change_id))
+        if afile is not None:
+            change['file'] = files._resource(afile)
+        return change
+
+    @reads
+    def list(self, startChangeId=None, includeDeleted=True, maxResults=None, pageToken=None, **kwargs):
+        """
+        :param startChangeId: the first change id to return; ignored when there is a pageToken
+        """
+        after, limit = _page_args(pageToken, maxResults)
+        if after is None and startChangeId not in (None, ''):
+            try:
+                after = int(startChangeId) - 1
+            except ValueError:
+                raise_400("Invalid startChangeId: %s" % startChangeId)
+        accept = None
+        if includeDeleted in (False, 'false'):
+            files = self._directory.files()._files
+            accept = lambda file_id: file_id in files
+        file_ids, last = self._log.page(after, limit, accept=accept)
+        response = {
+            "kind": "drive#changeList",
+            "etag": "\"ALmZNavQ1pakoTwofyfJ4wBG6iY/changes\"",
+            "selfLink": "https://www.googleapis.com/drive/v2/changes",
+            "largestChangeId": str(self._largest),
+            "items": [self._change(file_id, self._log.seq(file_id)) for file_id in file_ids]
+        }
+        _set_next_page(response, last)
+        return response
+
+    @reads
+    def get(self, changeId=None, **kwargs):
+        try:
+            change_id = int(changeId)
+        except (TypeError, ValueError):
+            change_id = None
+        file_id = self._log.key_at(change_id) if change_id is not None else None
+        if file_id is None:
+            raise_404(changeId, msg="Change not found: %s" % changeId)
+        return self._change(file_id, change_id)
+
+
+class Snapshot(object):
+    """
+    Returned by ServiceDirectory.snapshot(). Holds a copy of each file as it was when the
+    snapshot was taken, made just before the file was first changed afterwards.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        # file id -> state from ServiceDirectory._export, None for files that didn't exist
+        self._saved = {}
+
+    @property
+    def changed(self):
+        """
+        :return: number of files changed since the snapshot was taken or last restored
+        """
+        return len(self._saved)
+
+
 class ServiceDirectory(object):
 
-    def __init__(self, files=None, user_email="test@drivetestbed.org"):
+    # services that keep state for each file, in the order it has to be put back
+    PER_FILE_SERVICES = ('files', 'permissions', 'parents')
+    # service name, which is also its path -> its class. Each is made the first time it is used.
+    SERVICES = {
+        'files': FilesService,
+        'permissions': PermissionsService,
+        'parents': ParentsService,
+        'children': ChildrenService,
+        'changes': ChangesService,
+    }
+
+    def __init__(self, files=None, user_email="test@drivetestbed.org", backend=None, throttle=None, clock=None):
+        """
+        :param files: fixture records to start with
+        :param backend: where to keep the data, see drivetestbed.backends. The default keeps it
+            in this directory only.
+        :param throttle: a drivetestbed.throttle.Throttle to rate limit and delay calls made
+            through TestbedHttp, None to answer them all at once
+        :param clock: what the files' dates are read from, a drivetestbed.throttle.RealClock or
+            VirtualClock. The throttle's clock if there is a throttle, otherwise the real one.
+        """
         self._path_map = {}
         self._name_map = {}
         self._user_email = user_email
-        for cls in [FilesService, PermissionsService, ParentsService]:
-            serv = cls(files=files, directory=self)
-            self._path_map[serv.path] = serv
-            self._name_map[serv.name] = serv
+        self._snapshot = None
+        # writers have the whole directory to themselves, see drivetestbed.locking
+        self._lock = ReadWriteLock()
+        self._backend = backend or DictBackend()
+        # ids of the files changed by the current write, when the backend needs to know
+        self._dirty = None
+        self._response_cache = ResponseCache()
+        self._uploads = media.Uploads()
+        self._metrics = Metrics()
+        self._throttle = throttle
+        if clock is None:
+            if throttle is not None:
+                clock = throttle.clock
+            else:
+                from drivetestbed.throttle import RealClock
+                clock = RealClock()
+        self._clock = clock
+        # (resource, action) -> the bound method that answers it, filled in as calls arrive
+        self._handlers = {}
+        # held while a service is made, see _construct
+        self._services_lock = threading.RLock()
+        # service name -> [(file ids, {file id: fixture data})] of fixture files loaded before the
+        # service was made, for it to take in when it is
+        self._pending = {}
+        self._owners = None
+        self._backend.attach(self, files)
+
+    def _load(self, files):
+        """
+        Add fixture files with their default permissions and parents, in one pass.
+        The dicts are copied, the caller's are left as they are.
+        """
+        if files:
+            loader.load_records(self, files)
+
+    def load(self, source, format=None, use_mmap=False, batch_size=loader.DEFAULT_BATCH_SIZE):
+        """
+        Stream fixture files from disk into the directory, see drivetestbed.loader
+        :param source: path or open file holding NDJSON or a JSON array of Drive file resources
+        :return: loader.LoadStats
+        """
+        return loader.load(self, source, format=format, use_mmap=use_mmap, batch_size=batch_size)
+
+    def _reading(self):
+        """
+        :return: context manager for a read, caught up with the backend first
+        """
+        backend = self._backend
+        if backend.shared and not self._lock.held() and backend.stale():
+            with self._lock.writing():
+                backend.refresh(self)
+        return self._lock.reading()
+
+    def _writing(self):
+        """
+        :return: context manager for a change, which is committed to the backend when it ends
+        """
+        if self._backend.shared:
+            return self._shared_writing()
+        return self._lock.writing()
+
+    @contextmanager
+    def _shared_writing(self):
+        with self._lock.writing():
+            if self._dirty is not None:
+                # inside another write, which commits for both
+                yield
+                return
+            self._dirty = set()
+            try:
+                self._backend.begin(self)
+                try:
+                    yield
+                except BaseException:
+                    self._backend.rollback(self, self._dirty)
+                    raise
+                self._backend.commit(self, self._dirty)
+            finally:
+                self._dirty = None
+
+    def _add_batch(self, records):
+        """
+        Add a batch of fixture records. A record is a Drive file resource, and may carry its
+        "permissions" and "parents"; files without them get the defaults. The files are stored
+        now, their permissions and parents are handed to those services when they are first
+        used, see _index_fixtures.
+
+        A record with the id of a file the directory already has replaces that file, with
+        everything that belonged to it.
+        """
+        files_service = self.files()
+        default_owners = self._default_owners()
+        file_ids = []
+        fixture_perms = {}
+        fixture_parents = {}
+        replaced = False
+        with self._writing():
+            for record in records:
+                afile = FileRecord(record)
+                if 'id' not in afile:
+                    afile['id'] = get_a_uuid()
+                file_id = afile['id']
+                if file_id in files_service._files:
+                    # moves the file's version on, so responses cached for the old one aren't served
+                    self._before_change(file_id)
+                    # it may have been loaded earlier in this batch, and not handed on yet
+                    fixture_perms.pop(file_id, None)
+                    fixture_parents.pop(file_id, None)
+                    replaced = True
+                    for name in self.PER_FILE_SERVICES:
+                        # making a service takes in what's pending for it, so that is dropped too
+                        self.for_name(name)._forget(file_id)
+                elif self._snapshot is not None or self._dirty is not None:
+                    self._before_change(file_id)
+                # parents and permissions live in their own services, not on the file
+                perms = afile.pop('permissions', None)
+                if perms is None:
+                    _add_default_owners(afile, default_owners)
+                else:
+                    fixture_perms[file_id] = perms
+                parents = afile.pop('parents', None)
+                if parents:
+                    fixture_parents[file_id] = parents
+                files_service._add(afile)
+                file_ids.append(file_id)
+            if replaced:
+                # a file loaded twice in the batch is handed on once, where it was loaded last
+                seen = set()
+                file_ids = [file_id for file_id in reversed(file_ids) if not (file_id in seen or seen.add(file_id))]
+                file_ids.reverse()
+            self._index_fixtures('permissions', file_ids, fixture_perms)
+            self._index_fixtures('parents', file_ids, fixture_parents)
+        return len(records)
+
+    def _index_fixtures(self, name, file_ids, fixture_data):
+        """
+        Give a service the fixture files just loaded, or keep them for it if it hasn't been made yet
+        """
+        with self._services_lock:
+            service = self._name_map.get(name)
+            if service is None:
+                self._pending.setdefault(name, []).append((file_ids, fixture_data))
+                return
+        service._index_fixtures(file_ids, fixture_data)
+
+    def _now(self):
+        """
+        :return: the clock's time as a Drive date
+        """
+        return query.format_date(self._clock.now())
+
+    def _default_owners(self):
+        """
+        :return: the owners list shared by every file that only has the directory's user as owner
+        """
+        if self._owners is None:
+            self._owners = [_default_owner(self._user_email)[1]]
+        return self._owners
+
+    def _before_change(self, fileId):
+        """
+        Called by the services before they change anything belonging to a file
+        """
+        self._changed(fileId)
+        if self._dirty is not None:
+            self._dirty.add(fileId)
+        snapshot = self._snapshot
+        if snapshot is not None and fileId not in snapshot._saved:
+            snapshot._saved[fileId] = self._export(fileId)
+
+    def _changed(self, fileId):
+        """
+        Log a change to the file in the changes feed, which moves its version on
+        """
+        self.for_name('changes')._record(fileId)
+
+    def _version(self, fileId):
+        """
+        :return: a number that changes whenever anything belonging to the file changes, the id
+            of its latest change. Never reused.
+        """
+        return self.for_name('changes')._change_id(fileId)
+
+    def response_cache(self):
+        """
+        :return: the ResponseCache used to encode this directory's responses
+        """
+        return self._response_cache
+
+    def metrics(self):
+        """
+        :return: the Metrics of the Drive calls made to this directory through TestbedHttp
+        """
+        return self._metrics
+
+    def throttle(self):
+        """
+        :return: the Throttle in front of this directory's calls, None if there isn't one
+        """
+        return self._throttle
+
+    def set_throttle(self, throttle):
+        """
+        :param throttle: a drivetestbed.throttle.Throttle, or None to stop throttling
+        """
+        self._throttle = throttle
+
+    def uploads(self):
+        """
+        :return: the media.Uploads holding this directory's resumable uploads in progress
+        """
+        return self._uploads
+
+    def _export(self, fileId):
+        files = self.files()
+        if fileId not in files._files:
+            return None
+        state = dict((name, self.for_name(name)._export(fileId)) for name in self.PER_FILE_SERVICES)
+        # the Blob itself, content is never changed in place
+        state['content'] = files._content.get(fileId)
+        return state
+
+    def _import_file(self, fileId, state, changed=True):
+        """
+        :param state: from _export
+        :param changed: False when filling an empty directory, which has no versions to move on
+        """
+        if changed:
+            self._changed(fileId)
+        # the content goes first, the files service indexes the words in it
+        if state.get('content') is not None:
+            self.files()._content[fileId] = state['content']
+        for name in self.PER_FILE_SERVICES:
+            self.for_name(name)._import(fileId, state[name])
+
+    def _forget_file(self, fileId):
+        self._changed(fileId)
+        for name in self.PER_FILE_SERVICES:
+            self.for_name(name)._forget(fileId)
+
+    def snapshot(self):
+        """
+        Remember the current state so that restore() can return to it. Nothing is copied up
+        front: each file is copied the first time it is about to change.
+        Only one snapshot is kept, taking a new one replaces the last.
+        :return: the Snapshot to pass to restore()
+        """
+        with self._writing():
+            self._snapshot = Snapshot(self)
+            return self._snapshot
+
+    def restore(self, snapshot):
+        """
+        Undo every change made since the snapshot was taken or last restored, in time
+        proportional to the number of files changed. The snapshot stays valid.
+        :param snapshot: the directory's current snapshot
+        """
+        with self._writing():
+            if snapshot is not self._snapshot:
+                raise ValueError("Not the current snapshot of this directory")
+            saved = snapshot._saved
+            if self._dirty is not None:
+                self._dirty.update(saved)
+            # don't record the restore itself
+            self._snapshot = None
+            try:
+                for fileId in saved:
+                    self._forget_file(fileId)
+                for fileId, state in saved.iteritems():
+                    if state is not None:
+                        self._import_file(fileId, state)
+            finally:
+                snapshot._saved = {}
+                self._snapshot = snapshot
+
+    def reset_changes(self):
+        """
+        Empty the changes feed, so that a directory put back with restore() looks as it did when it
+        was first loaded. Change ids, and so file versions, start again from 1, so the encoded
+        responses cached under the old ones are dropped too.
+        """
+        with self._writing():
+            self.for_name('changes')._reset()
+            self._response_cache.clear()
 
     def add_mapping(self, service, path):
         """
@@ -359,11 +1698,64 @@ class ServiceDirectory(object):
     def parents(self):
         return self.for_path('parents')
 
+    def changes(self):
+        return self.for_path('changes')
+
+    def children(self):
+        return self.for_path('children')
+
     def for_name(self, name):
-        return self._name_map[name]
+        """
+        :return: the service, made now if this is the first time it is used
+        :raises KeyError: if there is no service by that name
+        """
+        service = self._name_map.get(name)
+        if service is None:
+            service = self._construct(name)
+        return service
 
     def for_path(self, path):
-        return self._path_map.get(path)
+        """
+        :return: the service that answers the path, None if there isn't one
+        """
+        service = self._path_map.get(path)
+        if service is None and path in self.SERVICES:
+            service = self._construct(path)
+        return service
+
+    def _construct(self, name):
+        """
+        Make a service and give it the fixture files loaded so far. Only the services a test uses
+        are made, and a service's share of a large fixture is only indexed if it is used.
+        """
+        with self._services_lock:
+            service = self._name_map.get(name)
+            if service is None:
+                service = self.SERVICES[name](directory=self)
+                for file_ids, fixture_data in self._pending.pop(name, ()):
+                    service._index_fixtures(file_ids, fixture_data)
+                self._path_map[service.path] = service
+                # assigned last, it is the flag for_name checks without the lock
+                self._name_map[name] = service
+        return service
+
+    def handler(self, resource, action):
+        """
+        :param resource: a resource of the discovery document, e.g. "files"
+        :param action: one of its methods, e.g. "list"
+        :return: the service's bound method for it, None if the testbed doesn't have one
+        """
+        key = (resource, action)
+        try:
+            return self._handlers[key]
+        except KeyError:
+            pass
+        service = self.for_name(resource) if resource in self.SERVICES else None
+        func = getattr(service, action, None) if service is not None and not action.startswith('_') else None
+        if not callable(func):
+            func = None
+        self._handlers[key] = func
+        return func
 
 
 class ServiceStub(object):
@@ -0,0 +1,355 @@
+# ordered, pageable containers for the in-memory services
+import base64
+import heapq
+from bisect import bisect_left, bisect_right
+
+__author__ = 'charlie'
+
+# page size used by the list calls when the caller doesn't give maxResults
+DEFAULT_PAGE_SIZE = 100
+
+_TOKEN_PREFIX = "dtb1:"
+
+
+class PageTokenError(ValueError):
+    pass
+
+
+def encode_page_token(seq):
+    return base64.urlsafe_b64encode("%s%d" % (_TOKEN_PREFIX, seq)).replace('=', '')
+
+
+def decode_page_token(token):
+    """
+    :param token: a pageToken from a previous list response, or None
+    :return: the sequence number the previous page ended at, or None to start from the beginning
+    :raises PageTokenError: if the token wasn't made by encode_page_token
+    """
+    if not token:
+        return None
+    try:
+        token = str(token)
+        decoded = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+    except (TypeError, ValueError, UnicodeError):
+        raise PageTokenError("Invalid page token: %s" % token)
+    if not decoded.startswith(_TOKEN_PREFIX) or not decoded[len(_TOKEN_PREFIX):].isdigit():
+        raise PageTokenError("Invalid page token: %s" % token)
+    return int(decoded[len(_TOKEN_PREFIX):])
+
+
+def page_size(maxResults, default=DEFAULT_PAGE_SIZE):
+    """
+    :param maxResults: the maxResults parameter as it came in on the request, may be a string
+    :return: number of items for this page, or None for no limit
+    """
+    if maxResults is None or maxResults == '':
+        return default
+    try:
+        size = int(maxResults)
+    except (TypeError, ValueError):
+        raise PageTokenError("Invalid maxResults: %s" % maxResults)
+    if size <= 0:
+        return default
+    return size
+
+
+class OrderedStore(object):
+    """
+    Dict-like container that keeps insertion order and can be read a page at a time.
+
+    Each key gets an increasing sequence number when it's added. A page is "everything after
+    sequence number n", found by bisecting, so a cursor stays valid however many items are
+    added or removed before the next page is read, and reading a page costs about as much
+    as the page itself.
+
+    Removal only drops the key from the lookup tables; the stale slot in the order is skipped
+    when paging and reclaimed once they make up half of it.
+    """
+
+    # there is one of these for every file's permissions and parents
+    __slots__ = ('_values', '_seq_of', '_seqs', '_keys', '_next_seq', '_removed')
+
+    def __init__(self, items=None):
+        self._values = {}
+        self._seq_of = {}
+        self._seqs = []
+        self._keys = []
+        self._next_seq = 0
+        self._removed = 0
+        for key, value in items or ():
+            self[key] = value
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        if key not in self._values:
+            seq = self._next_seq
+            self._next_seq += 1
+            self._seq_of[key] = seq
+            self._seqs.append(seq)
+            self._keys.append(key)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._values[key]
+        del self._seq_of[key]
+        self._removed += 1
+        if self._removed > 32 and self._removed * 2 > len(self._keys):
+            self._compact()
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def pop(self, key, *default):
+        if key not in self._values:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self._values[key]
+        del self[key]
+        return value
+
+    def copy(self):
+        """
+        :return: a new store with the same items and sequence numbers
+        """
+        result = OrderedStore()
+        result._values = dict(self._values)
+        result._seq_of = dict(self._seq_of)
+        result._seqs = list(self._seqs)
+        result._keys = list(self._keys)
+        result._next_seq = self._next_seq
+        result._removed = self._removed
+        return result
+
+    def seq(self, key):
+        """
+        :return: the sequence number key was added with
+        """
+        return self._seq_of[key]
+
+    def key_at(self, seq):
+        """
+        :return: the key that has sequence number seq now, None if there isn't one
+        """
+        i = bisect_right(self._seqs, seq) - 1
+        if i >= 0 and self._seqs[i] == seq and self._seq_of.get(self._keys[i]) == seq:
+            return self._keys[i]
+        return None
+
+    def put_at(self, key, value, seq):
+        """
+        Put a removed key back where it was, e.g. when rolling back to a snapshot
+        :param seq: the sequence number the key had, from seq()
+        """
+        if key in self._values:
+            del self[key]
+        i = bisect_right(self._seqs, seq)
+        if i and self._seqs[i - 1] == seq:
+            # the slot it left behind is still here, a sequence number only ever belongs to one key
+            self._removed -= 1
+        else:
+            self._seqs.insert(i, seq)
+            self._keys.insert(i, key)
+        self._seq_of[key] = seq
+        self._values[key] = value
+        self._next_seq = max(self._next_seq, seq + 1)
+
+    def _live(self, start=0):
+        seq_of = self._seq_of
+        keys = self._keys
+        seqs = self._seqs
+        for i in xrange(start, len(keys)):
+            key = keys[i]
+            if seq_of.get(key) == seqs[i]:
+                yield seqs[i], key
+
+    def _compact(self):
+        live = list(self._live())
+        self._seqs = [seq for seq, key in live]
+        self._keys = [key for seq, key in live]
+        self._removed = 0
+
+    def iterkeys(self):
+        for seq, key in self._live():
+            yield key
+
+    def itervalues(self):
+        values = self._values
+        for seq, key in self._live():
+            yield values[key]
+
+    def iteritems(self):
+        values = self._values
+        for seq, key in self._live():
+            yield key, values[key]
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def page(self, after=None, limit=None, accept=None):
+        """
+        :param after: sequence number the previous page ended at, None to start at the beginning
+        :param limit: maximum number of values to return, None for all of them
+        :param accept: optional filter, called with each value
+        :return: (values, seq) where seq is the cursor for the next page, or None if this is the last one
+        """
+        start = 0 if after is None else bisect_right(self._seqs, after)
+        values = self._values
+        found = []
+        last = None
+        for seq, key in self._live(start):
+            value = values[key]
+            if accept is not None and not accept(value):
+                continue
+            if limit is not None and len(found) == limit:
+                return found, last
+            found.append(value)
+            last = seq
+        return found, None
+
+    def page_of(self, keys, after=None, limit=None):
+        """
+        Page through a subset of the store, e.g. the candidates from an index.
+        Costs time in proportion to len(keys), not to the size of the store.
+        :param keys: iterable of keys, keys not in the store are ignored
+        :return: (values, seq) as for page()
+        """
+        seq_of = self._seq_of
+        ordered = ((seq_of[key], key) for key in keys if key in seq_of)
+        if after is not None:
+            ordered = ((seq, key) for seq, key in ordered if seq > after)
+        if limit is None:
+            chosen = sorted(ordered)
+            more = False
+        else:
+            chosen = heapq.nsmallest(limit + 1, ordered)
+            more = len(chosen) > limit
+            chosen = chosen[:limit]
+        values = [self._values[key] for seq, key in chosen]
+        return values, (chosen[-1][0] if more else None)
+
+
+class SortedIndex(object):
+    """
+    Items in the order of a key, e.g. files by date, for range queries. Kept sorted by (key, id) in
+    blocks of a few hundred, each a list of keys and a parallel list of ids, so an entry is found
+    with a bisect over the blocks' first entries and two within its block. A change only shifts
+    one block along, and a range costs log N plus the items in it.
+    """
+
+    __slots__ = ('_keys', '_ids', '_firsts')
+
+    # entries in a block to start with; a block that grows to twice this is split
+    BLOCK_SIZE = 512
+
+    def __init__(self, items=()):
+        """
+        :param items: (key, id) pairs to start with, in any order
+        """
+        items = sorted(items)
+        starts = xrange(0, len(items), self.BLOCK_SIZE)
+        self._keys = [[key for key, item_id in items[start:start + self.BLOCK_SIZE]] for start in starts]
+        self._ids = [[item_id for key, item_id in items[start:start + self.BLOCK_SIZE]] for start in starts]
+        # (key, id) of the first entry of each block
+        self._firsts = [items[start] for start in starts]
+
+    def __len__(self):
+        return sum(len(keys) for keys in self._keys)
+
+    def _find(self, key, item_id):
+        """
+        :return: (block, where the entry is or would go in it, the end of the entries there with that key)
+        """
+        block = max(bisect_right(self._firsts, (key, item_id)) - 1, 0)
+        keys = self._keys[block]
+        first = bisect_left(keys, key)
+        end = bisect_right(keys, key, first)
+        return block, bisect_left(self._ids[block], item_id, first, end), end
+
+    def add(self, key, item_id):
+        if not self._keys:
+            self._keys.append([key])
+            self._ids.append([item_id])
+            self._firsts.append((key, item_id))
+            return
+        block, i, end = self._find(key, item_id)
+        keys = self._keys[block]
+        ids = self._ids[block]
+        if i < end and ids[i] == item_id:
+            return
+        keys.insert(i, key)
+        ids.insert(i, item_id)
+        if i == 0:
+            self._firsts[block] = (key, item_id)
+        if len(keys) >= 2 * self.BLOCK_SIZE:
+            half = len(keys) // 2
+            self._keys.insert(block + 1, keys[half:])
+            self._ids.insert(block + 1, ids[half:])
+            self._firsts.insert(block + 1, (keys[half], ids[half]))
+            del keys[half:]
+            del ids[half:]
+
+    def remove(self, key, item_id):
+        if not self._keys:
+            return
+        block, i, end = self._find(key, item_id)
+        keys = self._keys[block]
+        ids = self._ids[block]
+        if i < end and ids[i] == item_id:
+            del keys[i]
+            del ids[i]
+            if not keys:
+                del self._keys[block]
+                del self._ids[block]
+                del self._firsts[block]
+            elif i == 0:
+                self._firsts[block] = (keys[0], ids[0])
+
+    def range(self, low=None, high=None, include_low=True, include_high=True):
+        """
+        :param low: the smallest key wanted, None for no lower bound
+        :param high: the largest key wanted, None for no upper bound
+        :return: list of the ids with keys in the range, in key order
+        """
+        blocks = self._keys
+        block = 0
+        i = 0
+        if low is not None:
+            # the block before the first one starting at low or later may hold some of it too
+            block = max(bisect_left(self._firsts, (low,)) - 1, 0)
+            # entries with the key low may carry on into the blocks after
+            while block < len(blocks):
+                i = bisect_left(blocks[block], low) if include_low else bisect_right(blocks[block], low)
+                if i < len(blocks[block]):
+                    break
+                block += 1
+        found = []
+        while block < len(blocks):
+            keys = blocks[block]
+            if high is None:
+                found.extend(self._ids[block][i:])
+            else:
+                end = bisect_right(keys, high, i) if include_high else bisect_left(keys, high, i)
+                found.extend(self._ids[block][i:end])
+                if end < len(keys):
+                    break
+            block += 1
+            i = 0
+        return found
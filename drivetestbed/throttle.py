@@ -0,0 +1,167 @@
+# rate limits and latency like Drive's, so that backoff and concurrency can be tested
+# see https://developers.google.com/drive/v2/web/handle-errors
+import math
+import random
+import threading
+import time
+
+__author__ = 'charlie'
+
+
+class RealClock(object):
+    """
+    Wall clock time; sleeping really sleeps
+    """
+
+    def now(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds)
+
+
+class VirtualClock(object):
+    """
+    A clock that only moves when something sleeps on it, so a test of minutes of throttling and
+    latency runs in milliseconds. Give the code under test clock.sleep in place of time.sleep.
+    """
+
+    def __init__(self, start=0.0):
+        self._now = start
+        self._lock = threading.Lock()
+
+    def now(self):
+        return self._now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            with self._lock:
+                self._now += seconds
+
+    advance = sleep
+
+
+class TokenBucket(object):
+    """
+    Holds up to capacity tokens and gains rate tokens a second. Each call takes one, and is refused
+    when there are none, so calls may come in bursts of capacity but average at most rate a second.
+    """
+
+    def __init__(self, rate, capacity, clock):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock.now()
+
+    def peek(self):
+        """
+        :return: True if there is a token for a call, without taking it
+        """
+        now = self._clock.now()
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+        return self._tokens >= 1
+
+    def take(self):
+        """
+        :return: True if there was a token, False if the call should be refused
+        """
+        if self.peek():
+            self._tokens -= 1
+            return True
+        return False
+
+
+def fixed(seconds):
+    """
+    :return: a latency distribution that is always the same
+    """
+    return lambda rand: seconds
+
+
+def uniform(low, high):
+    return lambda rand: rand.uniform(low, high)
+
+
+def lognormal(median, sigma=0.5):
+    """
+    :return: a latency distribution with a long tail, like real network calls. Half of the calls take
+        less than median seconds, and sigma sets how far the slow ones stray.
+    """
+    mu = math.log(median)
+    return lambda rand: rand.lognormvariate(mu, sigma)
+
+
+class Throttle(object):
+    """
+    Sits in front of a ServiceDirectory's calls (see ServiceDirectory.set_throttle) and, like Drive:
+
+    * refuses calls over the per user rate with a 403 userRateLimitExceeded. Users are told apart
+      by the quotaUser parameter, or are the directory's user.
+    * refuses calls over the rate for the whole project with a 429 rateLimitExceeded
+    * delays each call by a latency drawn from its endpoint's distribution
+
+    With a VirtualClock nothing really waits: latency moves the clock on and the buckets refill
+    as it moves.
+    """
+
+    def __init__(self, clock=None, user_rate=None, user_burst=None, project_rate=None, project_burst=None,
+                 latency=None, seed=None):
+        """
+        :param clock: RealClock (the default) or VirtualClock
+        :param user_rate: calls a second each user may make on average, None for no limit
+        :param user_burst: calls a user may make at once, user_rate if None
+        :param project_rate: calls a second for everyone together, None for no limit
+        :param project_burst: project_rate if None
+        :param latency: "resource.action" -> distribution (see fixed, uniform, lognormal); "*" for
+            every endpoint without its own
+        :param seed: for the latency draws, so runs can be repeated
+        """
+        self.clock = clock or RealClock()
+        self._user_rate = user_rate
+        self._user_burst = user_burst or user_rate
+        self._user_buckets = {}
+        self._project_bucket = None
+        if project_rate:
+            self._project_bucket = TokenBucket(project_rate, project_burst or project_rate, self.clock)
+        self._latency = dict(latency or {})
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.throttled = 0
+
+    def _user_bucket(self, user):
+        bucket = self._user_buckets.get(user)
+        if bucket is None:
+            bucket = self._user_buckets[user] = TokenBucket(self._user_rate, self._user_burst, self.clock)
+        return bucket
+
+    def admit(self, name, user):
+        """
+        Called before each call. Waits for the call's latency, then takes its tokens.
+        :param name: the call's "resource.action"
+        :return: None if the call may go ahead, else (status, reason, error reason, message) to refuse it with
+        """
+        with self._lock:
+            distribution = self._latency.get(name) or self._latency.get('*')
+            delay = distribution(self._random) if distribution is not None else 0
+        self.clock.sleep(delay)
+        with self._lock:
+            # a refused call costs nothing, so both buckets are checked before either is taken from
+            user_bucket = self._user_bucket(user) if self._user_rate else None
+            project_bucket = self._project_bucket
+            refusal = None
+            if user_bucket is not None and not user_bucket.peek():
+                refusal = (403, "Forbidden", "userRateLimitExceeded", "User Rate Limit Exceeded")
+            elif project_bucket is not None and not project_bucket.peek():
+                refusal = (429, "Too Many Requests", "rateLimitExceeded", "Rate Limit Exceeded")
+            if refusal is not None:
+                self.throttled += 1
+                return refusal
+            if user_bucket is not None:
+                user_bucket.take()
+            if project_bucket is not None:
+                project_bucket.take()
+            return None
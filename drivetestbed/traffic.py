@@ -0,0 +1,386 @@
+# records the calls made through TestbedHttp and replays them against fresh directories
+#
+#     python -m drivetestbed.traffic traffic.log --workers 4 --timing recorded --fixture files.ndjson
+#
+# The log is append-only NDJSON, one call a line: see Recorder.
+import argparse
+import base64
+import json
+import os
+import re
+import threading
+import time
+from timeit import default_timer
+from urlparse import urlparse
+from googleapiclient.errors import HttpError
+
+__author__ = 'charlie'
+
+# anything that could be a file or upload id the testbed made (see services.get_a_uuid and
+# media.ResumableUpload). Replay swaps the ones made while recording for the ones made while replaying.
+_ID_RE = re.compile(r"[A-Za-z0-9_-]{16,}")
+# ids in the resources of a response, and the upload id in the Location of a resumable upload
+_RESPONSE_ID_RE = re.compile(r'"id":\s*"([A-Za-z0-9_-]{16,})"')
+_UPLOAD_ID_RE = re.compile(r"upload_id=([A-Za-z0-9_-]+)")
+
+# latency percentiles in a report
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _created_ids(method, resp, content):
+    """
+    :return: the ids in what a call that changes something answered, in order, to pair with the
+        answer to the same call when it is replayed
+    """
+    if method == 'GET' or resp.status != 200:
+        return []
+    ids = _UPLOAD_ID_RE.findall(resp.get('location') or '')
+    if isinstance(content, basestring):
+        ids.extend(_RESPONSE_ID_RE.findall(content))
+    return ids
+
+
+class Call(object):
+    """
+    One logged call
+    """
+
+    __slots__ = ('at', 'tenant', 'method', 'uri', 'body', 'headers', 'status', 'latency', 'ids')
+
+    def __init__(self, at, tenant, method, uri, body, headers, status, latency, ids):
+        """
+        :param at: when it was made, in seconds since 1970
+        :param tenant: whose directory it went to, its user's email
+        :param latency: how long it took to answer, in seconds
+        :param ids: see _created_ids
+        """
+        self.at = at
+        self.tenant = tenant
+        self.method = method
+        self.uri = uri
+        self.body = body
+        self.headers = headers
+        self.status = status
+        self.latency = latency
+        self.ids = ids
+
+    def to_line(self):
+        body = self.body
+        if body is not None:
+            try:
+                body = body.decode('utf-8')
+            except UnicodeDecodeError:
+                # uploaded content
+                body = {'b64': base64.b64encode(body)}
+        return json.dumps([round(self.at, 6), self.tenant, self.method, self.uri, body, self.headers or None,
+                           self.status, round(self.latency, 6), self.ids or None], separators=(',', ':')) + '\n'
+
+    @classmethod
+    def from_line(cls, line):
+        at, tenant, method, uri, body, headers, status, latency, ids = json.loads(line)
+        if isinstance(body, dict):
+            body = base64.b64decode(body['b64'])
+        elif body is not None:
+            body = body.encode('utf-8')
+        return cls(at, tenant, method, uri.encode('utf-8'), body, headers or {}, status, latency, ids or [])
+
+    def __repr__(self):
+        return "<Call %s %s %d>" % (self.method, self.uri, self.status)
+
+
+class Recorder(object):
+    """
+    Appends the calls made through a TestbedHttp to a log. Each call is one line written with one
+    write to a file opened for appending, so several recorders, in this process or others, can
+    share a log without mixing up their lines.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def record(self, call):
+        line = call.to_line()
+        with self._lock:
+            if self._fd is None:
+                return
+            os.write(self._fd, line)
+            self.calls += 1
+
+    def call(self, tenant, func, uri, method, body, headers):
+        """
+        Make a call and log it, whether it succeeds or fails
+        :param func: makes the call, given the rest of the arguments
+        :return: what func returns
+        """
+        at = time.time()
+        started = default_timer()
+        try:
+            resp, content = func(uri, method, body, headers)
+        except HttpError as e:
+            self.record(Call(at, tenant, method, uri, body, headers, e.resp.status, default_timer() - started, []))
+            raise
+        latency = default_timer() - started
+        self.record(Call(at, tenant, method, uri, body, headers, resp.status, latency,
+                         _created_ids(method, resp, content)))
+        return resp, content
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+
+def read_log(path, tenants=None):
+    """
+    :param tenants: only the calls of these tenants, all of them if None
+    :return: iterator of the logged Calls, in order
+    """
+    with open(path, 'rb') as log:
+        for line in log:
+            if not line.strip():
+                continue
+            call = Call.from_line(line)
+            if tenants is None or call.tenant in tenants:
+                yield call
+
+
+def _percentile(ordered, percent):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100.0))]
+
+
+class ReplayReport(object):
+    """
+    What a replay did: how many calls, how fast, and which answered differently than when they
+    were recorded
+    """
+
+    def __init__(self, calls=0, seconds=0.0, latencies=None, diverged=0, failed=0, endpoints=None):
+        """
+        :param seconds: wall time from the start of the replay to the end of its last call
+        :param latencies: the seconds each call took
+        :param diverged: calls whose status wasn't the recorded one
+        :param failed: calls that raised something other than an HttpError
+        :param endpoints: "resource.action" -> list of the seconds its calls took
+        """
+        self.calls = calls
+        self.seconds = seconds
+        self.latencies = latencies or []
+        self.diverged = diverged
+        self.failed = failed
+        self.endpoints = endpoints or {}
+
+    @property
+    def throughput(self):
+        """
+        :return: calls a second
+        """
+        return self.calls / self.seconds if self.seconds else 0.0
+
+    def percentiles(self, name=None):
+        """
+        :param name: a "resource.action", or None for every call
+        :return: percent -> latency in seconds, for PERCENTILES and 100
+        """
+        ordered = sorted(self.latencies if name is None else self.endpoints.get(name, ()))
+        result = dict((percent, _percentile(ordered, percent)) for percent in PERCENTILES)
+        result[100] = ordered[-1] if ordered else 0.0
+        return result
+
+    def merge(self, other):
+        """
+        Add another worker's report to this one. The replay took as long as the slowest worker.
+        """
+        self.calls += other.calls
+        self.seconds = max(self.seconds, other.seconds)
+        self.latencies.extend(other.latencies)
+        self.diverged += other.diverged
+        self.failed += other.failed
+        for name, latencies in other.endpoints.iteritems():
+            self.endpoints.setdefault(name, []).extend(latencies)
+
+    def format(self):
+        """
+        :return: the report as text, the slowest endpoints by total time first
+        """
+        lines = ["%d calls in %.2fs, %.0f calls/s, %d diverged, %d failed" %
+                 (self.calls, self.seconds, self.throughput, self.diverged, self.failed)]
+        columns = ''.join("%10s" % ("p%g" % percent) for percent in PERCENTILES + (100,))
+        lines.append("%-28s %8s %10s%s" % ('', 'calls', 'total ms', columns))
+        rows = [('all', self.latencies)]
+        rows.extend(sorted(self.endpoints.iteritems(), key=lambda item: -sum(item[1])))
+        for name, latencies in rows:
+            percentiles = self.percentiles(None if name == 'all' else name)
+            lines.append("%-28s %8d %10.1f%s" % (name, len(latencies), sum(latencies) * 1000, ''.join(
+                "%10.3f" % (percentiles[percent] * 1000) for percent in PERCENTILES + (100,))))
+        return '\n'.join(lines)
+
+    def __repr__(self):
+        return "<ReplayReport %d calls, %.0f calls/s>" % (self.calls, self.throughput)
+
+
+class _Replayer(object):
+    """
+    Replays the calls of some tenants, each against a fresh ServiceDirectory of its own
+    """
+
+    def __init__(self, files=None, fixture=None):
+        """
+        :param files: fixture records every tenant's directory starts with
+        :param fixture: path of an NDJSON or JSON array fixture to load into each one instead
+        """
+        self._files = files
+        self._fixture = fixture
+        # tenant -> (TestbedHttp, {recorded id: replayed id})
+        self._tenants = {}
+
+    def _tenant(self, tenant):
+        found = self._tenants.get(tenant)
+        if found is None:
+            from drivetestbed.http import TestbedHttp
+            from drivetestbed.services import ServiceDirectory
+            directory = ServiceDirectory(files=self._files, user_email=tenant)
+            if self._fixture:
+                directory.load(self._fixture)
+            # never recorded, a replay may be reading the log recording is going to
+            testbed = TestbedHttp(recorder=False, directory=directory)
+            testbed._use_schema()
+            found = self._tenants[tenant] = (testbed, {})
+        return found
+
+    def run(self, calls, timing='fast', speed=1.0, start_at=None):
+        """
+        :param calls: iterable of Calls, in the order they were made
+        :param timing: "recorded" to make each call as long after the first as it was made, "fast"
+            to make each as soon as the one before is answered
+        :param speed: with recorded timing, how many times faster than recorded to go
+        :param start_at: the recorded time the replay starts from, the first call's if None
+        :return: ReplayReport
+        """
+        from drivetestbed import media, schema
+        dispatcher = schema.get_cache().dispatcher
+        report = ReplayReport()
+        started = time.time()
+        ended = started
+        for call in calls:
+            testbed, id_map = self._tenant(call.tenant)
+            if start_at is None:
+                start_at = call.at
+            if timing == 'recorded':
+                delay = started + (call.at - start_at) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            uri, body = call.uri, call.body
+            if id_map:
+                swap = lambda match: id_map.get(match.group(0), match.group(0))
+                uri = _ID_RE.sub(swap, uri)
+                # the body of an upload is content, which is sent as it was
+                if body and media.upload_path(urlparse(uri).path) is None:
+                    body = _ID_RE.sub(swap, body)
+            call_started = default_timer()
+            try:
+                resp, content = testbed.request(uri, method=call.method, body=body, headers=dict(call.headers))
+                status = resp.status
+            except HttpError as e:
+                resp, content, status = e.resp, '', e.resp.status
+            except Exception:
+                resp, content, status = None, '', 500
+                report.failed += 1
+            latency = default_timer() - call_started
+            ended = time.time()
+            if call.ids and resp is not None:
+                for recorded, replayed in zip(call.ids, _created_ids(call.method, resp, content)):
+                    if recorded != replayed:
+                        id_map[recorded] = replayed
+            report.calls += 1
+            report.latencies.append(latency)
+            if status != call.status:
+                report.diverged += 1
+            report.endpoints.setdefault(_endpoint(dispatcher, call), []).append(latency)
+        report.seconds = ended - started
+        return report
+
+
+def _endpoint(dispatcher, call):
+    """
+    :return: the "resource.action" a call went to, for the report
+    """
+    from drivetestbed import batch, media
+    path = urlparse(call.uri).path
+    if 'discovery' in path:
+        return 'discovery'
+    if batch.is_batch_path(path):
+        return 'batch'
+    found = dispatcher.match(call.method, media.upload_path(path) or path)
+    if found is None:
+        return "%s (not found)" % call.method
+    return "%s.%s" % (found[0].resource, found[0].action)
+
+
+def _replay_worker(args):
+    """
+    Replay the tenants a worker process was given, in a pool
+    """
+    path, tenants, files, fixture, timing, speed, start_at = args
+    return _Replayer(files, fixture).run(read_log(path, tenants), timing=timing, speed=speed, start_at=start_at)
+
+
+def replay(path, files=None, fixture=None, workers=1, timing='fast', speed=1.0):
+    """
+    Make the logged calls again, each tenant's against a fresh ServiceDirectory of its own. Ids the
+    testbed made while recording, for new files and uploads, are swapped for the ones it makes
+    this time, so later calls find what earlier ones made.
+    :param files: fixture records every tenant's directory starts with
+    :param fixture: path of an NDJSON or JSON array fixture to load into each one instead
+    :param workers: processes to share the tenants out between, 1 to replay in this one
+    :param timing: "recorded" or "fast", see _Replayer.run
+    :return: ReplayReport
+    """
+    if workers <= 1:
+        return _Replayer(files, fixture).run(read_log(path), timing=timing, speed=speed)
+    # in the order they first appear, the set to look them up in
+    tenants = []
+    seen = set()
+    start_at = None
+    for call in read_log(path):
+        if start_at is None:
+            start_at = call.at
+        if call.tenant not in seen:
+            seen.add(call.tenant)
+            tenants.append(call.tenant)
+    shares = [set(tenants[i::workers]) for i in xrange(workers) if tenants[i::workers]]
+    if not shares:
+        return ReplayReport()
+    import multiprocessing
+    pool = multiprocessing.Pool(len(shares))
+    try:
+        reports = pool.map(_replay_worker, [(path, share, files, fixture, timing, speed, start_at)
+                                            for share in shares])
+    finally:
+        pool.close()
+        pool.join()
+    report = reports[0]
+    for other in reports[1:]:
+        report.merge(other)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a log of Drive calls against the testbed")
+    parser.add_argument('log', help="a log written by a Recorder")
+    parser.add_argument('--fixture', help="NDJSON or JSON array of Drive files every tenant starts with")
+    parser.add_argument('--workers', type=int, default=1, help="processes to share the tenants out between")
+    parser.add_argument('--timing', choices=('fast', 'recorded'), default='fast')
+    parser.add_argument('--speed', type=float, default=1.0, help="with recorded timing, times faster to go")
+    args = parser.parse_args(argv)
+    report = replay(args.log, fixture=args.fixture, workers=args.workers, timing=args.timing, speed=args.speed)
+    print report.format()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,20 @@
+import hashlib
+import httplib2
+import io
+import json
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+from StringIO import StringIO
 from apiclient.errors import HttpError
 from apiclient.discovery import build
-from drivetestbed import http
+from apiclient.http import BatchHttpRequest, MediaInMemoryUpload, MediaIoBaseDownload, MediaIoBaseUpload
+from drivetestbed import backends, batch, dispatch, fields, http, loader, locking, media, query, records, schema, \
+    search, serialize, server, throttle, traffic
+from drivetestbed.services import ServiceDirectory, ROOT_FOLDER_ID, raise_404
+from drivetestbed.store import OrderedStore, SortedIndex
 from apiclient import discovery
 import pytest
 
@@ -271,6 +285,12 @@ class TestParentsService(object):
         perms = one_file_service.parents().list(fileId=ONE_FILE_ID).execute()
         assert len(perms['items']) == 1
 
+    def test_get_root_alias(self, one_file_service):
+        response = one_file_service.parents().get(fileId=ONE_FILE_ID, parentId='root').execute()
+        assert response['id'] == ROOT_FOLDER_ID and response['isRoot']
+        with pytest.raises(HttpError):
+            one_file_service.parents().get(fileId=ONE_FILE_ID, parentId='NOT_A_PARENT').execute()
+
 
 class TestClientCall(object):
 
@@ -307,3 +327,1493 @@ class TestGlobalService(object):
         finally:
             http.TestbedHttp.teardown_global_service()
 
+
+
+class TestSchemaCache(object):
+
+    def test_warm_up(self):
+        cache = schema.SchemaCache()
+        assert not cache.loaded
+        cache.dispatcher
+        assert cache.loaded
+        assert 'files' in cache.schema['resources']
+
+    def test_shared_between_instances(self):
+        http.TestbedHttp.warm_up()
+        dispatcher = schema.get_cache().dispatcher
+        first = http.TestbedHttp()
+        second = http.TestbedHttp()
+        first.request("https://www.googleapis.com/discovery/v1/apis/drive/v2/rest")
+        second.request("https://www.googleapis.com/drive/v2/files")
+        assert schema.get_cache().dispatcher is dispatcher
+
+    def test_discovery_content(self):
+        resp, content = http.TestbedHttp().request("https://www.googleapis.com/discovery/v1/apis/drive/v2/rest")
+        assert resp.status == 200
+        with open(schema.SCHEMA_PATH) as fp:
+            assert content == fp.read()
+
+
+class TestDispatch(object):
+
+    def _match(self, method, path):
+        route, params = schema.get_cache().dispatcher.match(method, "/drive/v2/" + path)
+        return route.resource + '.' + route.action, params
+
+    def test_match(self):
+        assert self._match('GET', "files") == ('files.list', {})
+        assert self._match('GET', "files/ABC") == ('files.get', {'fileId': 'ABC'})
+        assert self._match('GET', "files/ABC/children") == ('children.list', {'folderId': 'ABC'})
+        assert self._match('DELETE', "files/ABC/parents/DEF") == ('parents.delete', {'fileId': 'ABC', 'parentId': 'DEF'})
+        assert self._match('GET', "files/a%20b%C3%A9") == ('files.get', {'fileId': u'a b\xe9'})
+        assert schema.get_cache().dispatcher.match('POST', "/drive/v2/files/ABC") is None
+        assert schema.get_cache().dispatcher.match('GET', "/drive/v3/files") is None
+
+    def test_literal_before_param(self):
+        assert self._match('DELETE', "files/trash") == ('files.emptyTrash', {})
+        assert self._match('DELETE', "files/ABC") == ('files.delete', {'fileId': 'ABC'})
+        # only DELETE has a files/trash route
+        assert self._match('GET', "files/trash") == ('files.get', {'fileId': 'trash'})
+
+    def test_parse_query(self):
+        assert dispatch.parse_query("a=1&b=&c=2&c=3&d=x+y%21") == {'a': '1', 'c': ['2', '3'], 'd': 'x y!'}
+        assert dispatch.parse_query("") == {}
+
+    def test_before_discovery(self):
+        schema.get_cache().clear()
+        testbed = http.TestbedHttp(files=[{'id': 'A', 'title': "a"}])
+        resp, content = testbed.request("https://www.googleapis.com/drive/v2/files/A")
+        assert resp.status == 200 and json.loads(content)['title'] == "a"
+
+    def test_unknown_action(self):
+        testbed = http.TestbedHttp()
+        with pytest.raises(HttpError) as e:
+            testbed.request("https://www.googleapis.com/drive/v2/about")
+        assert e.value.resp.status == 404
+        assert "No such action: about.get" in e.value.content
+        resp, content = testbed.request("https://www.googleapis.com/drive/v2/nowhere")
+        assert resp.status == 404
+
+
+class TestLazyServices(object):
+
+    FILES = [
+        {'id': 'FOLDER', 'title': "folder", 'mimeType': 'application/vnd.google-apps.folder'},
+        {'id': 'A', 'title': "a", 'parents': [{'id': 'FOLDER'}],
+         'permissions': [{'id': 'reader', 'type': 'user', 'role': 'reader', 'emailAddress': 'reader@example.com'}]},
+    ]
+
+    def test_made_on_first_use(self):
+        directory = ServiceDirectory(files=self.FILES)
+        assert 'permissions' not in directory._name_map and 'parents' not in directory._name_map
+        # the owners are on the file without the permissions service
+        assert directory.files().get(fileId='FOLDER')['owners'][0]['emailAddress'] == "test@drivetestbed.org"
+        assert [p['id'] for p in directory.parents().list(fileId='A')['items']] == ['FOLDER']
+        assert [p['id'] for p in directory.permissions().list(fileId='A')['items']] == ['reader']
+        assert len(directory.permissions().list(fileId='FOLDER')['items']) == 1
+        assert not directory._pending
+        with pytest.raises(KeyError):
+            directory.for_name('comments')
+        assert directory.handler('comments', 'list') is None
+
+    def test_loaded_after_use(self):
+        directory = ServiceDirectory(files=self.FILES[:1])
+        directory.parents()
+        directory._add_batch([{'id': 'B', 'parents': [{'id': 'FOLDER'}]}])
+        assert directory.children().list(folderId='FOLDER')['items'][0]['id'] == 'B'
+
+    def test_query_indexes_built_by_first_query(self):
+        directory = ServiceDirectory(files=self.FILES)
+        files = directory.files()
+        assert files._label_index is None
+        directory.files().insert(body={'title': "a"})
+        assert len(files.list(q="title = 'a'")['items']) == 2
+        assert files._label_index is not None
+        directory.files().insert(body={'title': "a"})
+        assert len(files._ids_with('title', "a")) == 3
+
+
+@pytest.fixture
+def query_service():
+    files = [
+        {'id': 'DOC_1', 'title': "Quarterly report", 'description': "numbers for q1", 'mimeType': 'text/plain'},
+        {'id': 'DOC_2', 'title': "Holiday photos", 'description': "beach", 'mimeType': 'image/jpeg'},
+        {'id': 'DOC_3', 'title': "Report draft", 'description': "more numbers", 'mimeType': 'text/plain',
+         'labels': {'trashed': True}},
+        {'id': 'FOLDER', 'title': "Reports", 'mimeType': 'application/vnd.google-apps.folder'},
+    ]
+    service = build('drive', 'v2', http.TestbedHttp(files=files))
+    service.parents().insert(fileId='DOC_1', body={'id': 'FOLDER'}).execute()
+    return service
+
+
+def _ids(response):
+    return sorted(item['id'] for item in response['items'])
+
+
+class TestFilesQuery(object):
+
+    def test_mime_type(self, query_service):
+        response = query_service.files().list(q="mimeType = 'text/plain'").execute()
+        assert _ids(response) == ['DOC_1', 'DOC_3']
+
+    def test_title_contains(self, query_service):
+        response = query_service.files().list(q="title contains 'report'").execute()
+        assert _ids(response) == ['DOC_1', 'DOC_3', 'FOLDER']
+        # only matches the start of words
+        response = query_service.files().list(q="title contains 'port'").execute()
+        assert _ids(response) == []
+
+    def test_trashed(self, query_service):
+        response = query_service.files().list(q="mimeType = 'text/plain' and trashed = false").execute()
+        assert _ids(response) == ['DOC_1']
+
+    def test_in_parents(self, query_service):
+        response = query_service.files().list(q="'FOLDER' in parents").execute()
+        assert _ids(response) == ['DOC_1']
+        query_service.parents().delete(fileId='DOC_1', parentId='FOLDER').execute()
+        response = query_service.files().list(q="'FOLDER' in parents").execute()
+        assert _ids(response) == []
+
+    def test_or_and_not(self, query_service):
+        q = "(mimeType = 'image/jpeg' or 'FOLDER' in parents) and not title contains 'holiday'"
+        response = query_service.files().list(q=q).execute()
+        assert _ids(response) == ['DOC_1']
+
+    def test_index_follows_insert_and_delete(self, query_service):
+        body = {'title': "new", 'mimeType': 'image/jpeg'}
+        new_id = query_service.files().insert(body=body).execute()['id']
+        response = query_service.files().list(q="mimeType = 'image/jpeg'").execute()
+        assert _ids(response) == sorted(['DOC_2', new_id])
+        query_service.files().delete(fileId='DOC_2').execute()
+        response = query_service.files().list(q="mimeType = 'image/jpeg'").execute()
+        assert _ids(response) == [new_id]
+
+    def test_invalid_query(self, query_service):
+        with pytest.raises(HttpError) as excinfo:
+            query_service.files().list(q="title ~ 'x'").execute()
+        assert excinfo.value.resp.status == 400
+
+    def test_plan_is_cached(self):
+        assert query.compile_query("trashed = false") is query.compile_query("trashed = false")
+
+
+class TestFullText(object):
+
+    def _directory(self):
+        return ServiceDirectory(files=[
+            {'id': 'NOTES', 'title': "Meeting notes", 'description': "Budget for the quarter"},
+            {'id': 'PLAN', 'title': "Plan-B budget.txt"},
+            {'id': 'CAFE', 'title': u"Caf\xe9 menu"},
+        ])
+
+    def test_words_of_title_and_description(self):
+        files = self._directory().files()
+        assert _ids(files.list(q="fullText contains 'budget'")) == ['NOTES', 'PLAN']
+        assert _ids(files.list(q="fullText contains 'quarter budget'")) == ['NOTES']
+        assert _ids(files.list(q="fullText contains 'budg'")) == []
+        assert _ids(files.list(q="not fullText contains 'budget'")) == ['CAFE']
+
+    def test_title_prefixes(self):
+        files = self._directory().files()
+        assert _ids(files.list(q="title contains 'b'")) == ['PLAN']
+        assert _ids(files.list(q="title contains 'plan-b bud'")) == ['PLAN']
+        assert _ids(files.list(q="title contains 'txt'")) == ['PLAN']
+        assert _ids(files.list(q="title contains 'an'")) == []
+        # a query string is UTF-8
+        assert _ids(files.list(q="title contains 'caf\xc3\xa9'")) == ['CAFE']
+
+    def test_follows_changes(self):
+        directory = self._directory()
+        files = directory.files()
+        snapshot = directory.snapshot()
+        assert _ids(files.list(q="fullText contains 'menu'")) == ['CAFE']
+        uploaded = files.insert(body={'title': "upload", 'mimeType': 'text/plain'},
+                                media_body=media.Blob.from_string("the lunch menu"))['id']
+        binary = files.insert(body={'title': "binary", 'mimeType': 'application/pdf'},
+                              media_body=media.Blob.from_string("menu"))['id']
+        copied = files.copy(fileId='CAFE', body={'title': "Dinner menu"})['id']
+        assert _ids(files.list(q="fullText contains 'menu'")) == sorted(['CAFE', uploaded, copied])
+        files.patch(fileId='CAFE', body={'description': "closed"})
+        files.delete(fileId=uploaded)
+        assert _ids(files.list(q="fullText contains 'menu'")) == sorted(['CAFE', copied])
+        assert _ids(files.list(q="fullText contains 'closed'")) == ['CAFE']
+        assert _ids(files.list(q="title contains 'din'")) == [copied]
+        files.patch(fileId=copied, body={'title': "Supper menu"})
+        assert _ids(files.list(q="title contains 'din'")) == []
+        directory.restore(snapshot)
+        assert _ids(files.list(q="fullText contains 'menu'")) == ['CAFE']
+        assert _ids(files.list(q="fullText contains 'closed'")) == []
+        assert binary not in files._files
+
+    def test_patch(self):
+        files = self._directory().files()
+        patched = files.patch(fileId='PLAN', body={'title': "Plan C", 'labels': {'starred': True}})
+        assert patched['title'] == "Plan C" and patched['labels']['starred']
+        assert _ids(files.list(q="starred = true")) == ['PLAN']
+        assert files.patch(fileId='PLAN', body={'labels': {'trashed': True}})['explicitlyTrashed']
+        assert _ids(files.list(q="trashed = true")) == ['PLAN']
+        with pytest.raises(HttpError):
+            files.patch(fileId='MISSING', body={'title': "x"})
+
+    def test_new_terms_are_merged(self):
+        index = search.TextIndex([('OLD', "alpha", None, None)])
+        for i in range(2000):
+            index.add("NEW_%d" % i, "term%d" % i)
+        index.remove("NEW_1", "term1")
+        assert len(index._recent) < 1024
+        assert sorted(index.with_prefix('term1')) == sorted("NEW_%d" % i for i in range(2000)
+                                                            if str(i).startswith('1') and i != 1)
+        assert index.with_prefix('alp') == ('OLD',)
+
+
+@pytest.fixture
+def many_files_service():
+    files = [{'id': "FILE_%03d" % i, 'title': "file %d" % i, 'mimeType': 'text/plain'} for i in range(25)]
+    return build('drive', 'v2', http.TestbedHttp(files=files))
+
+
+class TestPaging(object):
+
+    def _all_pages(self, service, **kwargs):
+        seen = []
+        pages = 0
+        token = None
+        while True:
+            response = service.files().list(pageToken=token, **kwargs).execute()
+            seen.extend(item['id'] for item in response['items'])
+            pages += 1
+            token = response.get('nextPageToken')
+            if not token:
+                return seen, pages
+
+    def test_pages(self, many_files_service):
+        seen, pages = self._all_pages(many_files_service, maxResults=10)
+        assert pages == 3
+        assert seen == ["FILE_%03d" % i for i in range(25)]
+
+    def test_last_page_has_no_token(self, many_files_service):
+        response = many_files_service.files().list(maxResults=25).execute()
+        assert len(response['items']) == 25
+        assert 'nextPageToken' not in response
+
+    def test_default_page_size(self):
+        files = [{'title': "file %d" % i} for i in range(150)]
+        service = build('drive', 'v2', http.TestbedHttp(files=files))
+        response = service.files().list().execute()
+        assert len(response['items']) == 100
+        assert response['nextPageToken']
+
+    def test_changes_between_pages(self, many_files_service):
+        response = many_files_service.files().list(maxResults=10).execute()
+        token = response['nextPageToken']
+        # remove an item already returned and one still to come, then add a new one
+        many_files_service.files().delete(fileId="FILE_000").execute()
+        many_files_service.files().delete(fileId="FILE_015").execute()
+        new_id = many_files_service.files().insert(body={'title': "late"}).execute()['id']
+        response = many_files_service.files().list(maxResults=100, pageToken=token).execute()
+        ids = [item['id'] for item in response['items']]
+        assert ids == ["FILE_%03d" % i for i in range(10, 25) if i != 15] + [new_id]
+
+    def test_query_pages(self, many_files_service):
+        seen, pages = self._all_pages(many_files_service, maxResults=4, q="mimeType = 'text/plain'")
+        assert pages == 7
+        assert seen == ["FILE_%03d" % i for i in range(25)]
+
+    def test_bad_token(self, many_files_service):
+        with pytest.raises(HttpError) as excinfo:
+            many_files_service.files().list(pageToken="garbage").execute()
+        assert excinfo.value.resp.status == 400
+
+    def test_permission_pages(self):
+        directory = ServiceDirectory(files=[{'id': ONE_FILE_ID}])
+        for i in range(4):
+            directory.permissions().insert(fileId=ONE_FILE_ID,
+                                           body={'type': 'user', 'role': 'reader', 'value': "u%d@x.org" % i})
+        response = directory.permissions().list(fileId=ONE_FILE_ID, maxResults="3")
+        assert len(response['items']) == 3
+        response = directory.permissions().list(fileId=ONE_FILE_ID, pageToken=response['nextPageToken'])
+        assert [perm['id'] for perm in response['items']] == ["u2@x.org", "u3@x.org"]
+        assert 'nextPageToken' not in response
+
+
+class TestOrderedStore(object):
+
+    def test_compaction_keeps_cursor(self):
+        store = OrderedStore((i, i) for i in range(200))
+        values, last = store.page(limit=50)
+        assert values == range(50)
+        for i in range(150):
+            del store[i]
+        values, last = store.page(after=last, limit=10)
+        assert values == range(150, 160)
+        assert len(store._keys) < 200
+
+    def test_readd_moves_to_end(self):
+        store = OrderedStore([('a', 1), ('b', 2)])
+        del store['a']
+        store['a'] = 3
+        assert store.items() == [('b', 2), ('a', 3)]
+
+
+class TestDates(object):
+
+    # 2015-01-01T00:00:00Z
+    START = 1420070400
+
+    def _directory(self):
+        clock = throttle.VirtualClock(self.START)
+        directory = ServiceDirectory(files=[
+            {'id': 'OLD', 'title': "old", 'modifiedDate': "2014-06-01T12:00:00.000Z",
+             'createdDate': "2014-06-01T04:00:00-08:00"},
+            {'id': 'UNDATED', 'title': "undated"},
+        ], clock=clock)
+        return directory, clock
+
+    def _query(self, files, q):
+        return _ids(files.list(q=q))
+
+    def test_insert_and_patch(self):
+        directory, clock = self._directory()
+        files = directory.files()
+        created = files.insert(body={'title': "new"})
+        assert created['createdDate'] == created['modifiedDate'] == "2015-01-01T00:00:00.000Z"
+        clock.advance(90.5)
+        patched = files.patch(fileId=created['id'], body={'title': "newer"})
+        assert patched['createdDate'] == "2015-01-01T00:00:00.000Z"
+        assert patched['modifiedDate'] == patched['lastViewedByMeDate'] == "2015-01-01T00:01:30.500Z"
+        patched = files.patch(fileId=created['id'], body={'modifiedDate': "2013-01-01T00:00:00.000Z"},
+                              setModifiedDate='true', updateViewedDate='false')
+        assert patched['modifiedDate'] == "2013-01-01T00:00:00.000Z"
+        assert patched['lastViewedByMeDate'] == "2015-01-01T00:01:30.500Z"
+
+    def test_ranges(self):
+        directory, clock = self._directory()
+        files = directory.files()
+        assert self._query(files, "modifiedDate < '2015-01-01'") == ['OLD']
+        first = files.insert(body={'title': "first"})['id']
+        clock.advance(60)
+        second = files.insert(body={'title': "second"})['id']
+        assert self._query(files, "modifiedDate > '2014-12-31T23:00:00-01:00'") == [second]
+        assert self._query(files, "modifiedDate >= '2015-01-01T00:00:00Z'") == sorted([first, second])
+        assert self._query(files, "createdDate = '2014-06-01T12:00:00Z'") == ['OLD']
+        assert self._query(files, "modifiedDate != '2015-01-01T00:01:00Z'") == sorted(['OLD', first])
+        q = "createdDate < '2015-01-01T00:00:30Z' and title contains 'first'"
+        assert self._query(files, q) == [first]
+
+    def test_other_services_move_modified_date(self):
+        directory, clock = self._directory()
+        files = directory.files()
+        snapshot = directory.snapshot()
+        assert self._query(files, "modifiedDate > '2015-01-01'") == []
+        clock.advance(10)
+        directory.permissions().insert(fileId='OLD', body={'type': 'user', 'role': 'reader', 'value': 'r@x.org'})
+        assert self._query(files, "modifiedDate > '2015-01-01'") == ['OLD']
+        clock.advance(10)
+        directory.parents().insert(fileId='UNDATED', body={'id': 'OLD'})
+        assert self._query(files, "modifiedDate > '2015-01-01T00:00:15Z'") == ['UNDATED']
+        copied = files.copy(fileId='OLD')
+        assert copied['createdDate'] == "2015-01-01T00:00:20.000Z"
+        directory.restore(snapshot)
+        assert self._query(files, "modifiedDate > '2015-01-01'") == []
+        assert self._query(files, "modifiedDate < '2015-01-01'") == ['OLD']
+
+    def test_sorted_index(self):
+        index = SortedIndex([(2, 'b'), (1, 'a'), (2, 'a'), (3, 'c')])
+        index.add(2, 'c')
+        index.add(2, 'c')
+        index.remove(2, 'a')
+        index.remove(5, 'x')
+        assert index.range() == ['a', 'b', 'c', 'c']
+        assert index.range(2, 2) == ['b', 'c']
+        assert index.range(low=2, include_low=False) == ['c']
+        assert index.range(high=2, include_high=False) == ['a']
+        assert index.range(3, 1) == []
+
+    def test_sorted_index_blocks(self, monkeypatch):
+        monkeypatch.setattr(SortedIndex, 'BLOCK_SIZE', 4)
+        index = SortedIndex((i // 3, "ID_%02d" % i) for i in range(30))
+        for i in range(0, 30, 2):
+            index.remove(i // 3, "ID_%02d" % i)
+        for i in range(30, 60):
+            index.add(i // 3, "ID_%02d" % i)
+        assert len(index._keys) > 4 and len(index) == 45
+        expected = ["ID_%02d" % i for i in range(60) if i >= 30 or i % 2]
+        assert index.range() == expected
+        assert index.range(4, 12, include_low=False) == [i for i in expected if 15 <= int(i[3:]) < 39]
+        q = "modifiedDate >= '2015-01-01' and modifiedDate < '2015-01-02' and modifiedDate > '2014-12-01'"
+        assert query.compile_query(q).root.nodes[0]._range()[0] == query.date_key(query.parse_date('2015-01-01'))
+
+
+@pytest.fixture
+def folder_service():
+    files = [
+        {'id': 'FOLDER', 'title': "folder", 'mimeType': 'application/vnd.google-apps.folder'},
+        {'id': 'IN_FOLDER', 'title': "inside", 'mimeType': 'text/plain', 'parents': [{'id': 'FOLDER'}]},
+        {'id': 'AT_ROOT', 'title': "outside", 'mimeType': 'text/plain'},
+    ]
+    return build('drive', 'v2', http.TestbedHttp(files=files))
+
+
+class TestChildrenService(object):
+
+    def test_list(self, folder_service):
+        response = folder_service.children().list(folderId='FOLDER').execute()
+        assert response['kind'] == 'drive#childList'
+        assert [child['id'] for child in response['items']] == ['IN_FOLDER']
+        response = folder_service.children().list(folderId='root').execute()
+        assert [child['id'] for child in response['items']] == ['FOLDER', 'AT_ROOT']
+
+    def test_insert_and_delete(self, folder_service):
+        folder_service.children().insert(folderId='FOLDER', body={'id': 'AT_ROOT'}).execute()
+        parents = folder_service.parents().list(fileId='AT_ROOT').execute()
+        assert sorted(parent['id'] for parent in parents['items']) == ['FOLDER', 'ROOT_FOLDER_ID']
+        folder_service.children().delete(folderId='FOLDER', childId='IN_FOLDER').execute()
+        response = folder_service.children().list(folderId='FOLDER').execute()
+        assert [child['id'] for child in response['items']] == ['AT_ROOT']
+
+    def test_get(self, folder_service):
+        response = folder_service.children().get(folderId='FOLDER', childId='IN_FOLDER').execute()
+        assert response['kind'] == 'drive#childReference'
+        with pytest.raises(HttpError):
+            folder_service.children().get(folderId='FOLDER', childId='AT_ROOT').execute()
+
+    def test_insert_file_into_folder(self, folder_service):
+        body = {'title': "new", 'parents': [{'id': 'FOLDER'}]}
+        new_id = folder_service.files().insert(body=body).execute()['id']
+        response = folder_service.children().list(folderId='FOLDER', q="title = 'new'").execute()
+        assert [child['id'] for child in response['items']] == [new_id]
+
+    def test_delete_file(self, folder_service):
+        folder_service.files().delete(fileId='IN_FOLDER').execute()
+        response = folder_service.children().list(folderId='FOLDER').execute()
+        assert response['items'] == []
+
+    def test_unknown_folder(self, folder_service):
+        with pytest.raises(HttpError):
+            folder_service.children().list(folderId='NOPE').execute()
+
+
+class TestPermissionIndex(object):
+
+    def _share(self, directory, fileId, value, role='reader', type='user'):
+        body = {'type': type, 'role': role}
+        if value:
+            body['value'] = value
+        return directory.permissions().insert(fileId=fileId, body=body)
+
+    def test_visible_files(self):
+        directory = ServiceDirectory(files=[{'id': 'A'}, {'id': 'B'}, {'id': 'C'}, {'id': 'D'}])
+        self._share(directory, 'A', 'reader@x.org')
+        self._share(directory, 'B', 'x.org', type='domain')
+        self._share(directory, 'C', None, type='anyone')
+        assert directory.permissions()._visible_file_ids('reader@x.org') == set(['A', 'B', 'C'])
+        assert directory.permissions()._visible_file_ids('other@y.org') == set(['C'])
+
+    def test_index_follows_delete(self):
+        directory = ServiceDirectory(files=[{'id': 'A'}, {'id': 'B'}])
+        perm = self._share(directory, 'A', 'reader@x.org')
+        self._share(directory, 'B', 'reader@x.org')
+        directory.permissions().delete(fileId='A', permissionId=perm['id'])
+        directory.files().delete(fileId='B')
+        assert not directory.permissions()._file_ids_for('reader@x.org')
+
+    def test_readers_query(self, query_service):
+        body = {'type': 'user', 'role': 'writer', 'value': 'writer@x.org'}
+        query_service.permissions().insert(fileId='DOC_2', body=body).execute()
+        response = query_service.files().list(q="'writer@x.org' in writers").execute()
+        assert _ids(response) == ['DOC_2']
+        response = query_service.files().list(q="'writer@x.org' in readers").execute()
+        assert _ids(response) == []
+
+    def test_shared_with_me(self):
+        directory = ServiceDirectory(files=[{'id': 'A'}, {'id': 'B'}], user_email="me@x.org")
+        self._share(directory, 'B', 'me@x.org')
+        response = directory.files().list(q="sharedWithMe")
+        assert [item['id'] for item in response['items']] == ['B']
+
+
+class TestSnapshot(object):
+
+    def _state(self, directory):
+        files = directory.files().list(maxResults=1000)['items']
+        state = []
+        for afile in files:
+            perms = directory.permissions().list(fileId=afile['id'])['items']
+            parents = directory.parents().list(fileId=afile['id'])['items']
+            state.append((afile, perms, parents))
+        return state
+
+    def test_restore(self):
+        fixture = [{'id': 'FOLDER', 'mimeType': 'application/vnd.google-apps.folder'},
+                   {'id': 'A', 'title': "a", 'parents': [{'id': 'FOLDER'}]},
+                   {'id': 'B', 'title': "b"}]
+        directory = ServiceDirectory(files=fixture)
+        snapshot = directory.snapshot()
+        before = self._state(directory)
+        new_id = directory.files().insert(body={'title': "new", 'parents': [{'id': 'FOLDER'}]})['id']
+        directory.permissions().insert(fileId='B', body={'type': 'user', 'role': 'reader', 'value': 'r@x.org'})
+        directory.parents().insert(fileId='B', body={'id': 'FOLDER'})
+        # A, B and the new file go with the folder
+        directory.files().delete(fileId='FOLDER')
+        assert snapshot.changed == 4
+        directory.restore(snapshot)
+        assert self._state(directory) == before
+        assert directory.files().list(q="'r@x.org' in readers")['items'] == []
+        assert [child['id'] for child in directory.children().list(folderId='FOLDER')['items']] == ['A']
+        assert new_id not in directory.files()._files
+        # and again from the same snapshot
+        directory.files().delete(fileId='B')
+        directory.restore(snapshot)
+        assert self._state(directory) == before
+
+    def test_fixture_not_changed(self):
+        fixture = [{'title': "no id"}]
+        ServiceDirectory(files=fixture)
+        assert fixture == [{'title': "no id"}]
+
+    def test_stale_snapshot(self):
+        directory = ServiceDirectory()
+        snapshot = directory.snapshot()
+        directory.snapshot()
+        with pytest.raises(ValueError):
+            directory.restore(snapshot)
+
+    def test_global_service_reset(self):
+        fixture = [{'id': "GLOBAL_FILE_ID", 'title': "test global"}]
+        try:
+            http.TestbedHttp.setup_global_service(files=fixture)
+            first = http.TestbedHttp.default_service
+            first.files().delete(fileId="GLOBAL_FILE_ID")
+            http.TestbedHttp.setup_global_service(files=fixture)
+            assert http.TestbedHttp.default_service is first
+            assert "GLOBAL_FILE_ID" in first.files()._files
+        finally:
+            http.TestbedHttp.teardown_global_service()
+
+    def test_given_directory(self):
+        directory = ServiceDirectory(files=[{'id': "OWN_FILE_ID", 'title': "own"}])
+        try:
+            http.TestbedHttp.setup_global_service(files=[{'id': "GLOBAL_FILE_ID", 'title': "test global"}])
+            drive = discovery.build('drive', 'v2', http.TestbedHttp(directory=directory))
+            assert [item['id'] for item in drive.files().list().execute()['items']] == ["OWN_FILE_ID"]
+        finally:
+            http.TestbedHttp.teardown_global_service()
+
+    def test_global_service_reset_changes(self):
+        fixture = [{'id': "GLOBAL_FILE_ID", 'title': "test global"}]
+        try:
+            http.TestbedHttp.setup_global_service(files=fixture)
+            drive = discovery.build('drive', 'v2', http.TestbedHttp())
+            drive.files().insert(body={'title': "from test 1"}).execute()
+            drive.files().patch(fileId="GLOBAL_FILE_ID", body={'title': "renamed"}).execute()
+            assert drive.changes().list().execute()['items']
+            http.TestbedHttp.setup_global_service(files=fixture)
+            drive = discovery.build('drive', 'v2', http.TestbedHttp())
+            changes = drive.changes().list().execute()
+            assert changes['items'] == []
+            assert changes['largestChangeId'] == "0"
+            assert drive.files().get(fileId="GLOBAL_FILE_ID").execute()['title'] == "test global"
+        finally:
+            http.TestbedHttp.teardown_global_service()
+
+    def test_global_service_reset_metrics(self):
+        fixture = [{'id': "GLOBAL_FILE_ID", 'title': "test global"}]
+        try:
+            http.TestbedHttp.setup_global_service(files=fixture)
+            testbed = http.TestbedHttp()
+            drive = discovery.build('drive', 'v2', testbed)
+            drive.files().get(fileId="GLOBAL_FILE_ID").execute()
+            testbed.request("https://www.googleapis.com/upload/drive/v2/files?uploadType=resumable",
+                            method="POST", body=json.dumps({'title': "unfinished"}))
+            directory = http.TestbedHttp.default_service
+            assert directory.metrics().snapshot().calls() == 1
+            assert len(directory.uploads()) == 1
+            directory.set_throttle(throttle.Throttle(clock=throttle.VirtualClock()))
+            http.TestbedHttp.setup_global_service(files=fixture)
+            assert directory.metrics().snapshot().calls() == 0
+            assert len(directory.uploads()) == 0
+            assert directory.throttle() is None
+        finally:
+            http.TestbedHttp.teardown_global_service()
+
+
+FIXTURE_RECORDS = [
+    {'id': 'FOLDER', 'title': "folder", 'mimeType': 'application/vnd.google-apps.folder'},
+    {'id': 'SHARED', 'title': "shared", 'parents': [{'id': 'FOLDER'}],
+     'permissions': [{'id': 'p1', 'type': 'user', 'role': 'writer', 'emailAddress': 'w@x.org'}]},
+    {'title': "no id"},
+]
+
+
+class TestLoader(object):
+
+    def _check(self, directory):
+        assert len(directory.files()._files) == 3
+        children = directory.children().list(folderId='FOLDER')['items']
+        assert [child['id'] for child in children] == ['SHARED']
+        perms = directory.permissions().list(fileId='SHARED')['items']
+        assert [perm['id'] for perm in perms] == ['p1']
+        assert directory.permissions()._has_role('SHARED', 'w@x.org', 'writer')
+        # the file still gets the default owner
+        assert len(directory.permissions().list(fileId='FOLDER')['items']) == 1
+
+    def test_ndjson(self, tmpdir):
+        path = tmpdir.join("fixture.ndjson")
+        path.write("\n".join(json.dumps(record) for record in FIXTURE_RECORDS) + "\n")
+        directory = ServiceDirectory()
+        stats = directory.load(str(path))
+        assert stats.files == 3
+        assert stats.bytes == path.size()
+        self._check(directory)
+
+    def test_json_array(self, tmpdir):
+        path = tmpdir.join("fixture.json")
+        path.write(json.dumps(FIXTURE_RECORDS, indent=2))
+        directory = ServiceDirectory()
+        directory.load(str(path), use_mmap=True, batch_size=2)
+        self._check(directory)
+
+    def test_small_reads(self):
+        fp = StringIO(json.dumps(FIXTURE_RECORDS))
+        records = list(loader.iter_json_array(fp, read_size=7))
+        assert records == FIXTURE_RECORDS
+
+    def test_bad_array(self):
+        with pytest.raises(ValueError):
+            list(loader.iter_json_array(StringIO('[{"id": 1}, 2]')))
+
+    def test_load_into_populated_directory(self):
+        directory = ServiceDirectory(files=FIXTURE_RECORDS)
+        testbed = http.TestbedHttp(directory=directory)
+        testbed._use_schema()
+        uri = "https://www.googleapis.com/drive/v2/files/SHARED"
+        assert json.loads(testbed.request(uri)[1])['title'] == "shared"
+        assert _ids(directory.files().list(q="title contains 'shared'")) == ['SHARED']
+        # the second SHARED in the batch is the one that stays
+        directory._add_batch([
+            {'id': 'SHARED', 'title': "first", 'permissions': [{'id': 'p2', 'type': 'anyone', 'role': 'reader'}]},
+            {'id': 'SHARED', 'title': "renamed"},
+        ])
+        assert json.loads(testbed.request(uri)[1])['title'] == "renamed"
+        assert directory.files().list(q="title contains 'shared'")['items'] == []
+        assert directory.files().list(q="title contains 'first'")['items'] == []
+        assert [perm['role'] for perm in directory.permissions().list(fileId='SHARED')['items']] == ['owner']
+        assert directory.children().list(folderId='FOLDER')['items'] == []
+        assert directory.changes().list()['items'][-1]['fileId'] == 'SHARED'
+        _check_invariants(directory)
+
+
+class TestCompactRecords(object):
+
+    def test_responses_are_copies(self):
+        files = ServiceDirectory().files()
+        afile = files.insert(body={'title': "a"})
+        other_id = files.insert(body={'title': "b"})['id']
+        afile['labels']['starred'] = True
+        afile['owners'].append({'displayName': "someone"})
+        other = files.get(fileId=other_id)
+        assert other['labels']['starred'] is False
+        assert len(other['owners']) == 1
+        assert files.get(fileId=afile['id']) != afile
+
+    def test_insert_labels(self):
+        files = ServiceDirectory().files()
+        starred = files.insert(body={'title': "starred", 'labels': {'starred': True}})
+        plain = files.insert(body={'title': "plain"})
+        assert starred['labels']['starred'] is True
+        assert plain['labels']['starred'] is False
+
+    def test_default_permissions_copied_on_write(self):
+        directory = ServiceDirectory(files=[{'id': 'A'}, {'id': 'B'}])
+        perms = directory.permissions()
+        perms.insert(fileId='A', body={'type': 'user', 'role': 'reader', 'value': 'r@x.org'})
+        assert len(perms.list(fileId='A')['items']) == 2
+        assert len(perms.list(fileId='B')['items']) == 1
+        owner_id = perms.list(fileId='B')['items'][0]['id']
+        perms.delete(fileId='B', permissionId=owner_id)
+        assert len(perms.list(fileId='A')['items']) == 2
+
+    def test_root_parents_copied_on_write(self):
+        directory = ServiceDirectory(files=[{'id': 'FOLDER'}, {'id': 'A'}, {'id': 'B'}])
+        parents = directory.parents()
+        parents.insert(fileId='A', body={'id': 'FOLDER'})
+        assert [p['id'] for p in parents.list(fileId='A')['items']] == [ROOT_FOLDER_ID, 'FOLDER']
+        assert [p['id'] for p in parents.list(fileId='B')['items']] == [ROOT_FOLDER_ID]
+        assert parents.get(fileId='B', parentId=ROOT_FOLDER_ID)['selfLink'].endswith('/files/B/parents/' + ROOT_FOLDER_ID)
+
+    def test_title_index(self):
+        files = ServiceDirectory(files=[{'id': 'A', 'title': "same"}, {'id': 'B', 'title': "same"},
+                                        {'id': 'C', 'title': "other"}]).files()
+        assert set(files._ids_with('title', "same")) == set(['A', 'B'])
+        files.delete(fileId='A')
+        assert list(files._ids_with('title', "same")) == ['B']
+        assert list(files._ids_with('title', "missing")) == []
+
+
+class TestBatch(object):
+
+    def _run(self, service, requests):
+        results = {}
+
+        def callback(request_id, response, exception):
+            results[request_id] = (response, exception)
+
+        batch = BatchHttpRequest(callback=callback)
+        for request_id, request in requests:
+            batch.add(request, request_id=request_id)
+        batch.execute()
+        return results
+
+    def test_batch(self, one_file_service):
+        files = one_file_service.files()
+        results = self._run(one_file_service, [
+            ('get', files.get(fileId=ONE_FILE_ID)),
+            ('insert', files.insert(body={'title': "batched"})),
+            ('list', files.list(q="title = 'batched'")),
+        ])
+        assert results['get'][0]['id'] == ONE_FILE_ID
+        assert results['insert'][0]['title'] == "batched"
+        assert [afile['title'] for afile in results['list'][0]['items']] == ["batched"]
+        assert all(exception is None for response, exception in results.values())
+
+    def test_partial_failure(self, one_file_service):
+        files = one_file_service.files()
+        results = self._run(one_file_service, [
+            ('missing', files.get(fileId="NO_SUCH_FILE")),
+            ('delete', files.delete(fileId=ONE_FILE_ID)),
+            ('bad', files.list(pageToken="not a token")),
+        ])
+        response, exception = results['missing']
+        assert response is None
+        assert exception.resp.status == 404
+        assert "NO_SUCH_FILE" in exception.content
+        assert results['delete'][1] is None
+        assert results['bad'][1].resp.status == 400
+        with pytest.raises(HttpError):
+            files.get(fileId=ONE_FILE_ID).execute()
+
+    def test_parse_batch(self):
+        body = ('--xyz\r\nContent-Type: application/http\r\nContent-ID: <a+1>\r\n\r\n'
+                'PUT /drive/v2/files/F?alt=json HTTP/1.1\r\nContent-Type: application/json\r\n'
+                'content-length: 17\r\n\r\n{"title": "new"}\n\r\n'
+                '--xyz\r\nContent-Type: application/http\r\nContent-ID: <a+2>\r\n\r\n'
+                'GET /drive/v2/files HTTP/1.1\r\n\r\n\r\n--xyz--\r\n')
+        parts = batch.parse_batch(body, 'multipart/mixed; boundary="xyz"')
+        assert [(part.content_id, part.method, part.uri, part.body) for part in parts] == [
+            ('a+1', 'PUT', '/drive/v2/files/F?alt=json', '{"title": "new"}\n'),
+            ('a+2', 'GET', '/drive/v2/files', None)]
+        with pytest.raises(batch.BatchError):
+            batch.parse_batch(body, 'application/json')
+
+
+def _check_invariants(directory):
+    """
+    Every index agrees with the data it indexes and every file is known to every service
+    """
+    files = directory.files()
+    permissions = directory.permissions()
+    parents = directory.parents()
+    file_ids = set(files._files)
+    assert set(permissions._permissions) == file_ids
+    assert set(parents._parents) == file_ids
+    by_principal = {}
+    for file_id, perms in permissions._permissions.iteritems():
+        for perm in perms.itervalues():
+            key = (records.principal(perm), perm['role'])
+            counts = by_principal.setdefault(key, {})
+            counts[file_id] = counts.get(file_id, 0) + 1
+    assert by_principal == dict((key, ids) for key, ids in permissions._by_principal.iteritems() if ids)
+    children = {}
+    for file_id, parent_ids in parents._parents.iteritems():
+        for parent_id in parent_ids:
+            children.setdefault(parent_id, set()).add(file_id)
+    assert children == dict((parent_id, set(ids)) for parent_id, ids in parents._children.iteritems())
+    for afile in files._files.itervalues():
+        assert afile['id'] in files._ids_with('title', afile.get('title'))
+    assert files._trashed == set(afile['id'] for afile in files._files.itervalues()
+                                 if (afile.get('labels') or {}).get('trashed'))
+
+
+class TestTrash(object):
+
+    FOLDER_TYPE = 'application/vnd.google-apps.folder'
+
+    def _directory(self):
+        return ServiceDirectory(files=[
+            {'id': 'FOLDER', 'mimeType': self.FOLDER_TYPE},
+            {'id': 'SUB', 'mimeType': self.FOLDER_TYPE, 'parents': [{'id': 'FOLDER'}]},
+            {'id': 'A', 'parents': [{'id': 'SUB'}]},
+            {'id': 'B', 'parents': [{'id': 'FOLDER'}]},
+            {'id': 'OTHER'},
+        ])
+
+    def test_trash_and_untrash(self, service):
+        afile = service.files().insert(body={'title': "binned"}).execute()
+        trashed = service.files().trash(fileId=afile['id']).execute()
+        assert trashed['labels']['trashed'] and trashed['explicitlyTrashed']
+        assert _ids(service.files().list(q="trashed = true").execute()) == [afile['id']]
+        restored = service.files().untrash(fileId=afile['id']).execute()
+        assert not restored['labels']['trashed'] and 'explicitlyTrashed' not in restored
+        assert service.files().list(q="trashed = true").execute()['items'] == []
+
+    def test_folder_takes_contents_along(self):
+        directory = self._directory()
+        files = directory.files()
+        files.trash(fileId='A')
+        files.trash(fileId='FOLDER')
+        assert sorted(files._trashed) == ['A', 'B', 'FOLDER', 'SUB']
+        assert files.get(fileId='B')['explicitlyTrashed'] is False
+        files.untrash(fileId='FOLDER')
+        # A was trashed on its own, so it stays
+        assert sorted(files._trashed) == ['A']
+        assert _ids(files.list(q="trashed = false")) == ['B', 'FOLDER', 'OTHER', 'SUB']
+
+    def test_empty_trash(self):
+        directory = self._directory()
+        snapshot = directory.snapshot()
+        directory.permissions().insert(fileId='A', body={'type': 'user', 'role': 'reader', 'value': 'r@x.org'})
+        directory.files().trash(fileId='SUB')
+        directory.files().emptyTrash()
+        assert _ids(directory.files().list()) == ['B', 'FOLDER', 'OTHER']
+        assert directory.permissions()._file_ids_for('r@x.org') == set()
+        assert 'SUB' not in directory.parents()._children
+        _check_invariants(directory)
+        directory.restore(snapshot)
+        assert _ids(directory.files().list()) == ['A', 'B', 'FOLDER', 'OTHER', 'SUB']
+        _check_invariants(directory)
+
+    def test_copy_is_not_trashed(self):
+        directory = self._directory()
+        files = directory.files()
+        files.trash(fileId='A')
+        files.trash(fileId='FOLDER')
+        for file_id in ('A', 'B'):
+            copy = files.copy(fileId=file_id)
+            assert not copy['labels']['trashed'] and 'explicitlyTrashed' not in copy
+            assert copy['id'] not in files._trashed
+        _check_invariants(directory)
+
+    def test_delete_folder(self):
+        directory = self._directory()
+        directory.files().delete(fileId='FOLDER')
+        assert _ids(directory.files().list()) == ['OTHER']
+        _check_invariants(directory)
+
+
+class TestConcurrency(object):
+
+    def test_stress(self):
+        directory = ServiceDirectory(files=[{'id': 'FOLDER', 'title': "folder"}])
+        errors = []
+        stop = threading.Event()
+
+        def writer(n):
+            mine = []
+            try:
+                for i in xrange(150):
+                    afile = directory.files().insert(body={'title': "w%d" % n, 'parents': [{'id': 'FOLDER'}]})
+                    mine.append(afile['id'])
+                    directory.permissions().insert(fileId=afile['id'], body={
+                        'type': 'user', 'role': 'reader', 'value': 'r%d@x.org' % n})
+                    if i % 3 == 0:
+                        directory.files().copy(fileId=afile['id'], body={'title': "copy%d" % n})
+                    if i % 5 == 0:
+                        directory.parents().delete(fileId=mine[-1], parentId='FOLDER')
+                    if i % 2 == 0:
+                        directory.files().delete(fileId=mine.pop(0))
+            except Exception as e:
+                errors.append(e)
+
+        def reader():
+            try:
+                while not stop.is_set():
+                    listed = directory.files().list(q="'FOLDER' in parents", maxResults=50)
+                    assert all(afile['title'] != "folder" for afile in listed['items'])
+                    directory.children().list(folderId='FOLDER')
+                    with directory._lock.reading():
+                        _check_invariants(directory)
+            except Exception as e:
+                errors.append(e)
+
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            writers = [threading.Thread(target=writer, args=(n,)) for n in range(6)]
+            readers = [threading.Thread(target=reader) for n in range(3)]
+            for thread in writers + readers:
+                thread.start()
+            for thread in writers:
+                thread.join()
+            stop.set()
+            for thread in readers:
+                thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        assert errors == []
+        _check_invariants(directory)
+        # 6 writers each inserted 150, copied 50 and deleted 75
+        assert len(directory.files()._files) == 1 + 6 * (150 + 50 - 75)
+
+    def test_lock_reentrant(self):
+        lock = locking.ReadWriteLock()
+        with lock.writing():
+            with lock.writing():
+                with lock.reading():
+                    pass
+        with lock.reading():
+            with lock.reading():
+                with pytest.raises(RuntimeError):
+                    lock.acquire_write()
+        with lock.writing():
+            pass
+
+
+@pytest.fixture
+def testbed_server():
+    directory = ServiceDirectory(files=[{'id': ONE_FILE_ID, 'title': "served"}])
+    testbed = server.TestbedServer(directory).start()
+    yield testbed
+    testbed.stop()
+
+
+class TestServer(object):
+
+    def _read_response(self, fp):
+        status = fp.readline()
+        headers = {}
+        while True:
+            line = fp.readline().strip()
+            if not line:
+                break
+            name, value = line.split(':', 1)
+            headers[name.lower()] = value.strip()
+        return status, headers, fp.read(int(headers['content-length']))
+
+    def test_client(self, testbed_server):
+        drive = build('drive', 'v2', httplib2.Http(), discoveryServiceUrl=testbed_server.discovery_url)
+        assert [afile['id'] for afile in drive.files().list().execute()['items']] == [ONE_FILE_ID]
+        new_file = drive.files().insert(body={'title': "new"}).execute()
+        assert testbed_server.directory.files().get(fileId=new_file['id'])['title'] == "new"
+        with pytest.raises(HttpError) as e:
+            drive.files().get(fileId="NO_SUCH_FILE").execute()
+        assert e.value.resp.status == 404
+
+    def test_media(self, testbed_server):
+        client = httplib2.Http()
+        # newer httplib2 follows 308s as redirects, resumable uploads use them to say "carry on"
+        client.redirect_codes = client.redirect_codes - set([308])
+        drive = build('drive', 'v2', client, discoveryServiceUrl=testbed_server.discovery_url)
+        content = ''.join(chr(i % 256) for i in range(600000))
+        upload = MediaIoBaseUpload(io.BytesIO(content), 'application/octet-stream', chunksize=256 * 1024,
+                                   resumable=True)
+        new_file = drive.files().insert(body={'title': "uploaded"}, media_body=upload).execute()
+        assert new_file['fileSize'] == str(len(content))
+        assert drive.files().get_media(fileId=new_file['id']).execute() == content
+
+    def test_pipelining(self, testbed_server):
+        sock = socket.create_connection(testbed_server.address)
+        try:
+            body = json.dumps({'title': "piped"})
+            sock.sendall("GET /drive/v2/files/%s HTTP/1.1\r\nHost: x\r\n\r\n"
+                         "POST /drive/v2/files HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s"
+                         "GET /drive/v2/files/NOPE HTTP/1.1\r\nConnection: close\r\n\r\n" %
+                         (ONE_FILE_ID, len(body), body))
+            fp = sock.makefile('rb')
+            status, headers, content = self._read_response(fp)
+            assert status.startswith("HTTP/1.1 200") and json.loads(content)['id'] == ONE_FILE_ID
+            status, headers, content = self._read_response(fp)
+            assert status.startswith("HTTP/1.1 200") and json.loads(content)['title'] == "piped"
+            status, headers, content = self._read_response(fp)
+            assert status.startswith("HTTP/1.1 404") and headers['connection'] == 'close'
+            assert fp.read() == ''
+        finally:
+            sock.close()
+
+
+def _insert_in_other_process(path, title):
+    directory = ServiceDirectory(backend=backends.SqliteBackend(path))
+    directory.files().insert(body={'title': title, 'parents': [{'id': 'FOLDER'}]})
+
+
+class TestSqliteBackend(object):
+
+    FIXTURE = [{'id': 'FOLDER', 'title': "folder"},
+               {'id': 'A', 'title': "a", 'parents': [{'id': 'FOLDER'}]}]
+
+    def _open(self, tmpdir, files=None):
+        return ServiceDirectory(files=files, backend=backends.SqliteBackend(str(tmpdir.join("drive.db"))))
+
+    def test_fixture_loaded_once(self, tmpdir):
+        first = self._open(tmpdir, self.FIXTURE)
+        second = self._open(tmpdir, [{'id': 'OTHER'}])
+        assert [afile['id'] for afile in second.files().list()['items']] == ['FOLDER', 'A']
+        assert second.children().list(folderId='FOLDER')['items'][0]['id'] == 'A'
+        _check_invariants(first)
+        _check_invariants(second)
+
+    def test_writes_are_shared(self, tmpdir):
+        first = self._open(tmpdir, self.FIXTURE)
+        second = self._open(tmpdir)
+        new_id = first.files().insert(body={'title': "new", 'parents': [{'id': 'FOLDER'}]})['id']
+        first.permissions().insert(fileId=new_id, body={'type': 'user', 'role': 'reader', 'value': 'r@x.org'})
+        assert _ids(second.files().list(q="'FOLDER' in parents")) == sorted(['A', new_id])
+        assert _ids(second.files().list(q="'r@x.org' in readers")) == [new_id]
+        second.files().delete(fileId='FOLDER')
+        # A and the new file went with the folder
+        assert first.files().list()['items'] == []
+        assert 'FOLDER' not in first.parents()._children
+        _check_invariants(first)
+        _check_invariants(second)
+
+    def test_failed_write_rolled_back(self, tmpdir):
+        first = self._open(tmpdir, self.FIXTURE)
+        with pytest.raises(HttpError):
+            with first._writing():
+                first.files().insert(body={'title': "lost"})
+                first.files().delete(fileId='A')
+                raise_404('NO_SUCH_FILE')
+        assert _ids(first.files().list()) == ['A', 'FOLDER']
+        assert _ids(self._open(tmpdir).files().list()) == ['A', 'FOLDER']
+        _check_invariants(first)
+
+    def test_other_process(self, tmpdir):
+        first = self._open(tmpdir, self.FIXTURE)
+        process = multiprocessing.Process(target=_insert_in_other_process,
+                                          args=(str(tmpdir.join("drive.db")), "from afar"))
+        process.start()
+        process.join()
+        assert process.exitcode == 0
+        assert [afile['title'] for afile in first.files().list(q="'FOLDER' in parents")['items']] == ["a", "from afar"]
+
+
+class TestResponseCache(object):
+
+    def _request(self, testbed, path):
+        resp, content = testbed.request("https://www.googleapis.com/drive/v2/" + path)
+        return json.loads(content)
+
+    def test_cached_and_invalidated(self):
+        testbed = http.TestbedHttp(files=[{'id': 'A', 'title': "a"}, {'id': 'B', 'title': "b"}])
+        testbed.warm_up()
+        testbed._use_schema()
+        cache = testbed._services.response_cache()
+        assert self._request(testbed, "files")['items'][0]['id'] == 'A'
+        assert cache.stats()['misses'] == 2
+        assert self._request(testbed, "files/A")['title'] == "a"
+        assert cache.stats()['hits'] == 1
+        assert len(self._request(testbed, "files/A/permissions")['items']) == 1
+        testbed._services.permissions().insert(fileId='A', body={'type': 'anyone', 'role': 'reader'})
+        assert len(self._request(testbed, "files/A/permissions")['items']) == 2
+        snapshot = testbed._services.snapshot()
+        testbed._services.files().delete(fileId='B')
+        assert [afile['id'] for afile in self._request(testbed, "files")['items']] == ['A']
+        testbed._services.restore(snapshot)
+        assert self._request(testbed, "files/B")['title'] == "b"
+
+    def test_fixture_loaded_again(self):
+        directory = ServiceDirectory()
+        directory.load(StringIO(json.dumps({'id': 'A', 'title': "a"})), format='ndjson')
+        testbed = http.TestbedHttp(directory=directory)
+        testbed._use_schema()
+        assert self._request(testbed, "files/A")['title'] == "a"
+        directory.load(StringIO(json.dumps({'id': 'A', 'title': "reloaded"})), format='ndjson')
+        assert self._request(testbed, "files/A")['title'] == "reloaded"
+        with pytest.raises(ValueError):
+            directory.files()._add({'id': 'A', 'title': "over the top"})
+        # deleted, then forgotten by the changes log, then loaded again: back at version 0
+        directory.changes().max_deleted = 2
+        directory.load(StringIO(json.dumps({'id': 'B', 'title': "b"})), format='ndjson')
+        assert self._request(testbed, "files/B")['title'] == "b"
+        for file_id in ['B'] + [directory.files().insert(body={'title': "temp"})['id'] for i in range(5)]:
+            directory.files().delete(fileId=file_id)
+        assert directory._version('B') == 0
+        directory.load(StringIO(json.dumps({'id': 'B', 'title': "b again"})), format='ndjson')
+        assert self._request(testbed, "files/B")['title'] == "b again"
+
+    def test_list_fragments(self):
+        directory = ServiceDirectory(files=[{'id': "F%d" % i, 'title': u"f\xe9 %d" % i} for i in range(5)])
+        cache = serialize.ResponseCache()
+        response = directory.files().list()
+        expected = json.loads(json.dumps(response))
+        assert json.loads(serialize.dumps(response, cache)) == expected
+        assert json.loads(serialize.dumps(response, cache)) == expected
+        assert cache.stats()['hits'] == 5
+        assert json.loads(serialize.dumps({'items': []}, cache)) == {'items': []}
+
+    def test_lru_eviction(self):
+        cache = serialize.ResponseCache(max_bytes=50)
+        resources = [records.Resource({'n': i}, ('n', i)) for i in range(5)]
+        for resource in resources[:4]:
+            cache.fragment(resource)
+        # "{"n": 0}" is 8 bytes, so all four fit; touch the oldest then add one more
+        cache.fragment(resources[0])
+        cache.fragment(records.Resource({'n': 'x' * 20}, ('n', 'big')))
+        assert cache.stats()['evictions'] == 2
+        hits = cache.hits
+        cache.fragments([resources[0], resources[3]])
+        assert cache.hits == hits + 2
+        cache.fragment(resources[1])
+        assert cache.hits == hits + 2
+
+
+class TestChanges(object):
+
+    def _file_ids(self, response):
+        return [change['fileId'] for change in response['items']]
+
+    def test_feed(self, one_file_service):
+        drive = one_file_service
+        start = int(drive.changes().list().execute()['largestChangeId']) + 1
+        a = drive.files().insert(body={'title': "a"}).execute()['id']
+        b = drive.files().insert(body={'title': "b"}).execute()['id']
+        drive.permissions().insert(fileId=a, body={'type': 'anyone', 'role': 'reader'}).execute()
+        drive.parents().insert(fileId=ONE_FILE_ID, body={'id': b}).execute()
+        changes = drive.changes().list(startChangeId=start).execute()
+        # only the latest change to each file, oldest first
+        assert self._file_ids(changes) == [b, a, ONE_FILE_ID]
+        assert changes['largestChangeId'] == str(start + 3)
+        assert changes['items'][1]['file']['title'] == "a"
+        assert not changes['items'][1]['deleted']
+
+        latest = int(changes['largestChangeId'])
+        drive.files().delete(fileId=a).execute()
+        changes = drive.changes().list(startChangeId=latest + 1).execute()
+        assert self._file_ids(changes) == [a]
+        assert changes['items'][0]['deleted'] and 'file' not in changes['items'][0]
+        assert self._file_ids(drive.changes().list(startChangeId=start, includeDeleted=False).execute()) == \
+            [b, ONE_FILE_ID]
+        assert drive.changes().get(changeId=changes['items'][0]['id']).execute()['fileId'] == a
+        with pytest.raises(HttpError):
+            drive.changes().get(changeId=str(start)).execute()
+
+    def test_paging(self):
+        directory = ServiceDirectory()
+        ids = [directory.files().insert(body={'title': "f%d" % i})['id'] for i in range(5)]
+        changes = directory.changes()
+        seen = []
+        response = changes.list(maxResults=2)
+        while True:
+            seen.extend(self._file_ids(response))
+            if 'nextPageToken' not in response:
+                break
+            response = changes.list(maxResults=2, pageToken=response['nextPageToken'])
+        assert seen == ids
+
+    def test_log_stays_bounded(self):
+        directory = ServiceDirectory()
+        changes = directory.changes()
+        changes.max_deleted = 10
+        for i in range(200):
+            file_id = directory.files().insert(body={'title': "temp"})['id']
+            directory.permissions().insert(fileId=file_id, body={'type': 'anyone', 'role': 'reader'})
+            directory.files().delete(fileId=file_id)
+        assert len(changes._log) <= 10
+        assert changes.list()['largestChangeId'] == str(600)
+
+
+def _download(drive, file_id, chunksize):
+    fh = io.BytesIO()
+    download = MediaIoBaseDownload(fh, drive.files().get_media(fileId=file_id), chunksize=chunksize)
+    chunks = 0
+    done = False
+    while not done:
+        status, done = download.next_chunk()
+        chunks += 1
+    return fh.getvalue(), chunks
+
+
+class TestMedia(object):
+
+    CONTENT = ''.join(chr(i % 251) for i in range(300000))
+
+    def test_resumable_upload(self, service, monkeypatch):
+        # spool to a memory mapped temporary file past 64KB
+        monkeypatch.setattr(media, 'SPOOL_SIZE', 64 * 1024)
+        upload = MediaIoBaseUpload(io.BytesIO(self.CONTENT), 'application/pdf', chunksize=256 * 1024, resumable=True)
+        new_file = service.files().insert(body={'title': "big"}, media_body=upload).execute()
+        assert new_file['mimeType'] == 'application/pdf'
+        assert new_file['fileSize'] == str(len(self.CONTENT))
+        assert new_file['md5Checksum'] == hashlib.md5(self.CONTENT).hexdigest()
+        content, chunks = _download(service, new_file['id'], 100000)
+        assert content == self.CONTENT and chunks == 3
+
+    def test_simple_and_multipart(self, service):
+        untitled = service.files().insert(media_body=MediaInMemoryUpload("just content", 'text/plain')).execute()
+        assert untitled['mimeType'] == 'text/plain'
+        assert str(service.files().get_media(fileId=untitled['id']).execute()) == "just content"
+        content = "line\r\n\nanother\n"
+        described = service.files().insert(body={'title': "described"},
+                                           media_body=MediaInMemoryUpload(content, 'text/plain')).execute()
+        assert described['title'] == "described"
+        assert str(service.files().get_media(fileId=described['id']).execute()) == content
+
+    def test_range(self):
+        directory = ServiceDirectory()
+        file_id = directory.files().insert(body={'title': "ranged"}, media_body=media.Blob.from_string("0123456789"))['id']
+        testbed = http.TestbedHttp(directory=directory)
+        testbed._use_schema()
+        uri = "https://www.googleapis.com/drive/v2/files/%s?alt=media" % file_id
+        resp, content = testbed.request(uri, headers={'Range': 'bytes=2-4'})
+        assert resp.status == 206 and str(content) == "234" and resp['content-range'] == "bytes 2-4/10"
+        resp, content = testbed.request(uri, headers={'Range': 'bytes=-3'})
+        assert str(content) == "789"
+        resp, content = testbed.request(uri, headers={'Range': 'bytes=10-'})
+        assert resp.status == 416 and resp['content-range'] == "bytes */10"
+        resp, content = testbed.request(uri)
+        assert resp.status == 200 and str(content) == "0123456789"
+
+    def test_resume(self):
+        testbed = http.TestbedHttp()
+        testbed._use_schema()
+        resp, content = testbed.request("https://www.googleapis.com/upload/drive/v2/files?uploadType=resumable",
+                                        method="POST", body=json.dumps({'title': "resumed"}),
+                                        headers={'X-Upload-Content-Length': '6'})
+        location = resp['location']
+        resp, content = testbed.request(location, method="PUT", body="abc",
+                                        headers={'Content-Range': 'bytes 0-2/6'})
+        assert resp.status == 308 and resp['range'] == "bytes=0-2"
+        # a gap is refused, a status query says where to carry on from
+        with pytest.raises(HttpError):
+            testbed.request(location, method="PUT", body="f", headers={'Content-Range': 'bytes 5-5/6'})
+        resp, content = testbed.request(location, method="PUT", headers={'Content-Range': 'bytes */6'})
+        assert resp.status == 308 and resp['range'] == "bytes=0-2"
+        # resent bytes are skipped
+        resp, content = testbed.request(location, method="PUT", body="cdef",
+                                        headers={'Content-Range': 'bytes 2-5/6'})
+        assert resp.status == 200 and json.loads(content)['fileSize'] == '6'
+        assert len(testbed._services.uploads()) == 0
+
+    def test_copy_delete_and_restore(self):
+        directory = ServiceDirectory()
+        files = directory.files()
+        original = files.insert(body={'title': "original"}, media_body=media.Blob.from_string("content"))['id']
+        snapshot = directory.snapshot()
+        copied = files.copy(fileId=original)['id']
+        assert str(files.get(fileId=copied, alt='media').view()) == "content"
+        files.delete(fileId=original)
+        assert original not in files._content
+        directory.restore(snapshot)
+        assert str(files.get(fileId=original, alt='media').view()) == "content"
+        assert copied not in files._content
+
+    def test_sqlite_backend(self, tmpdir):
+        path = str(tmpdir.join("drive.db"))
+        first = ServiceDirectory(backend=backends.SqliteBackend(path))
+        file_id = first.files().insert(body={'title': "stored"}, media_body=media.Blob.from_string("stored content"))['id']
+        second = ServiceDirectory(backend=backends.SqliteBackend(path))
+        assert str(second.files().get(fileId=file_id, alt='media').view()) == "stored content"
+        first.permissions().insert(fileId=file_id, body={'type': 'anyone', 'role': 'reader'})
+        assert str(second.files().get(fileId=file_id, alt='media').view()) == "stored content"
+
+
+class TestMetrics(object):
+
+    def test_call_budget(self, one_file_service):
+        metrics = one_file_service._http._services.metrics()
+        before = metrics.snapshot()
+        one_file_service.files().list().execute()
+        one_file_service.files().list().execute()
+        with pytest.raises(HttpError):
+            one_file_service.files().get(fileId="NO_SUCH_FILE").execute()
+        one_file_service.files().insert(body={'title': "counted"}).execute()
+        calls = metrics.snapshot().since(before)
+        assert calls.calls('files.list') == 2
+        assert calls.calls() == 4
+        assert calls.errors('files.get', status=404) == 1 and calls.errors() == 1
+        inserts = calls['files.insert']
+        assert inserts.request_bytes == len(json.dumps({'title': "counted"}))
+        assert inserts.response_bytes > 0
+        assert sum(calls['files.list'].histogram) == 2
+        assert calls.calls('permissions.list') == 0
+
+    def test_unknown_action_counted(self, one_file_service):
+        metrics = one_file_service._http._services.metrics()
+        before = metrics.snapshot()
+        with pytest.raises(HttpError):
+            one_file_service.files().update(fileId=ONE_FILE_ID, body={'title': "updated"}).execute()
+        calls = metrics.snapshot().since(before)
+        assert calls.calls('files.update') == 1
+        assert calls.errors('files.update', status=404) == 1
+
+    def test_snapshot_and_reset(self):
+        directory = ServiceDirectory()
+        testbed = http.TestbedHttp(directory=directory)
+        drive = build('drive', 'v2', testbed)
+        drive.files().list().execute()
+        snapshot = directory.metrics().snapshot()
+        drive.files().list().execute()
+        assert snapshot.calls('files.list') == 1
+        directory.metrics().reset()
+        assert directory.metrics().snapshot().calls() == 0
+        # direct service calls aren't Drive calls
+        directory.files().list()
+        assert directory.metrics().snapshot().calls() == 0
+
+
+class TestThrottle(object):
+
+    def _drive(self, throttle):
+        testbed = http.TestbedHttp(directory=ServiceDirectory(files=[{'id': ONE_FILE_ID, 'title': "throttled"}],
+                                                              throttle=throttle))
+        return build('drive', 'v2', testbed)
+
+    def _error(self, request):
+        with pytest.raises(HttpError) as e:
+            request.execute()
+        error = json.loads(e.value.content)['error']
+        return e.value.resp.status, error['errors'][0]['reason']
+
+    def test_user_rate_limit(self):
+        clock = throttle.VirtualClock()
+        drive = self._drive(throttle.Throttle(clock, user_rate=2))
+        drive.files().get(fileId=ONE_FILE_ID).execute()
+        drive.files().get(fileId=ONE_FILE_ID).execute()
+        assert self._error(drive.files().get(fileId=ONE_FILE_ID)) == (403, "userRateLimitExceeded")
+        # another user has their own quota
+        drive.files().get(fileId=ONE_FILE_ID, quotaUser="someone else").execute()
+        clock.advance(0.5)
+        drive.files().get(fileId=ONE_FILE_ID).execute()
+        metrics = drive._http._services.metrics().snapshot()
+        assert metrics.errors('files.get', status=403) == 1
+
+    def test_project_rate_limit(self):
+        drive = self._drive(throttle.Throttle(throttle.VirtualClock(), project_rate=1))
+        drive.files().list().execute()
+        assert self._error(drive.files().list(quotaUser="other")) == (429, "rateLimitExceeded")
+
+    def test_refused_call_costs_nothing(self):
+        clock = throttle.VirtualClock()
+        drive = self._drive(throttle.Throttle(clock, user_rate=1, user_burst=2, project_rate=2, project_burst=1))
+        drive.files().list().execute()
+        assert self._error(drive.files().list()) == (429, "rateLimitExceeded")
+        clock.advance(0.5)
+        # the refused call didn't take the user's second token
+        drive.files().list().execute()
+
+    def test_virtual_latency_and_backoff(self):
+        clock = throttle.VirtualClock()
+        drive = self._drive(throttle.Throttle(clock, user_rate=1, user_burst=2,
+                                              latency={'files.list': throttle.fixed(2.0),
+                                                       '*': throttle.uniform(0.1, 0.2)}))
+        drive.files().list().execute()
+        assert clock.now() == 2.0
+        drive.files().get(fileId=ONE_FILE_ID).execute()
+        assert 2.1 <= clock.now() <= 2.2
+        # ten calls at one a second, backing off when refused
+        started = time.time()
+        for i in range(10):
+            delay = 0.1
+            while True:
+                try:
+                    drive.files().get(fileId=ONE_FILE_ID).execute()
+                    break
+                except HttpError:
+                    clock.sleep(delay)
+                    delay *= 2
+        assert clock.now() > 10
+        assert time.time() - started < 5
+
+
+class TestFields(object):
+
+    def test_partial_list(self, many_files_service):
+        response = many_files_service.files().list(maxResults=2, fields="items(id,title),nextPageToken").execute()
+        assert sorted(response) == ['items', 'nextPageToken']
+        assert [sorted(item) for item in response['items']] == [['id', 'title'], ['id', 'title']]
+
+    def test_partial_get(self, one_file_service):
+        file_id = one_file_service.files().insert(body={'title': "labelled"}).execute()['id']
+        response = one_file_service.files().get(fileId=file_id, fields="id,labels/starred,owners").execute()
+        assert response['labels'] == {'starred': False}
+        assert sorted(response) == ['id', 'labels', 'owners']
+        assert response['owners'][0]['displayName'] == "Test User"
+        with pytest.raises(HttpError) as e:
+            one_file_service.files().get(fileId=ONE_FILE_ID, fields="labels(starred").execute()
+        assert e.value.resp.status == 400
+
+    def test_compiled_once_and_cached(self, one_file_service):
+        projection = fields.compile_fields("items(id,title)")
+        assert fields.compile_fields("items(id,title)") is projection
+        assert fields.compile_fields("items/title,items/id").key == projection.key
+        cache = one_file_service._http._services.response_cache()
+        one_file_service.files().list(fields="items(id,title)").execute()
+        hits = cache.hits
+        response = one_file_service.files().list(fields="items(id,title)").execute()
+        assert cache.hits == hits + 1
+        assert response == {'items': [{'id': ONE_FILE_ID, 'title': "test"}]}
+
+    def test_projected_by_the_service(self):
+        directory = ServiceDirectory(files=[{'id': ONE_FILE_ID, 'title': "test"}])
+        files = directory.files()
+        response = files.list(fields="items(id,owners(displayName)),kind")
+        assert response == {'kind': "drive#fileList",
+                            'items': [{'id': ONE_FILE_ID, 'owners': [{'displayName': "Test User"}]}]}
+        # what's returned is a copy, even of the parts selected from inside a field
+        response['items'][0]['owners'][0]['displayName'] = "changed"
+        assert files.get(fileId=ONE_FILE_ID)['owners'][0]['displayName'] == "Test User"
+        assert files.list(fields="nextPageToken") == {}
+        file_id = files.insert(body={'title': "labelled"})['id']
+        everything = files.get(fileId=file_id, fields="*,labels(starred)")
+        assert everything['title'] == "labelled" and everything['labels'] == {'starred': False}
+        assert files.get(fileId=ONE_FILE_ID, fields="title") == {'title': "test"}
+
+
+class TestTraffic(object):
+
+    FILES = [{'id': 'SHARED', 'title': "shared", 'mimeType': 'text/plain'}]
+
+    def _record(self, tmpdir):
+        path = str(tmpdir.join("traffic.log"))
+        recorder = traffic.Recorder(path)
+        for user in ("a@x.org", "b@x.org"):
+            drive = build('drive', 'v2', http.TestbedHttp(files=self.FILES, user_email=user, recorder=recorder))
+            made = drive.files().insert(body={'title': "made by " + user}).execute()
+            drive.parents().insert(fileId=made['id'], body={'id': 'SHARED'}).execute()
+            drive.files().get(fileId=made['id']).execute()
+            upload = MediaIoBaseUpload(io.BytesIO('\xff\x00' * 10), 'application/pdf', chunksize=256 * 1024,
+                                       resumable=True)
+            uploaded = drive.files().insert(body={'title': "blob"}, media_body=upload).execute()
+            drive.files().get(fileId=uploaded['id']).execute()
+            with pytest.raises(HttpError):
+                drive.files().get(fileId='MISSING').execute()
+        recorder.close()
+        return path, recorder.calls
+
+    def test_record_and_replay(self, tmpdir):
+        path, recorded = self._record(tmpdir)
+        calls = list(traffic.read_log(path))
+        assert len(calls) == recorded and [call.status for call in calls].count(404) == 2
+        assert set(call.tenant for call in calls) == set(["a@x.org", "b@x.org"])
+        report = traffic.replay(path, files=self.FILES)
+        assert report.calls == recorded and report.diverged == 0 and report.failed == 0
+        assert report.endpoints['files.get'] and report.throughput > 0
+        percentiles = report.percentiles()
+        assert percentiles[50] <= percentiles[99] <= percentiles[100]
+        assert 'files.insert' in report.format()
+
+    def test_workers_and_recorded_timing(self, tmpdir):
+        path, recorded = self._record(tmpdir)
+        report = traffic.replay(path, files=self.FILES, workers=2, timing='recorded', speed=10)
+        assert report.calls == recorded and report.diverged == 0
+
+    def test_default_recorder(self, tmpdir, one_file_service):
+        path = str(tmpdir.join("default.log"))
+        http.TestbedHttp.start_recording(path)
+        try:
+            drive = build('drive', 'v2', http.TestbedHttp(files=self.FILES))
+            drive.files().list().execute()
+        finally:
+            http.TestbedHttp.stop_recording()
+        one_file_service.files().list().execute()
+        assert [call.method for call in traffic.read_log(path)] == ['GET', 'GET']
+
+    def test_replay_is_not_recorded(self, tmpdir):
+        path, recorded = self._record(tmpdir)
+        http.TestbedHttp.start_recording(path)
+        try:
+            report = traffic.replay(path, files=self.FILES)
+        finally:
+            http.TestbedHttp.stop_recording()
+        assert report.calls == recorded
+        assert len(list(traffic.read_log(path))) == recorded